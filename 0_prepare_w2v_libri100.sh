@@ -32,7 +32,7 @@ fi
 if [ ${stage} -le 3 ] && [ ${stop_stage} -ge 3 ]; then
     echo "stage 3: Prepare tsv"
     for part in $data_sets; do
-        python3 examples/wav2vec/wav2vec_manifest.py $datadir/LibriSpeech/$part --dest $tsvdir/$part --ext flac --valid-percent 0
+        python3 examples/wav2vec/wav2vec_manifest.py $datadir/LibriSpeech/$part --dest $tsvdir/$part --ext flac --valid-percent 0 --metadata-cache $tsvdir/audio_metadata.tsv
         mv $tsvdir/$part/train.tsv $tsvdir/$part/wav_dir.tsv
     done
 fi
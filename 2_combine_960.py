@@ -1,5 +1,6 @@
 #!/bin/bash
 import sys
+from itertools import zip_longest
 
 # Usage: python3 2_combine_960.py data/combined_dir data/train_clean_100 data/train_clean_360 data/train_other_500
 
@@ -11,45 +12,26 @@ for idx in range(1, len(sys.argv)):
     else:
         dir_input.append(sys.argv[idx])
 
-ltr_to_write=[]
-wrd_to_write=[]
-tsv_to_write=[]
-tsv_to_write.append('/DB/LibriSpeech/LibriSpeech\n')
-
-for dir_name in dir_input:
-    dir_ltr = dir_name + '/labels.ltr'
-    dir_wrd = dir_name + '/labels.wrd'
-    dir_tsv = dir_name + '/wav_dir.tsv'
-    pre_fix = dir_name.replace('data/', '') + '/'
-
-    with open(dir_ltr, 'r') as f:
-        lines = f.readlines()
-
-    ltr_to_write.extend(lines)
-
-    with open(dir_wrd, 'r') as f:
-        lines = f.readlines()
-    wrd_to_write.extend(lines)
-
-
-    with open(dir_tsv, 'r') as f:
-        lines = f.readlines()
-    for idx, line in enumerate(lines):
-        if idx ==0:
-            pass
-        else:
-            new_line = pre_fix + line
-            tsv_to_write.append(new_line)
-
 # write
 dir_ltr = dir_output + '/labels.ltr'
 dir_wrd = dir_output + '/labels.wrd'
 dir_tsv = dir_output + '/wav_dir.tsv'
 
+# stream every subset into the combined files, one aligned (ltr, wrd, tsv) line at a time
 with open(dir_ltr, 'w') as f1, open(dir_wrd, 'w') as f2, open(dir_tsv, 'w') as f3:
-    f1.writelines(ltr_to_write)
-    f2.writelines(wrd_to_write)
-    f3.writelines(tsv_to_write)
+    f3.write('/DB/LibriSpeech/LibriSpeech\n')
+
+    for dir_name in dir_input:
+        pre_fix = dir_name.replace('data/', '') + '/'
+
+        with open(dir_name + '/labels.ltr', 'r') as ltr, open(dir_name + '/labels.wrd', 'r') as wrd, \
+                open(dir_name + '/wav_dir.tsv', 'r') as tsv:
+            next(tsv)  # root directory of the subset
+            for line_ltr, line_wrd, line_tsv in zip_longest(ltr, wrd, tsv):
+                assert None not in (line_ltr, line_wrd, line_tsv), dir_name + ': labels and manifest are not aligned'
+                f1.write(line_ltr)
+                f2.write(line_wrd)
+                f3.write(pre_fix + line_tsv)
 
 
 # root@6e37a0302757:/home/Workspace/fairseq# cat data/train-clean-100/labels.ltr | wc -l
@@ -1,4 +1,5 @@
 import sys
+from itertools import zip_longest
 
 dir_960=sys.argv[1]
 
@@ -10,37 +11,19 @@ dir_ltr_to_write=dir_960 + '/train.ltr'
 dir_wrd_to_write=dir_960 + '/train.wrd'
 dir_tsv_to_write=dir_960 + '/train.tsv'
 
-with open(dir_ltr, 'r') as f:
-    lines_ltr = f.readlines()
-with open(dir_wrd, 'r') as f:
-    lines_wrd = f.readlines()
-with open(dir_tsv, 'r') as f:
-    lines_tsv = f.readlines()
-
 # this threshold setting (3,850) removes 5 samples in 960h.
 threshold_min=3
 threshold_max=850
 
-new_lines_ltr=[]
-new_lines_wrd=[]
-new_lines_tsv=[]
-
-new_lines_tsv.append(lines_tsv[0])
-
-for idx in range(len(lines_ltr)):
-    idx_ltr = idx
-    idx_wrd = idx
-    idx_tsv = idx+1
-
-    if threshold_min < len(lines_ltr[idx_ltr]) < threshold_max:
-        new_lines_ltr.append(lines_ltr[idx_ltr])
-        new_lines_wrd.append(lines_wrd[idx_wrd])
-        new_lines_tsv.append(lines_tsv[idx_tsv])
+# stream the aligned (ltr, wrd, tsv) lines and write the kept ones right away
+with open(dir_ltr, 'r') as ltr, open(dir_wrd, 'r') as wrd, open(dir_tsv, 'r') as tsv, \
+        open(dir_ltr_to_write, 'w') as f_ltr, open(dir_wrd_to_write, 'w') as f_wrd, open(dir_tsv_to_write, 'w') as f_tsv:
+    f_tsv.write(next(tsv))
 
-with open(dir_ltr_to_write, 'w') as f:
-    f.writelines(new_lines_ltr)
-with open(dir_wrd_to_write, 'w') as f:
-    f.writelines(new_lines_wrd)
-with open(dir_tsv_to_write, 'w') as f:
-    f.writelines(new_lines_tsv)
+    for line_ltr, line_wrd, line_tsv in zip_longest(ltr, wrd, tsv):
+        assert None not in (line_ltr, line_wrd, line_tsv), 'labels and manifest are not aligned'
 
+        if threshold_min < len(line_ltr) < threshold_max:
+            f_ltr.write(line_ltr)
+            f_wrd.write(line_wrd)
+            f_tsv.write(line_tsv)
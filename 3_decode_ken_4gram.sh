@@ -7,6 +7,8 @@ combined_data_dir=/home/Workspace/fairseq/data/combined_data
 subsets="test_clean test_other dev_clean dev_other"
 dir_checkpoint=pretrained_models/errlog041_best.pt #errlog003.pt # /home/Workspace/fairseq/outputs/2023-02-16/01-15-13/errlog003_kd/checkpoint_best.pt
 results_path=/home/Workspace/fairseq/decode_results
+trie_cache_dir=/home/Workspace/fairseq/decode_results/trie_cache # built once, reused by every subset
+decoder_workers=8 # beam search processes, 0 to decode in the main process
 SHELL_PATH=`pwd -P`
 echo $SHELL_PATH
 
@@ -17,7 +19,7 @@ if [ ${stage} -le 7 ] && [ ${stop_stage} -ge 7 ]; then
         python3 examples/speech_recognition/infer.py $combined_data_dir --task audio_finetuning \
         --nbest 1 --path $dir_checkpoint --gen-subset $subset --results-path $results_path --w2l-decoder kenlm \
         --lm-model libri_4gram.bin --lm-weight 2.15 --word-score -1 --sil-weight 0 --criterion ctc --labels ltr --max-tokens 4000000 \
-        --post-process letter --lexicon libri_lexicon.txt --beam 1500
+        --post-process letter --lexicon libri_lexicon.txt --trie-cache-dir $trie_cache_dir --beam 1500 --decoder-workers $decoder_workers
     done
 fi # beam-size: 1500
 
@@ -13,13 +13,20 @@ import logging
 import math
 import os
 import sys
+from collections import deque
 
 import editdistance
 import numpy as np
 import torch
+from examples.speech_recognition.utils.emission_store import (
+    EmissionStore,
+    EmissionStoreWriter,
+)
+from examples.speech_recognition.utils.long_form import LongFormDecoder
 from fairseq import checkpoint_utils, options, progress_bar, tasks, utils
 from fairseq.data.data_utils import post_process
 from fairseq.logging.meters import StopwatchMeter, TimeMeter
+from omegaconf import OmegaConf
 
 
 logging.basicConfig()
@@ -54,10 +61,16 @@ output units",
     )
     parser.add_argument(
         "--w2l-decoder",
-        choices=["viterbi", "kenlm", "fairseqlm"],
+        choices=["viterbi", "greedy", "kenlm", "fairseqlm"],
         help="use a w2l decoder",
     )
     parser.add_argument("--lexicon", help="lexicon for w2l decoder")
+    parser.add_argument(
+        "--trie-cache-dir",
+        default=None,
+        help="if set, the kenlm decoder caches its lexicon trie in this "
+        "directory and reuses it across runs",
+    )
     parser.add_argument("--unit-lm", action="store_true", help="if using a unit lm")
     parser.add_argument("--kenlm-model", "--lm-model", help="lm model for w2l decoder")
     parser.add_argument("--beam-threshold", type=float, default=25.0)
@@ -65,11 +78,35 @@ output units",
     parser.add_argument("--word-score", type=float, default=1.0)
     parser.add_argument("--unk-weight", type=float, default=-math.inf)
     parser.add_argument("--sil-weight", type=float, default=0.0)
+    parser.add_argument(
+        "--lm-cache-mb",
+        type=int,
+        default=256,
+        help="max size in MB of the cache of next-word distributions of the "
+        "fairseqlm decoder",
+    )
+    parser.add_argument(
+        "--decoder-workers",
+        type=int,
+        default=0,
+        help="if > 0, the kenlm decoder searches the utterances of a batch in "
+        "this many worker processes, overlapping with the emissions of the "
+        "next batch",
+    )
     parser.add_argument(
         "--dump-emissions",
         type=str,
         default=None,
-        help="if present, dumps emissions into this file and exits",
+        help="if present, dumps emissions into this directory and exits; "
+        "emissions are written as batches finish and utterances already in "
+        "the directory are skipped, so an interrupted run can be resumed",
+    )
+    parser.add_argument(
+        "--emissions-topk",
+        type=int,
+        default=0,
+        help="if > 0, --dump-emissions only keeps the this many best "
+        "log-probs of each frame",
     )
     parser.add_argument(
         "--dump-features",
@@ -81,7 +118,29 @@ output units",
         "--load-emissions",
         type=str,
         default=None,
-        help="if present, loads emissions from this file",
+        help="if present, loads emissions from this directory (written by "
+        "--dump-emissions) or from a .npy file of an older version",
+    )
+    parser.add_argument(
+        "--long-form-window",
+        type=float,
+        default=None,
+        help="if present, computes the emissions of every utterance on "
+        "overlapping windows of this many seconds, so that recordings of any "
+        "length can be transcribed; use with --batch-size or a --max-tokens "
+        "above the longest recording",
+    )
+    parser.add_argument(
+        "--long-form-overlap",
+        type=float,
+        default=1.0,
+        help="overlap of consecutive --long-form-window windows in seconds",
+    )
+    parser.add_argument(
+        "--long-form-batch-windows",
+        type=int,
+        default=16,
+        help="max number of --long-form-window windows encoded at once",
     )
     return parser
 
@@ -95,6 +154,9 @@ def check_args(args):
     assert (
         args.replace_unk is None or args.raw_text
     ), "--replace-unk requires a raw text dataset (--raw-text)"
+    assert (
+        args.long_form_window is None or not args.load_emissions
+    ), "--long-form-window requires a model, not --load-emissions"
 
 
 def get_dataset_itr(args, task, models):
@@ -185,6 +247,9 @@ def optimize_models(args, use_cuda, models):
             beamable_mm_beam_size=None if args.no_beamable_mm else args.beam,
             need_attn=args.print_alignment,
         )
+        if hasattr(model, "set_aux_outputs"):
+            # decoding only consumes the emissions
+            model.set_aux_outputs(())
         if args.fp16:
             model.half()
         if use_cuda:
@@ -202,15 +267,49 @@ class ExistingEmissionsDecoder(object):
         self.decoder = decoder
         self.emissions = emissions
 
-    def generate(self, models, sample, **unused):
+    def get_emissions(self, sample):
         ids = sample["id"].cpu().numpy()
+        if isinstance(self.emissions, EmissionStore):
+            return self.emissions.batch(ids, self.decoder.blank)
         try:
             emissions = np.stack(self.emissions[ids])
         except:
             print([x.shape for x in self.emissions[ids]])
             raise Exception("invalid sizes")
-        emissions = torch.from_numpy(emissions)
-        return self.decoder.decode(emissions)
+        return torch.from_numpy(emissions)
+
+    def generate(self, models, sample, **unused):
+        return self.decoder.decode(self.get_emissions(sample))
+
+    def generate_async(self, models, sample, **unused):
+        return self.decoder.decode_async(self.get_emissions(sample))
+
+    def close(self):
+        self.decoder.close()
+
+
+def build_generator(args, tgt_dict):
+    w2l_decoder = getattr(args, "w2l_decoder", None)
+    if w2l_decoder == "viterbi":
+        from examples.speech_recognition.w2l_decoder import W2lViterbiDecoder
+
+        return W2lViterbiDecoder(args, tgt_dict)
+    elif w2l_decoder == "greedy":
+        from examples.speech_recognition.w2l_decoder import W2lGreedyDecoder
+
+        return W2lGreedyDecoder(args, tgt_dict)
+    elif w2l_decoder == "kenlm":
+        from examples.speech_recognition.w2l_decoder import W2lKenLMDecoder
+
+        return W2lKenLMDecoder(args, tgt_dict)
+    elif w2l_decoder == "fairseqlm":
+        from examples.speech_recognition.w2l_decoder import W2lFairseqLMDecoder
+
+        return W2lFairseqLMDecoder(args, tgt_dict)
+    else:
+        print(
+            "only flashlight decoders with (viterbi, greedy, kenlm, fairseqlm) options are supported at the moment"
+        )
 
 
 def main(args, task=None, model_state=None):
@@ -230,7 +329,9 @@ def main(args, task=None, model_state=None):
     # Load ensemble
     if args.load_emissions:
         models, criterions = [], []
-        task.load_dataset(args.gen_subset)
+        # the task config built from args is a dataclass; load_dataset expects
+        # the DictConfig stored in checkpoints
+        task.load_dataset(args.gen_subset, task_cfg=OmegaConf.structured(task.cfg))
     else:
         logger.info("| loading model(s) from {}".format(args.path))
         models, saved_cfg, task = checkpoint_utils.load_model_ensemble_and_task(
@@ -267,33 +368,24 @@ def main(args, task=None, model_state=None):
     # Initialize generator
     gen_timer = StopwatchMeter()
 
-    def build_generator(args):
-        w2l_decoder = getattr(args, "w2l_decoder", None)
-        if w2l_decoder == "viterbi":
-            from examples.speech_recognition.w2l_decoder import W2lViterbiDecoder
-
-            return W2lViterbiDecoder(args, task.target_dictionary)
-        elif w2l_decoder == "kenlm":
-            from examples.speech_recognition.w2l_decoder import W2lKenLMDecoder
-
-            return W2lKenLMDecoder(args, task.target_dictionary)
-        elif w2l_decoder == "fairseqlm":
-            from examples.speech_recognition.w2l_decoder import W2lFairseqLMDecoder
-
-            return W2lFairseqLMDecoder(args, task.target_dictionary)
-        else:
-            print(
-                "only flashlight decoders with (viterbi, kenlm, fairseqlm) options are supported at the moment"
-            )
-
     # please do not touch this unless you test both generate.py and infer.py with audio_pretraining task
-    generator = build_generator(args)
+    generator = build_generator(args, task.target_dictionary)
 
     if args.load_emissions:
-        generator = ExistingEmissionsDecoder(
-            generator, np.load(args.load_emissions, allow_pickle=True)
+        if os.path.isdir(args.load_emissions):
+            emissions = EmissionStore(args.load_emissions)
+        else:
+            emissions = np.load(args.load_emissions, allow_pickle=True)
+        generator = ExistingEmissionsDecoder(generator, emissions)
+        logger.info(f"loaded {len(emissions)} emissions from {args.load_emissions}")
+    elif args.long_form_window is not None:
+        sample_rate = saved_cfg.task.get("sample_rate", 16_000)
+        generator = LongFormDecoder(
+            generator,
+            window=int(args.long_form_window * sample_rate),
+            overlap=int(args.long_form_overlap * sample_rate),
+            max_windows=args.long_form_batch_windows,
         )
-        logger.info("loaded emissions from " + args.load_emissions)
 
     num_sentences = 0
 
@@ -312,7 +404,14 @@ def main(args, task=None, model_state=None):
             max_source_pos = max_source_pos[0] - 1
 
     if args.dump_emissions:
-        emissions = {}
+        emission_writer = None
+        dumped_ids = set()
+        if os.path.exists(os.path.join(args.dump_emissions, "meta.json")):
+            dumped_ids = set(EmissionStore(args.dump_emissions).ids())
+            logger.info(
+                f"resuming: {len(dumped_ids)} emissions already in "
+                f"{args.dump_emissions}"
+            )
     if args.dump_features:
         features = {}
         models[0].bert.proj = None
@@ -320,6 +419,48 @@ def main(args, task=None, model_state=None):
         res_files = prepare_result_files(args)
     errs_t = 0
     lengths_t = 0
+
+    def process_batch(sample, hypos):
+        nonlocal errs_t, lengths_t, num_sentences
+        num_generated_tokens = sum(len(h[0]["tokens"]) for h in hypos)
+        gen_timer.stop(num_generated_tokens)
+
+        for i, sample_id in enumerate(sample["id"].tolist()):
+            speaker = None
+            # id = task.dataset(args.gen_subset).ids[int(sample_id)]
+            id = sample_id
+            toks = (
+                sample["target"][i, :]
+                if "target_label" not in sample
+                else sample["target_label"][i, :]
+            )
+            target_tokens = utils.strip_pad(toks, tgt_dict.pad()).int().cpu()
+            # Process top predictions
+            errs, length = process_predictions(
+                args,
+                hypos[i],
+                None,
+                tgt_dict,
+                target_tokens,
+                res_files,
+                speaker,
+                id,
+            )
+            errs_t += errs
+            lengths_t += length
+
+        wps_meter.update(num_generated_tokens)
+        t.log({"wps": round(wps_meter.avg)})
+        num_sentences += (
+            sample["nsentences"] if "nsentences" in sample else sample["id"].numel()
+        )
+
+    # batches whose beam search is running in the decoder workers
+    pending = deque()
+    decode_async = getattr(args, "decoder_workers", 0) > 0 and hasattr(
+        generator, "generate_async"
+    )
+
     with progress_bar.build_progress_bar(args, itr) as t:
         wps_meter = TimeMeter()
         for sample in t:
@@ -335,12 +476,23 @@ def main(args, task=None, model_state=None):
 
             gen_timer.start()
             if args.dump_emissions:
+                if dumped_ids.issuperset(sample["id"].tolist()):
+                    continue
                 with torch.no_grad():
                     encoder_out = models[0](**sample["net_input"])
                     emm = models[0].get_normalized_probs(encoder_out, log_probs=True)
-                    emm = emm.transpose(0, 1).cpu().numpy()
-                    for i, id in enumerate(sample["id"]):
-                        emissions[id.item()] = emm[i]
+                    emm = emm.transpose(0, 1)
+                    lengths = None
+                    if encoder_out.get("padding_mask") is not None:
+                        lengths = (~encoder_out["padding_mask"]).long().sum(-1)
+                    if emission_writer is None:
+                        emission_writer = EmissionStoreWriter(
+                            args.dump_emissions,
+                            emm.size(-1),
+                            topk=args.emissions_topk,
+                            prefix=f"shard{args.shard_id}",
+                        )
+                    emission_writer.add(sample["id"], emm, lengths)
                     continue
             elif args.dump_features:
                 with torch.no_grad():
@@ -354,47 +506,39 @@ def main(args, task=None, model_state=None):
                         )
                         features[id.item()] = (feat[i], padding)
                     continue
+            if decode_async:
+                with torch.no_grad():
+                    handle = generator.generate_async(models, sample)
+                targets = {
+                    k: v
+                    for k, v in sample.items()
+                    if k in ["id", "target", "target_label", "nsentences"]
+                }
+                pending.append((utils.move_to_cpu(targets), handle))
+                # stream the previous batch while this one is being searched
+                while len(pending) > 1:
+                    prev_sample, prev_handle = pending.popleft()
+                    process_batch(prev_sample, prev_handle.get())
+                continue
+
             hypos = task.inference_step(generator, models, sample, prefix_tokens)
-            num_generated_tokens = sum(len(h[0]["tokens"]) for h in hypos)
-            gen_timer.stop(num_generated_tokens)
-
-            for i, sample_id in enumerate(sample["id"].tolist()):
-                speaker = None
-                # id = task.dataset(args.gen_subset).ids[int(sample_id)]
-                id = sample_id
-                toks = (
-                    sample["target"][i, :]
-                    if "target_label" not in sample
-                    else sample["target_label"][i, :]
-                )
-                target_tokens = utils.strip_pad(toks, tgt_dict.pad()).int().cpu()
-                # Process top predictions
-                errs, length = process_predictions(
-                    args,
-                    hypos[i],
-                    None,
-                    tgt_dict,
-                    target_tokens,
-                    res_files,
-                    speaker,
-                    id,
-                )
-                errs_t += errs
-                lengths_t += length
-
-            wps_meter.update(num_generated_tokens)
-            t.log({"wps": round(wps_meter.avg)})
-            num_sentences += (
-                sample["nsentences"] if "nsentences" in sample else sample["id"].numel()
-            )
+            process_batch(sample, hypos)
+
+        while len(pending) > 0:
+            gen_timer.start()
+            prev_sample, prev_handle = pending.popleft()
+            process_batch(prev_sample, prev_handle.get())
+
+    if hasattr(generator, "close"):
+        generator.close()
 
     wer = None
     if args.dump_emissions:
-        emm_arr = []
-        for i in range(len(emissions)):
-            emm_arr.append(emissions[i])
-        np.save(args.dump_emissions, emm_arr)
-        logger.info(f"saved {len(emissions)} emissions to {args.dump_emissions}")
+        num_dumped = 0
+        if emission_writer is not None:
+            emission_writer.close()
+            num_dumped = emission_writer.num_utterances
+        logger.info(f"saved {num_dumped} emissions to {args.dump_emissions}")
     elif args.dump_features:
         feat_arr = []
         for i in range(len(features)):
@@ -60,3 +60,7 @@ class BaseDecoder:
         emissions: torch.FloatTensor,
     ) -> List[List[Dict[str, torch.LongTensor]]]:
         raise NotImplementedError
+
+    def log_stats(self) -> None:
+        """Logs decoder statistics at the end of inference."""
+        pass
@@ -41,6 +41,13 @@ class FlashlightDecoderConfig(FairseqDataclass):
         default=None,
         metadata={"help": "Lexicon for Flashlight decoder"},
     )
+    triecachedir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "If set, cache the lexicon trie built for the KenLM decoder "
+            "in this directory and reuse it across runs"
+        },
+    )
     beam: int = field(
         default=50,
         metadata={"help": "Number of beams to use for decoding"},
@@ -68,3 +75,10 @@ class FlashlightDecoderConfig(FairseqDataclass):
         default=2,
         metadata={"help": "Weight for LM while interpolating score"},
     )
+    lmcachemb: int = field(
+        default=256,
+        metadata={
+            "help": "Max size in MB of the cache of next-word distributions of "
+            "the fairseq LM decoder"
+        },
+    )
@@ -5,23 +5,22 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-import gc
 import os.path as osp
 import warnings
-from collections import deque, namedtuple
 from typing import Any, Dict, Tuple
 
-import numpy as np
 import torch
 from fairseq import tasks
 from fairseq.data.dictionary import Dictionary
 from fairseq.dataclass.utils import convert_namespace_to_omegaconf
 from fairseq.models.fairseq_model import FairseqModel
-from fairseq.utils import apply_to_sample
 from omegaconf import open_dict, OmegaConf
 
 from typing import List
 
+from examples.speech_recognition.utils.lexicon_trie import build_lexicon_trie
+from examples.speech_recognition.utils.lm_scoring import BatchedLMScorer
+
 from .decoder_config import FlashlightDecoderConfig
 from .base_decoder import BaseDecoder
 
@@ -59,24 +58,13 @@ class KenLMDecoder(BaseDecoder):
         self.unitlm = cfg.unitlm
 
         if cfg.lexicon:
-            self.lexicon = load_words(cfg.lexicon)
-            self.word_dict = create_word_dict(self.lexicon)
-            self.unk_word = self.word_dict.get_index("<unk>")
-
-            self.lm = KenLM(cfg.lmpath, self.word_dict)
-            self.trie = Trie(self.vocab_size, self.silence)
-
-            start_state = self.lm.start(False)
-            for word, spellings in self.lexicon.items():
-                word_idx = self.word_dict.get_index(word)
-                _, score = self.lm.score(start_state, word_idx)
-                for spelling in spellings:
-                    spelling_idxs = [tgt_dict.index(token) for token in spelling]
-                    assert (
-                        tgt_dict.unk() not in spelling_idxs
-                    ), f"{word} {spelling} {spelling_idxs}"
-                    self.trie.insert(spelling_idxs, word_idx, score)
-            self.trie.smear(SmearingMode.MAX)
+            self.word_dict, self.unk_word, self.lm, self.trie = build_lexicon_trie(
+                cfg.lexicon,
+                cfg.lmpath,
+                tgt_dict,
+                self.silence,
+                cache_dir=cfg.triecachedir,
+            )
 
             self.decoder_opts = LexiconDecoderOptions(
                 beam_size=cfg.beam,
@@ -168,50 +156,27 @@ class KenLMDecoder(BaseDecoder):
         return hypos
 
 
-FairseqLMState = namedtuple(
-    "FairseqLMState",
-    [
-        "prefix",
-        "incremental_state",
-        "probs",
-    ],
-)
-
-
 class FairseqLM(LM):
-    def __init__(self, dictionary: Dictionary, model: FairseqModel) -> None:
+    def __init__(
+        self, dictionary: Dictionary, model: FairseqModel, max_cache_mb: int = 256
+    ) -> None:
         super().__init__()
 
         self.dictionary = dictionary
         self.model = model
         self.unk = self.dictionary.unk()
 
-        self.save_incremental = False  # this currently does not work properly
-        self.max_cache = 20_000
-
         if torch.cuda.is_available():
             model.cuda()
         model.eval()
         model.make_generation_fast_()
 
+        self.scorer = BatchedLMScorer(model, dictionary, max_cache_mb=max_cache_mb)
         self.states = {}
-        self.stateq = deque()
 
     def start(self, start_with_nothing: bool) -> LMState:
         state = LMState()
-        prefix = torch.LongTensor([[self.dictionary.eos()]])
-        incremental_state = {} if self.save_incremental else None
-        with torch.no_grad():
-            res = self.model(prefix.cuda(), incremental_state=incremental_state)
-            probs = self.model.get_normalized_probs(res, log_probs=True, sample=None)
-
-        if incremental_state is not None:
-            incremental_state = apply_to_sample(lambda x: x.cpu(), incremental_state)
-        self.states[state] = FairseqLMState(
-            prefix.numpy(), incremental_state, probs[0, -1].cpu().numpy()
-        )
-        self.stateq.append(state)
-
+        self.states[state] = (self.dictionary.eos(),)
         return state
 
     def score(
@@ -232,62 +197,14 @@ class FairseqLM(LM):
         --------
         (LMState, float): pair of (new state, score for the current word)
         """
-        curr_state = self.states[state]
-
-        def trim_cache(targ_size: int) -> None:
-            while len(self.stateq) > targ_size:
-                rem_k = self.stateq.popleft()
-                rem_st = self.states[rem_k]
-                rem_st = FairseqLMState(rem_st.prefix, None, None)
-                self.states[rem_k] = rem_st
-
-        if curr_state.probs is None:
-            new_incremental_state = (
-                curr_state.incremental_state.copy()
-                if curr_state.incremental_state is not None
-                else None
-            )
-            with torch.no_grad():
-                if new_incremental_state is not None:
-                    new_incremental_state = apply_to_sample(
-                        lambda x: x.cuda(), new_incremental_state
-                    )
-                elif self.save_incremental:
-                    new_incremental_state = {}
-
-                res = self.model(
-                    torch.from_numpy(curr_state.prefix).cuda(),
-                    incremental_state=new_incremental_state,
-                )
-                probs = self.model.get_normalized_probs(
-                    res, log_probs=True, sample=None
-                )
-
-                if new_incremental_state is not None:
-                    new_incremental_state = apply_to_sample(
-                        lambda x: x.cpu(), new_incremental_state
-                    )
-
-                curr_state = FairseqLMState(
-                    curr_state.prefix, new_incremental_state, probs[0, -1].cpu().numpy()
-                )
-
-            if not no_cache:
-                self.states[state] = curr_state
-                self.stateq.append(state)
-
-        score = curr_state.probs[token_index].item()
-
-        trim_cache(self.max_cache)
+        prefix = self.states[state]
+        score = self.scorer.score(prefix, token_index)
 
         outstate = state.child(token_index)
         if outstate not in self.states and not no_cache:
-            prefix = np.concatenate(
-                [curr_state.prefix, torch.LongTensor([[token_index]])], -1
-            )
-            incr_state = curr_state.incremental_state
-
-            self.states[outstate] = FairseqLMState(prefix, incr_state, None)
+            self.states[outstate] = prefix + (token_index,)
+            if token_index not in (self.unk, self.dictionary.eos()):
+                self.scorer.prefetch(self.states[outstate])
 
         if token_index == self.unk:
             score = float("-inf")
@@ -304,9 +221,9 @@ class FairseqLM(LM):
         return self.score(state, self.dictionary.eos())
 
     def empty_cache(self) -> None:
+        # the scorer's cache is keyed by word prefixes and stays valid
         self.states = {}
-        self.stateq = deque()
-        gc.collect()
+        self.scorer.clear_pending()
 
 
 class FairseqLMDecoder(BaseDecoder):
@@ -340,7 +257,7 @@ class FairseqLMDecoder(BaseDecoder):
 
         self.word_dict = task.dictionary
         self.unk_word = self.word_dict.unk()
-        self.lm = FairseqLM(self.word_dict, model)
+        self.lm = FairseqLM(self.word_dict, model, max_cache_mb=cfg.lmcachemb)
 
         if self.lexicon:
             start_state = self.lm.start(False)
@@ -431,3 +348,7 @@ class FairseqLMDecoder(BaseDecoder):
             self.lm.empty_cache()
 
         return hypos
+
+    def log_stats(self) -> None:
+        if isinstance(self.lm, FairseqLM):
+            self.lm.scorer.log_stats()
@@ -195,6 +195,9 @@ class InferenceProcessor:
 
     def optimize_model(self, model: FairseqModel) -> None:
         model.make_generation_fast_()
+        if hasattr(model, "set_aux_outputs"):
+            # decoding only consumes the emissions
+            model.set_aux_outputs(())
         if self.cfg.common.fp16:
             model.half()
         if not self.cfg.common.cpu:
@@ -337,6 +340,7 @@ class InferenceProcessor:
             self.num_sentences / (self.gen_timer.sum + 1e-6),
             1.0 / (self.gen_timer.avg + 1e-6),
         )
+        self.generator.log_stats()
 
 
 def parse_wer(wer_file: Path) -> float:
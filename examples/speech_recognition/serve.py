@@ -0,0 +1,436 @@
+#!/usr/bin/env python3 -u
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Serves a CTC model (e.g. a fine-tuned wav2vec 2.0 checkpoint) for
+transcription of raw waveforms over HTTP, or over stdin/stdout.
+
+The model is loaded once. Requests are batched dynamically: a batch is
+dispatched when its padded length reaches --max-batch-frames or when its
+oldest request has waited --max-batch-delay seconds. One thread encodes the
+batches and another decodes them, so that the search of a batch overlaps the
+encoding of the next one. Takes the arguments of infer.py, e.g.
+
+    python examples/speech_recognition/serve.py /path/to/data \\
+        --task audio_finetuning --labels ltr --post-process letter \\
+        --path /path/to/model --w2l-decoder greedy --port 8000
+
+    curl --data-binary @utterance.wav localhost:8000/transcribe
+    curl localhost:8000/metrics
+
+With --stdin, audio file paths are read from stdin and one JSON line is
+written per file.
+"""
+
+import ast
+import io
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from examples.speech_recognition.infer import (
+    build_generator,
+    make_parser,
+    optimize_models,
+)
+from examples.speech_recognition.w2l_decoder import W2lGreedyDecoder
+from fairseq import checkpoint_utils, options, tasks, utils
+from fairseq.data.data_utils import post_process
+
+logger = logging.getLogger(__name__)
+
+
+def add_serving_args(parser):
+    group = parser.add_argument_group("serving")
+    group.add_argument("--host", default="localhost")
+    group.add_argument("--port", type=int, default=8000)
+    group.add_argument(
+        "--stdin",
+        action="store_true",
+        help="transcribe the audio files whose paths are read from stdin "
+        "instead of serving HTTP",
+    )
+    group.add_argument(
+        "--max-batch-frames",
+        type=int,
+        default=1_600_000,
+        help="max number of padded audio frames in a batch",
+    )
+    group.add_argument(
+        "--max-batch-delay",
+        type=float,
+        default=0.05,
+        help="max number of seconds a request waits for other requests to be "
+        "batched with",
+    )
+    return parser
+
+
+class _Request(object):
+    def __init__(self, source):
+        self.source = source
+        self.arrival = time.perf_counter()
+        self.future = Future()
+
+
+class AsrServer(object):
+    """Transcribes waveforms submitted from any number of threads.
+
+    Args:
+        model: CTC model taking ``source`` and ``padding_mask``
+        decoder: a decoder of :mod:`examples.speech_recognition.w2l_decoder`
+        tgt_dict (~fairseq.data.Dictionary): target dictionary
+        post_process (str): post-processing of the decoded units, see
+            :func:`fairseq.data.data_utils.post_process`
+        max_batch_frames (int): max number of padded frames in a batch
+        max_batch_delay (float): max number of seconds a request waits for
+            other requests to be batched with
+        sample_rate (int): sample rate of the submitted waveforms
+        normalize (bool): normalize each waveform to zero mean and unit
+            variance, as the model was trained with ``normalize: true``
+    """
+
+    def __init__(
+        self,
+        model,
+        decoder,
+        tgt_dict,
+        post_process="letter",
+        max_batch_frames=1_600_000,
+        max_batch_delay=0.05,
+        sample_rate=16_000,
+        normalize=False,
+    ):
+        self.model = model
+        self.model.eval()
+        self.decoder = decoder
+        self.tgt_dict = tgt_dict
+        self.post_process = post_process
+        self.max_batch_frames = max_batch_frames
+        self.max_batch_delay = max_batch_delay
+        self.sample_rate = sample_rate
+        self.normalize = normalize
+        param = next(model.parameters())
+        self.device, self.dtype = param.device, param.dtype
+
+        self._requests = queue.Queue()
+        # at most one encoded batch waits for the decoder
+        self._encoded = queue.Queue(maxsize=1)
+        self._next_request = None
+        self._closing = False
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=100_000)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.audio_seconds = 0.0
+        self.encode_seconds = 0.0
+        self.decode_seconds = 0.0
+
+        self._threads = [
+            threading.Thread(target=self._encode_loop, daemon=True),
+            threading.Thread(target=self._decode_loop, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, waveform):
+        """Queues a waveform (1-D, or 2-D with channels last) for
+        transcription. Returns a :class:`~concurrent.futures.Future` of a dict
+        with the ``text`` and the ``latency`` in seconds."""
+        assert not self._closing, "the server is closed"
+        source = torch.as_tensor(waveform, dtype=torch.float32)
+        if source.dim() == 2:
+            source = source.mean(-1)
+        assert source.dim() == 1 and len(source) > 0, source.shape
+        if self.normalize:
+            source = F.layer_norm(source, source.shape)
+        request = _Request(source)
+        self._requests.put(request)
+        return request.future
+
+    def transcribe(self, waveform, timeout=None):
+        return self.submit(waveform).result(timeout)
+
+    def close(self):
+        """Transcribes the queued requests and stops the server."""
+        if not self._closing:
+            self._closing = True
+            self._requests.put(None)
+            for thread in self._threads:
+                thread.join()
+            if hasattr(self.decoder, "close"):
+                self.decoder.close()
+
+    def metrics(self):
+        """Latency percentiles of the recent requests and real-time factors
+        (processing time over audio duration) of the encoder, the decoder and
+        both."""
+        with self._lock:
+            latencies = np.array(self._latencies)
+            audio_seconds = self.audio_seconds
+            metrics = {
+                "requests": self.num_requests,
+                "batches": self.num_batches,
+                "audio_seconds": audio_seconds,
+            }
+            busy = {
+                "encoder_rtf": self.encode_seconds,
+                "decoder_rtf": self.decode_seconds,
+                "rtf": self.encode_seconds + self.decode_seconds,
+            }
+        for p in [50, 90, 99]:
+            metrics[f"latency_p{p}_ms"] = (
+                float(np.percentile(latencies, p) * 1000) if len(latencies) else None
+            )
+        for name, seconds in busy.items():
+            metrics[name] = seconds / audio_seconds if audio_seconds > 0 else None
+        return metrics
+
+    def _next_batch(self):
+        """Waits until a batch is due and returns its requests, or None once
+        the server is closed and all requests are done."""
+        batch, width = [], 0
+        while True:
+            if self._next_request is not None:
+                request, self._next_request = self._next_request, None
+            elif self._closing and self._requests.empty():
+                request = None
+            else:
+                timeout = None
+                if len(batch) > 0:
+                    timeout = batch[0].arrival + self.max_batch_delay
+                    timeout -= time.perf_counter()
+                    if timeout <= 0:
+                        return batch
+                try:
+                    request = self._requests.get(timeout=timeout)
+                except queue.Empty:
+                    return batch
+            if request is None:
+                return batch if len(batch) > 0 else None
+
+            new_width = max(width, len(request.source))
+            if len(batch) > 0 and new_width * (len(batch) + 1) > self.max_batch_frames:
+                self._next_request = request
+                return batch
+            batch.append(request)
+            width = new_width
+            if width * len(batch) >= self.max_batch_frames:
+                return batch
+
+    def _encode(self, sources):
+        lengths = torch.LongTensor([len(s) for s in sources])
+        source = torch.zeros(len(sources), int(lengths.max()))
+        for i, s in enumerate(sources):
+            source[i, : len(s)] = s
+        padding_mask = torch.arange(source.size(1)) >= lengths.unsqueeze(1)
+        source = source.to(device=self.device, dtype=self.dtype)
+        padding_mask = padding_mask.to(self.device)
+
+        with torch.no_grad():
+            encoder_out = self.model(source=source, padding_mask=padding_mask)
+            if hasattr(self.model, "get_logits"):
+                emissions = self.model.get_logits(encoder_out)
+            else:
+                emissions = self.model.get_normalized_probs(encoder_out, log_probs=True)
+        emissions = emissions.transpose(0, 1)
+        input_lengths = None
+        if encoder_out.get("padding_mask", None) is not None:
+            input_lengths = (~encoder_out["padding_mask"]).long().sum(-1)
+        return emissions, input_lengths
+
+    def _decode(self, emissions, input_lengths):
+        if isinstance(self.decoder, W2lGreedyDecoder):
+            hypos = self.decoder.decode(emissions, input_lengths)
+        else:
+            hypos = self.decoder.decode_async(
+                emissions.float().cpu().contiguous()
+            ).get()
+        texts = []
+        for nbest in hypos:
+            if "words" in nbest[0]:
+                texts.append(" ".join(nbest[0]["words"]))
+            else:
+                units = self.tgt_dict.string(nbest[0]["tokens"].int().cpu())
+                texts.append(post_process(units, self.post_process))
+        return texts
+
+    def _encode_loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                self._encoded.put(None)
+                return
+            start = time.perf_counter()
+            try:
+                encoded = self._encode([r.source for r in batch])
+            except Exception as e:
+                logger.exception("encoding failed")
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            with self._lock:
+                self.encode_seconds += time.perf_counter() - start
+            self._encoded.put((batch, encoded))
+
+    def _decode_loop(self):
+        while True:
+            item = self._encoded.get()
+            if item is None:
+                return
+            batch, (emissions, input_lengths) = item
+            start = time.perf_counter()
+            try:
+                texts = self._decode(emissions, input_lengths)
+            except Exception as e:
+                logger.exception("decoding failed")
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            with self._lock:
+                self.decode_seconds += done - start
+                self.num_batches += 1
+                for request in batch:
+                    self.num_requests += 1
+                    self.audio_seconds += len(request.source) / self.sample_rate
+                    self._latencies.append(done - request.arrival)
+            for request, text in zip(batch, texts):
+                request.future.set_result(
+                    {"text": text, "latency": done - request.arrival}
+                )
+
+
+def make_http_server(server, host="localhost", port=8000):
+    """HTTP front end of *server*: ``POST /transcribe`` with an audio file as
+    the body, ``GET /metrics``. Each request is handled in its own thread, so
+    that concurrent requests are batched together."""
+    import soundfile as sf
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != "/transcribe":
+                return self._reply(404, {"error": f"unknown path {self.path}"})
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                waveform, sample_rate = sf.read(io.BytesIO(body), dtype="float32")
+            except Exception as e:
+                return self._reply(400, {"error": f"cannot read audio: {e}"})
+            if sample_rate != server.sample_rate:
+                return self._reply(
+                    400,
+                    {"error": f"sample rate {sample_rate}, need {server.sample_rate}"},
+                )
+            try:
+                future = server.submit(waveform)
+            except AssertionError as e:  # e.g. empty audio
+                return self._reply(400, {"error": f"invalid audio: {e}"})
+            try:
+                result = future.result()
+            except Exception as e:  # raised by the model or the decoder
+                return self._reply(500, {"error": str(e)})
+            self._reply(200, result)
+
+        def do_GET(self):
+            if self.path != "/metrics":
+                return self._reply(404, {"error": f"unknown path {self.path}"})
+            self._reply(200, server.metrics())
+
+        def _reply(self, code, obj):
+            data = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def serve_stdin(server, lines=sys.stdin, out=sys.stdout):
+    """Transcribes the audio files listed in *lines*, writing the results
+    in order while later files are being batched."""
+    import soundfile as sf
+
+    pending = deque()
+
+    def write(path, future):
+        print(json.dumps(dict(path=path, **future.result())), file=out, flush=True)
+
+    for line in lines:
+        path = line.strip()
+        if len(path) == 0:
+            continue
+        waveform, sample_rate = sf.read(path, dtype="float32")
+        assert sample_rate == server.sample_rate, (path, sample_rate)
+        pending.append((path, server.submit(waveform)))
+        while len(pending) > 0 and pending[0][1].done():
+            write(*pending.popleft())
+    while len(pending) > 0:
+        write(*pending.popleft())
+
+
+def load_server(args):
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    task = tasks.setup_task(args)
+    logger.info("| loading model(s) from {}".format(args.path))
+    models, saved_cfg, task = checkpoint_utils.load_model_ensemble_and_task(
+        utils.split_paths(args.path, separator="\\"),
+        arg_overrides=ast.literal_eval(args.model_overrides),
+        task=task,
+    )
+    optimize_models(args, use_cuda, models)
+    return AsrServer(
+        models[0],
+        build_generator(args, task.target_dictionary),
+        task.target_dictionary,
+        post_process=args.post_process,
+        max_batch_frames=args.max_batch_frames,
+        max_batch_delay=args.max_batch_delay,
+        sample_rate=saved_cfg.task.get("sample_rate", 16_000),
+        normalize=saved_cfg.task.get("normalize", False),
+    )
+
+
+def main(args):
+    server = load_server(args)
+    try:
+        if args.stdin:
+            serve_stdin(server)
+        else:
+            http_server = make_http_server(server, args.host, args.port)
+            logger.info(f"serving on http://{args.host}:{args.port}")
+            try:
+                http_server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            http_server.server_close()
+    finally:
+        server.close()
+        logger.info(json.dumps(server.metrics()))
+
+
+def cli_main():
+    parser = add_serving_args(make_parser())
+    args = options.parse_args_and_arch(parser)
+    main(args)
+
+
+if __name__ == "__main__":
+    cli_main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3 -u
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Tunes the LM weight, word score, silence weight and beam size of the KenLM
+lexicon decoder on emissions computed once with infer.py --dump-emissions.
+
+Takes the arguments of infer.py. If --emissions-dir does not hold emissions
+yet, they are computed first with the model given by --path. Every worker
+process builds (or, with fork, inherits) one lexicon trie and KenLM and only
+rebuilds the beam search when the parameters change.
+
+    python examples/speech_recognition/tune_decoder.py /path/to/data \\
+        --task audio_finetuning --gen-subset dev_other --labels ltr \\
+        --post-process letter --path /path/to/model \\
+        --emissions-dir /path/to/emissions/dev_other \\
+        --lexicon lexicon.txt --kenlm-model 4gram.bin --beam 500 \\
+        --lm-weights 1,1.5,2,2.5 --word-scores=-1,0,1 \\
+        --early-stop-utterances 300
+"""
+
+import copy
+import itertools
+import logging
+import math
+import os
+import random
+
+import editdistance
+import torch.multiprocessing as mp
+from examples.speech_recognition.infer import main as infer_main
+from examples.speech_recognition.infer import make_parser
+from examples.speech_recognition.utils.emission_store import EmissionStore
+from fairseq import options, tasks
+from fairseq.data.data_utils import post_process
+from omegaconf import OmegaConf
+
+logger = logging.getLogger(__name__)
+
+SEARCH_PARAMS = ["lm_weight", "word_score", "sil_weight", "beam"]
+
+
+def add_tuning_args(parser):
+    group = parser.add_argument_group("decoder tuning")
+    group.add_argument(
+        "--emissions-dir",
+        required=True,
+        help="emission store to tune on, computed with --path if it does not "
+        "exist yet",
+    )
+    # defaults to the value of --lm-weight, --word-score, --sil-weight, --beam
+    group.add_argument("--lm-weights", help="comma-separated LM weights")
+    group.add_argument("--word-scores", help="comma-separated word scores")
+    group.add_argument("--sil-weights", help="comma-separated silence weights")
+    group.add_argument("--beams", help="comma-separated beam sizes")
+    group.add_argument(
+        "--search",
+        choices=["grid", "random"],
+        default="grid",
+        help="evaluate every combination, or --num-trials random points "
+        "between the smallest and largest value of each list",
+    )
+    group.add_argument("--num-trials", type=int, default=20)
+    group.add_argument(
+        "--max-utterances",
+        type=int,
+        default=0,
+        help="if > 0, only tune on this many utterances",
+    )
+    group.add_argument(
+        "--early-stop-utterances",
+        type=int,
+        default=0,
+        help="if > 0, first decode this many utterances with every "
+        "configuration and only finish the best --early-stop-keep of them",
+    )
+    group.add_argument("--early-stop-keep", type=float, default=0.25)
+    group.add_argument(
+        "--tuning-workers",
+        type=int,
+        default=os.cpu_count(),
+        help="decoding processes",
+    )
+    group.add_argument(
+        "--tuning-results", help="if set, writes the WER table to this tsv file"
+    )
+    return parser
+
+
+def _values(arg, default, type):
+    if arg is None:
+        return [type(default)]
+    return [type(v) for v in arg.split(",")]
+
+
+def make_configs(args):
+    values = {
+        "lm_weight": _values(args.lm_weights, args.lm_weight, float),
+        "word_score": _values(args.word_scores, args.word_score, float),
+        "sil_weight": _values(args.sil_weights, args.sil_weight, float),
+        "beam": _values(args.beams, args.beam, int),
+    }
+    if args.search == "grid":
+        return [
+            dict(zip(SEARCH_PARAMS, point))
+            for point in itertools.product(*(values[p] for p in SEARCH_PARAMS))
+        ]
+
+    rng = random.Random(args.seed)
+    configs = []
+    for _ in range(args.num_trials):
+        config = {
+            p: round(rng.uniform(min(values[p]), max(values[p])), 3)
+            for p in ["lm_weight", "word_score", "sil_weight"]
+        }
+        config["beam"] = rng.choice(values["beam"])
+        configs.append(config)
+    return configs
+
+
+def load_references(args, ids):
+    """Reference words of the utterances *ids* of --gen-subset."""
+    task = tasks.setup_task(args)
+    task.load_dataset(args.gen_subset, task_cfg=OmegaConf.structured(task.cfg))
+    dataset = task.dataset(args.gen_subset)
+    refs = {}
+    for id in ids:
+        target = dataset.get_label(id, process_fn=dataset.process_label)
+        units = task.target_dictionary.string(target)
+        refs[id] = post_process(units, args.post_process).split()
+    return task.target_dictionary, refs
+
+
+# state of a tuning worker process, see _init_tuning_worker
+_worker = {}
+
+
+def _init_tuning_worker(decoder, args, tgt_dict, emissions_dir, refs):
+    if decoder is None:
+        from examples.speech_recognition.w2l_decoder import W2lKenLMDecoder
+
+        decoder = W2lKenLMDecoder(args, tgt_dict)
+    _worker["decoder"] = decoder
+    _worker["store"] = EmissionStore(emissions_dir)
+    _worker["refs"] = refs
+
+
+def _evaluate(config_idx, config, ids):
+    """Word errors of the configuration on the utterances *ids*."""
+    decoder = _worker["decoder"]
+    if decoder.search_params != config:
+        decoder.set_search_params(**config)
+    errors = words = 0
+    for id in ids:
+        emissions = _worker["store"].batch([id], decoder.blank)
+        hypo = decoder.decode(emissions)[0][0]
+        ref = _worker["refs"][id]
+        errors += editdistance.eval(hypo["words"], ref)
+        words += len(ref)
+    return config_idx, errors, words
+
+
+def _chunks(ids, num_chunks):
+    size = max(1, math.ceil(len(ids) / num_chunks))
+    return [ids[i : i + size] for i in range(0, len(ids), size)]
+
+
+def run_rung(pool, configs, active, ids, num_workers, errors, words):
+    """Decodes *ids* with the *active* configurations, adding to their
+    error and word counts."""
+    # several chunks per worker keep all of them busy until the end
+    chunks = _chunks(ids, max(1, 4 * num_workers // len(active)))
+    jobs = [(i, configs[i], chunk) for i in active for chunk in chunks]
+    for i, errs, n in pool.starmap(_evaluate, jobs, chunksize=1):
+        errors[i] += errs
+        words[i] += n
+
+
+def format_table(configs, rows):
+    header = SEARCH_PARAMS + ["utterances", "wer"]
+    lines = ["\t".join(header)]
+    for i, num_utterances, wer in rows:
+        values = [str(configs[i][p]) for p in SEARCH_PARAMS]
+        lines.append("\t".join(values + [str(num_utterances), f"{wer:.2f}"]))
+    return "\n".join(lines)
+
+
+def main(args):
+    if not os.path.exists(os.path.join(args.emissions_dir, "meta.json")):
+        assert args.path is not None, "--path is required to compute emissions"
+        dump_args = copy.copy(args)
+        dump_args.dump_emissions = args.emissions_dir
+        dump_args.w2l_decoder = "greedy"
+        infer_main(dump_args)
+
+    store = EmissionStore(args.emissions_dir)
+    ids = sorted(store.ids())
+    if args.max_utterances > 0:
+        ids = ids[: args.max_utterances]
+    tgt_dict, refs = load_references(args, ids)
+    configs = make_configs(args)
+    logger.info(
+        f"tuning {len(configs)} configurations on {len(ids)} utterances "
+        f"with {args.tuning_workers} workers"
+    )
+
+    worker_args = copy.copy(args)
+    worker_args.decoder_workers = 0
+    if "fork" in mp.get_all_start_methods():
+        from examples.speech_recognition.w2l_decoder import W2lKenLMDecoder
+
+        # the trie and KenLM are shared copy-on-write by the workers
+        ctx = mp.get_context("fork")
+        decoder = W2lKenLMDecoder(worker_args, tgt_dict)
+    else:
+        ctx = mp.get_context("spawn")
+        decoder = None
+    initargs = (decoder, worker_args, tgt_dict, args.emissions_dir, refs)
+
+    errors = [0] * len(configs)
+    words = [0] * len(configs)
+    active = list(range(len(configs)))
+    rows = []
+    with ctx.Pool(args.tuning_workers, _init_tuning_worker, initargs) as pool:
+        rungs = [ids]
+        if 0 < args.early_stop_utterances < len(ids) and len(configs) > 1:
+            prefix = args.early_stop_utterances
+            rungs = [ids[:prefix], ids[prefix:]]
+        for rung, rung_ids in enumerate(rungs):
+            run_rung(
+                pool, configs, active, rung_ids, args.tuning_workers, errors, words
+            )
+            active.sort(key=lambda i: errors[i] / max(words[i], 1))
+            if rung + 1 < len(rungs):
+                keep = max(1, math.ceil(args.early_stop_keep * len(active)))
+                for i in active[keep:]:
+                    rows.append(
+                        (i, len(rung_ids), 100.0 * errors[i] / max(words[i], 1))
+                    )
+                active = active[:keep]
+                logger.info(
+                    f"early stopping {len(configs) - keep} configurations after "
+                    f"{len(rung_ids)} utterances"
+                )
+        for i in active:
+            rows.append((i, len(ids), 100.0 * errors[i] / max(words[i], 1)))
+
+    # finished configurations first, best first
+    rows.sort(key=lambda row: (-row[1], row[2]))
+    table = format_table(configs, rows)
+    logger.info("WER table:\n" + table)
+    if args.tuning_results is not None:
+        with open(args.tuning_results, "w") as f:
+            print(table, file=f)
+    best = configs[rows[0][0]]
+    logger.info(f"best: {best} with WER {rows[0][2]:.2f}")
+    return best, rows[0][2]
+
+
+def cli_main():
+    parser = add_tuning_args(make_parser())
+    args = options.parse_args_and_arch(parser)
+    main(args)
+
+
+if __name__ == "__main__":
+    cli_main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Sharded on-disk store of CTC emissions, written by infer.py --dump-emissions
+and read back by --load-emissions.
+"""
+
+import glob
+import json
+import os
+
+import numpy as np
+import torch
+
+INDEX_DTYPE = np.dtype([("id", "<i8"), ("offset", "<i8"), ("frames", "<i8")])
+
+# log-prob of the classes pruned from a top-k store
+PRUNED_LOG_PROB = -1e4
+
+
+def _frame_dtype(num_classes, topk):
+    if topk > 0:
+        return np.dtype([("values", "<f2", (topk,)), ("classes", "<i2", (topk,))])
+    return np.dtype([("values", "<f2", (num_classes,))])
+
+
+def _shard_key(index_file):
+    prefix, counter, _ = os.path.basename(index_file).rsplit(".", 2)
+    return prefix, int(counter)
+
+
+def _read_meta(path):
+    with open(os.path.join(path, "meta.json")) as f:
+        return json.load(f)
+
+
+class EmissionStore(object):
+    """Read-only view of the emissions stored in *path* by
+    :class:`EmissionStoreWriter`.
+
+    Every shard is memory-mapped and utterances are only decoded to float32
+    when accessed, so the store can be much larger than the available memory.
+    Index entries pointing past the end of their shard (an interrupted
+    write) are ignored; if an utterance was stored more than once, the last
+    copy wins.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        meta = _read_meta(path)
+        self.num_classes = meta["num_classes"]
+        self.topk = meta["topk"]
+        frame_dtype = _frame_dtype(self.num_classes, self.topk)
+
+        self.shards = []
+        self.index = {}
+        index_files = glob.glob(os.path.join(path, "*.index"))
+        for index_file in sorted(index_files, key=_shard_key):
+            with open(index_file, "rb") as f:
+                data = f.read()
+            entries = np.frombuffer(
+                data[: len(data) - len(data) % INDEX_DTYPE.itemsize],
+                dtype=INDEX_DTYPE,
+            )
+            bin_file = index_file[: -len(".index")] + ".bin"
+            num_frames = os.path.getsize(bin_file) // frame_dtype.itemsize
+            if num_frames == 0:
+                continue
+            shard = len(self.shards)
+            self.shards.append(
+                np.memmap(bin_file, dtype=frame_dtype, mode="r", shape=(num_frames,))
+            )
+            for id, offset, frames in entries.tolist():
+                if offset + frames <= num_frames:
+                    self.index[id] = (shard, offset, frames)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, id):
+        return id in self.index
+
+    def ids(self):
+        return self.index.keys()
+
+    def num_frames(self, id):
+        return self.index[id][2]
+
+    def __getitem__(self, id):
+        """Log-probs of utterance *id* as a float32 array of shape
+        `(frames, num_classes)`."""
+        shard, offset, frames = self.index[id]
+        rows = self.shards[shard][offset : offset + frames]
+        if self.topk == 0:
+            return rows["values"].astype(np.float32)
+        out = np.full((frames, self.num_classes), PRUNED_LOG_PROB, dtype=np.float32)
+        np.put_along_axis(
+            out, rows["classes"].astype(np.int64), rows["values"].astype(np.float32), 1
+        )
+        return out
+
+    def batch(self, ids, blank_idx):
+        """Emissions of *ids* right-padded into a `(B, T, C)` float tensor.
+        Padding frames are certain blanks, which leave CTC decoding
+        unchanged."""
+        rows = [self[id] for id in ids]
+        max_frames = max((len(r) for r in rows), default=0)
+        out = torch.full((len(rows), max_frames, self.num_classes), PRUNED_LOG_PROB)
+        out[:, :, blank_idx] = 0
+        for i, r in enumerate(rows):
+            out[i, : len(r)] = torch.from_numpy(r)
+        return out
+
+
+class EmissionStoreWriter(object):
+    """Appends the emissions of finished batches to a new shard in *path*.
+
+    Each shard is a ``.bin`` file of float16 frames (or, with *topk*, the
+    *topk* best log-probs of each frame and their classes) and an ``.index``
+    file of (id, offset, frames) records, appended after the frames they
+    point to are written. Only the valid frames of every utterance are
+    stored. Shards are named after *prefix* and a counter, so writers with
+    different prefixes (e.g. one per --shard-id) and resumed runs never
+    write to the same files; a shard is closed after *max_shard_mb*.
+    """
+
+    def __init__(self, path, num_classes, topk=0, prefix="shard0", max_shard_mb=1024):
+        self.path = path
+        self.num_classes = num_classes
+        self.topk = topk
+        self.prefix = prefix
+        self.max_shard_bytes = max_shard_mb << 20
+        self.frame_dtype = _frame_dtype(num_classes, topk)
+
+        os.makedirs(path, exist_ok=True)
+        meta = {"num_classes": num_classes, "topk": topk}
+        if os.path.exists(os.path.join(path, "meta.json")):
+            assert _read_meta(path) == meta, (
+                f"{path} holds emissions with {_read_meta(path)}, "
+                f"cannot append emissions with {meta}"
+            )
+        else:
+            with open(os.path.join(path, "meta.json"), "w") as f:
+                json.dump(meta, f)
+
+        existing = glob.glob(os.path.join(path, f"{prefix}.*.index"))
+        self.next_shard = max((_shard_key(f)[1] + 1 for f in existing), default=0)
+        self.bin_file = None
+        self.index_file = None
+        self.num_utterances = 0
+
+    def _open_shard(self):
+        self.close()
+        name = os.path.join(self.path, f"{self.prefix}.{self.next_shard}")
+        self.next_shard += 1
+        self.bin_file = open(name + ".bin", "wb")
+        self.index_file = open(name + ".index", "wb")
+        self.offset = 0
+
+    def add(self, ids, emissions, lengths=None):
+        """Stores the first *lengths* frames of each row of the `(B, T, C)`
+        log-probs *emissions* under *ids*. The conversion to float16 (and
+        the top-k selection) happens on the emissions' device."""
+        bsz, tsz, _ = emissions.shape
+        if bsz == 0:
+            return
+        if lengths is None:
+            lengths = torch.full((bsz,), tsz, dtype=torch.long)
+        lengths = lengths.to(emissions.device)
+        valid = torch.arange(tsz, device=emissions.device) < lengths.unsqueeze(1)
+        frames = emissions[valid]
+        if self.topk > 0:
+            values, classes = frames.topk(self.topk, dim=-1)
+            records = np.empty(len(frames), dtype=self.frame_dtype)
+            records["values"] = values.half().cpu().numpy()
+            records["classes"] = classes.short().cpu().numpy()
+        else:
+            records = frames.half().cpu().numpy()
+
+        if self.bin_file is None or self.offset >= self.max_shard_bytes:
+            self._open_shard()
+        lengths = lengths.tolist()
+        index = np.empty(bsz, dtype=INDEX_DTYPE)
+        index["id"] = torch.as_tensor(ids).tolist()
+        index["frames"] = lengths
+        index["offset"] = np.cumsum([0] + lengths[:-1]) + (
+            self.offset // self.frame_dtype.itemsize
+        )
+        self.bin_file.write(records.tobytes())
+        self.bin_file.flush()
+        self.index_file.write(index.tobytes())
+        self.index_file.flush()
+        self.offset += records.nbytes
+        self.num_utterances += bsz
+
+    def close(self):
+        if self.bin_file is not None:
+            self.bin_file.close()
+            self.index_file.close()
+            self.bin_file = None
+            self.index_file = None
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Build-once lexicon tries for the flashlight KenLM decoders.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def lexicon_fingerprint(lexicon, lm_path, tgt_dict, silence):
+    """Hash of everything the trie is built from: the lexicon content, the
+    LM file (path, size and modification time, hashing a multi-GB LM would
+    defeat the purpose), the target dictionary and the silence token."""
+    h = hashlib.md5()
+    with open(lexicon, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    stat = os.stat(lm_path)
+    h.update(f"{os.path.abspath(lm_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    h.update("\n".join(tgt_dict.symbols).encode())
+    h.update(f"{silence}:{LexiconTrieCache.VERSION}".encode())
+    return h.hexdigest()
+
+
+class LexiconTrieCache(object):
+    """Array-backed form of a lexicon trie with its precomputed unigram
+    scores, stored in *cache_dir* under a fingerprint of the lexicon, the LM
+    and the target dictionary (see :func:`lexicon_fingerprint`).
+
+    The spellings of all lexicon entries, already mapped to target
+    dictionary indices, are concatenated into one array with an offset
+    index; each spelling has the index of its word and the LM score of the
+    word from the start state. The words are stored in word dictionary
+    order. Arrays are memory-mapped on load.
+    """
+
+    VERSION = 1
+
+    def __init__(self, cache_dir, fingerprint):
+        self.path = os.path.join(cache_dir, fingerprint)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def exists(self):
+        return os.path.exists(self._file("meta.json"))
+
+    def load(self):
+        with open(self._file("meta.json")) as f:
+            meta = json.load(f)
+        with open(self._file("words.txt"), encoding="utf-8") as f:
+            words = f.read().split("\n")[: meta["num_words"]]
+        arrays = {
+            name: np.load(self._file(f"{name}.npy"), mmap_mode="r")
+            for name in ["spellings", "offsets", "word_idxs", "scores"]
+        }
+        return words, meta["unk_word"], arrays
+
+    def save(self, words, unk_word, spellings, word_idxs, scores):
+        """Writes the cache atomically, so concurrent builders (e.g. one per
+        data-parallel worker) are safe; the last one wins."""
+        offsets = np.zeros(len(spellings) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in spellings], out=offsets[1:])
+        arrays = {
+            "spellings": np.fromiter(
+                (i for s in spellings for i in s), dtype=np.int32, count=offsets[-1]
+            ),
+            "offsets": offsets,
+            "word_idxs": np.asarray(word_idxs, dtype=np.int32),
+            "scores": np.asarray(scores, dtype=np.float32),
+        }
+
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+        with open(os.path.join(tmp_path, "words.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(words))
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"num_words": len(words), "unk_word": unk_word}, f)
+        try:
+            os.replace(tmp_path, self.path)
+        except OSError:
+            # another process created it first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        logger.info(f"saved lexicon trie to {self.path}")
+
+
+def build_lexicon_trie(lexicon, lm_path, tgt_dict, silence, cache_dir=None):
+    """Loads *lexicon* and the KenLM model at *lm_path* and builds the
+    smeared lexicon trie over *tgt_dict*.
+
+    With *cache_dir*, the spellings and unigram scores are read from a
+    :class:`LexiconTrieCache` instead of parsing the lexicon, mapping every
+    spelling and scoring every word with the LM; the cache is created on
+    the first call.
+
+    Returns:
+        tuple: (word dictionary, index of "<unk>" in it, KenLM, Trie)
+    """
+    from flashlight.lib.text.decoder import KenLM, SmearingMode, Trie
+    from flashlight.lib.text.dictionary import Dictionary as flDictionary
+    from flashlight.lib.text.dictionary import create_word_dict, load_words
+
+    cache = None
+    if cache_dir is not None:
+        cache = LexiconTrieCache(
+            cache_dir, lexicon_fingerprint(lexicon, lm_path, tgt_dict, silence)
+        )
+
+    trie = Trie(len(tgt_dict), silence)
+    if cache is not None and cache.exists():
+        words, unk_word, arrays = cache.load()
+        word_dict = flDictionary()
+        for word in words:
+            word_dict.add_entry(word)
+        word_dict.set_default_index(unk_word)
+        lm = KenLM(lm_path, word_dict)
+
+        spellings, offsets = arrays["spellings"], arrays["offsets"]
+        for i, (word_idx, score) in enumerate(
+            zip(arrays["word_idxs"].tolist(), arrays["scores"].tolist())
+        ):
+            trie.insert(
+                spellings[offsets[i] : offsets[i + 1]].tolist(), word_idx, score
+            )
+    else:
+        lexicon = load_words(lexicon)
+        word_dict = create_word_dict(lexicon)
+        unk_word = word_dict.get_index("<unk>")
+        lm = KenLM(lm_path, word_dict)
+
+        all_spellings, word_idxs, scores = [], [], []
+        start_state = lm.start(False)
+        for word, spellings in lexicon.items():
+            word_idx = word_dict.get_index(word)
+            _, score = lm.score(start_state, word_idx)
+            for spelling in spellings:
+                spelling_idxs = [tgt_dict.index(token) for token in spelling]
+                assert (
+                    tgt_dict.unk() not in spelling_idxs
+                ), f"{word} {spelling} {spelling_idxs}"
+                trie.insert(spelling_idxs, word_idx, score)
+                all_spellings.append(spelling_idxs)
+                word_idxs.append(word_idx)
+                scores.append(score)
+
+        if cache is not None:
+            words = [word_dict.get_entry(i) for i in range(word_dict.index_size())]
+            cache.save(words, unk_word, all_spellings, word_idxs, scores)
+    trie.smear(SmearingMode.MAX)
+    return word_dict, unk_word, lm, trie
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Batched neural LM scoring for the flashlight FairseqLM decoders.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class BatchedLMScorer(object):
+    """Next-word log-probabilities of a fairseq language model for word
+    prefixes, computed in padded batches and kept in an LRU cache.
+
+    The distributions live in up to ``capacity`` rows (pinned when the model
+    is on the GPU), allocated in blocks as the cache fills; a prefix owns one
+    row until it is evicted, least recently used first. The cache is keyed by
+    the prefix itself, so it is shared by all the utterances decoded with the
+    scorer.
+
+    Prefixes the decoder is likely to score next are registered with
+    :func:`prefetch`. On a cache miss, the missing prefix is scored together
+    with up to ``max_batch - 1`` of the most recently prefetched ones in a
+    single right-padded forward; only the hidden state of the last token of
+    each prefix goes through the output layer.
+
+    Args:
+        model (FairseqLanguageModel): the language model, already on its
+            device and in eval mode
+        dictionary (~fairseq.data.Dictionary): the model's dictionary
+        capacity (int, optional): number of prefixes to keep (default: as
+            many as fit into *max_cache_mb*, at most 20,000)
+        max_batch (int, optional): prefixes per forward (default: 64 on the
+            GPU, where a forward costs about the same for one prefix as for
+            64; 1 on the CPU, where speculative scoring does not pay off)
+        max_cache_mb (int, optional): max size of the cache when *capacity*
+            is not given (default: 256)
+    """
+
+    # rows are allocated in blocks of about this many bytes
+    BLOCK_BYTES = 16 << 20
+
+    def __init__(
+        self, model, dictionary, capacity=None, max_batch=None, max_cache_mb=256
+    ):
+        self.model = model
+        self.pad = dictionary.pad()
+        self.device = next(model.parameters()).device
+        self.vocab_size = len(dictionary)
+        if max_batch is None:
+            max_batch = 64 if self.device.type == "cuda" else 1
+
+        if capacity is None:
+            capacity = min(20_000, (max_cache_mb << 20) // (4 * self.vocab_size))
+        assert capacity >= max_batch > 0, "the cache must hold a full batch"
+        self.capacity = capacity
+        self.max_batch = max_batch
+
+        row_bytes = 4 * self.vocab_size
+        self.block_rows = min(capacity, max(max_batch, self.BLOCK_BYTES // row_bytes))
+        self.blocks = []
+        self.slots = OrderedDict()
+        self.free_slots = list(range(capacity - 1, -1, -1))
+        self.pending = OrderedDict()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.forwards = 0
+        self.scored_prefixes = 0
+        self.scored_tokens = 0
+        self.forward_time = 0.0
+
+    @property
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "requests": requests,
+            "hit_rate": self.hits / requests if requests > 0 else 0.0,
+            "misses": self.misses,
+            "forwards": self.forwards,
+            "prefixes_per_forward": (
+                self.scored_prefixes / self.forwards if self.forwards > 0 else 0.0
+            ),
+            "tokens_per_sec": (
+                self.scored_tokens / self.forward_time if self.forward_time > 0 else 0.0
+            ),
+        }
+
+    def log_stats(self):
+        stats = self.stats
+        logger.info(
+            "LM scoring: {requests} requests, {hit_rate:.1%} cache hits, "
+            "{misses} misses, {forwards} forwards with {prefixes_per_forward:.1f} "
+            "prefixes each, {tokens_per_sec:.0f} tokens/s".format(**stats)
+        )
+
+    def prefetch(self, prefix):
+        """Registers *prefix* (a tuple of word indices) to be scored along
+        with the next cache miss."""
+        if prefix not in self.slots:
+            self.pending[prefix] = None
+            self.pending.move_to_end(prefix)
+            # only the newest ones are ever batched
+            if len(self.pending) > 4 * self.max_batch:
+                self.pending.popitem(last=False)
+
+    def clear_pending(self):
+        self.pending.clear()
+
+    def score(self, prefix, token):
+        """Log-probability of *token* following *prefix*."""
+        slot = self.slots.get(prefix)
+        if slot is None:
+            self.misses += 1
+            slot = self._score_batch(prefix)
+        else:
+            self.hits += 1
+            self.slots.move_to_end(prefix)
+        block, row = divmod(slot, self.block_rows)
+        return float(self.blocks[block][row, token])
+
+    def _allocate(self, prefix):
+        if self.free_slots:
+            # free slots are handed out in order, a new block is needed when
+            # the last one is full
+            slot = self.free_slots.pop()
+            if slot == len(self.blocks) * self.block_rows:
+                rows = min(self.block_rows, self.capacity - slot)
+                block = torch.empty(
+                    (rows, self.vocab_size),
+                    dtype=torch.float32,
+                    pin_memory=self.device.type == "cuda",
+                )
+                self.blocks.append(block.numpy())
+        else:
+            _, slot = self.slots.popitem(last=False)
+        self.slots[prefix] = slot
+        return slot
+
+    def _score_batch(self, prefix):
+        self.pending.pop(prefix, None)
+        batch = [prefix]
+        while self.pending and len(batch) < self.max_batch:
+            other, _ = self.pending.popitem()
+            if other not in self.slots:
+                batch.append(other)
+
+        start = time.perf_counter()
+        lengths = torch.tensor([len(p) for p in batch])
+        tokens = torch.full((len(batch), int(lengths.max())), self.pad)
+        for i, p in enumerate(batch):
+            tokens[i, : len(p)] = torch.tensor(p)
+        tokens = tokens.to(self.device)
+        with torch.no_grad():
+            features, extra = self.model.extract_features(tokens, encoder_out=None)
+            features = features[torch.arange(len(batch)), lengths.to(self.device) - 1]
+            logits = self.model.output_layer(features.unsqueeze(1))
+            lprobs = self.model.get_normalized_probs(
+                (logits, extra), log_probs=True, sample=None
+            )
+        lprobs = lprobs[:, 0].float().cpu().numpy()
+
+        slots = [self._allocate(p) for p in batch]
+        for slot, slot_lprobs in zip(slots, lprobs):
+            block, row = divmod(slot, self.block_rows)
+            self.blocks[block][row] = slot_lprobs
+        self.forward_time += time.perf_counter() - start
+        self.forwards += 1
+        self.scored_prefixes += len(batch)
+        self.scored_tokens += int(lengths.sum())
+        return int(slots[0])
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Long-form transcription with wav2vec 2.0 CTC models, used by infer.py
+--long-form-window. The encoder attends over whole utterances, so its time
+and memory grow quadratically with their length; instead, utterances are
+split into overlapping windows, the windows of all utterances of a batch are
+encoded together, and the emissions of consecutive windows are merged over
+their overlap before decoding.
+"""
+
+import torch
+from examples.speech_recognition.w2l_decoder import W2lGreedyDecoder
+
+
+def feature_stride(w2v_model):
+    """Number of samples per frame of the convolutional feature extractor of
+    a :class:`~fairseq.models.wav2vec.Wav2Vec2Model`."""
+    stride = 1
+    for _, _, s in eval(w2v_model.cfg.conv_feature_layers):
+        stride *= s
+    return stride
+
+
+def window_spans(num_samples, window, hop, stride):
+    """(start, end) samples of windows of at most *window* samples, *hop*
+    samples apart, covering ``[0, num_samples)``.
+
+    Starts are multiples of *stride*, so that frame ``t`` of a window starting
+    at sample ``s`` is frame ``s // stride + t`` of the whole utterance. The
+    last window is moved back to end at *num_samples*, so that it is (almost)
+    as long as the others and adds (almost) no padding to their batch.
+    """
+    assert hop > 0 and hop % stride == 0, (hop, stride)
+    if num_samples <= window:
+        return [(0, num_samples)]
+    spans = []
+    start = 0
+    while start + window < num_samples:
+        spans.append((start, start + window))
+        start += hop
+    last = -(-(num_samples - window) // stride) * stride
+    spans.append((last, num_samples))
+    return spans
+
+
+def stitch_emissions(emissions, offsets, num_frames):
+    """Merges the ``(T_i, C)`` emissions of overlapping windows into the
+    ``(num_frames, C)`` emissions of an utterance, the i-th window starting
+    at frame ``offsets[i]``.
+
+    In an overlap, the emissions of the windows are averaged with weights
+    proportional to the distance of the frame to the edge of each window,
+    i.e. cross-faded linearly from one window to the next, so that every
+    frame mostly comes from the window which saw most context around it.
+    """
+    if len(emissions) == 1:
+        assert offsets[0] == 0 and len(emissions[0]) == num_frames
+        return emissions[0]
+    out = emissions[0].new_zeros(num_frames, emissions[0].size(-1))
+    total = out.new_zeros(num_frames, 1)
+    for e, offset in zip(emissions, offsets):
+        end = offset + len(e)
+        assert end <= num_frames, (offset, len(e), num_frames)
+        t = torch.arange(len(e), device=e.device, dtype=out.dtype) + 0.5
+        # the edges of the utterance are not edges of a window's context
+        far = torch.full_like(t, num_frames)
+        left = t if offset > 0 else far
+        right = len(e) - t if end < num_frames else far
+        weight = torch.min(left, right).unsqueeze(-1)
+        out[offset:end] += weight * e
+        total[offset:end] += weight
+    assert (total > 0).all(), "the windows do not cover the utterance"
+    return out / total
+
+
+class LongFormDecoder(object):
+    """Decodes the utterances of a batch with *decoder* from emissions
+    computed on overlapping windows of *window* samples.
+
+    Consecutive windows overlap by about *overlap* samples (rounded to whole
+    encoder frames) and at most *max_windows* windows, from any utterances of
+    the batch, are encoded at once. The merged emissions have as many frames
+    as those of the whole utterances, so any decoder of
+    :mod:`examples.speech_recognition.w2l_decoder` can search them.
+    """
+
+    def __init__(self, decoder, window, overlap, max_windows=16):
+        assert 0 <= overlap < window, (overlap, window)
+        self.decoder = decoder
+        self.window = window
+        self.overlap = overlap
+        self.max_windows = max_windows
+
+    def get_emissions(self, models, sample):
+        """Emissions ``(B, T, C)`` of the utterances of *sample* and their
+        numbers of frames. Padding frames are certain blanks."""
+        model = models[0]
+        w2v_model = model.w2v_encoder.w2v_model
+        stride = feature_stride(w2v_model)
+
+        def output_lengths(lengths):
+            return w2v_model._get_feat_extract_output_lengths(
+                torch.as_tensor(lengths, dtype=torch.long)
+            ).tolist()
+
+        hop = (output_lengths(self.window) - self.overlap // stride) * stride
+        assert hop > 0, "--long-form-overlap must be shorter than the window"
+
+        source = sample["net_input"]["source"]
+        padding_mask = sample["net_input"].get("padding_mask", None)
+        if padding_mask is None:
+            lengths = [source.size(1)] * source.size(0)
+        else:
+            lengths = (~padding_mask).long().sum(-1).tolist()
+        windows = [
+            (i, start, end)
+            for i, n in enumerate(lengths)
+            for start, end in window_spans(n, self.window, hop, stride)
+        ]
+
+        # longest first, so that windows of similar lengths are batched
+        order = sorted(range(len(windows)), key=lambda j: windows[j][1] - windows[j][2])
+        chunks = [None] * len(windows)
+        for b in range(0, len(order), self.max_windows):
+            batch = order[b : b + self.max_windows]
+            sizes = [windows[j][2] - windows[j][1] for j in batch]
+            x = source.new_zeros(len(batch), max(sizes))
+            mask = torch.ones(x.shape, dtype=torch.bool, device=x.device)
+            for k, j in enumerate(batch):
+                i, start, end = windows[j]
+                x[k, : end - start] = source[i, start:end]
+                mask[k, : end - start] = False
+
+            encoder_out = model(source=x, padding_mask=mask)
+            if hasattr(model, "get_logits"):
+                emissions = model.get_logits(encoder_out)
+            else:
+                emissions = model.get_normalized_probs(encoder_out, log_probs=True)
+            emissions = emissions.transpose(0, 1).float()
+            for k, (j, frames) in enumerate(zip(batch, output_lengths(sizes))):
+                chunks[j] = emissions[k, :frames]
+
+        num_frames = output_lengths(lengths)
+        merged = [[] for _ in lengths]
+        for (i, start, _), chunk in zip(windows, chunks):
+            merged[i].append((chunk, start // stride))
+        merged = [
+            stitch_emissions([c for c, _ in m], [o for _, o in m], n)
+            for m, n in zip(merged, num_frames)
+        ]
+
+        out = merged[0].new_full(
+            (len(merged), max(num_frames), merged[0].size(-1)), float("-inf")
+        )
+        out[:, :, self.decoder.blank] = 0
+        for i, m in enumerate(merged):
+            out[i, : len(m)] = m
+        return out.cpu().contiguous(), torch.LongTensor(num_frames)
+
+    def generate(self, models, sample, **unused):
+        emissions, lengths = self.get_emissions(models, sample)
+        if isinstance(self.decoder, W2lGreedyDecoder):
+            return self.decoder.decode(emissions, lengths)
+        return self.decoder.decode(emissions)
+
+    def generate_async(self, models, sample, **unused):
+        emissions, _ = self.get_emissions(models, sample)
+        return self.decoder.decode_async(emissions)
+
+    def close(self):
+        if hasattr(self.decoder, "close"):
+            self.decoder.close()
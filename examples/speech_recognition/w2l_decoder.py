@@ -9,18 +9,19 @@
 Flashlight decoders.
 """
 
-import gc
+import copy
 import itertools as it
 import os.path as osp
 from typing import List
 import warnings
-from collections import deque, namedtuple
 
-import numpy as np
 import torch
+import torch.multiprocessing as mp
 from examples.speech_recognition.data.replabels import unpack_replabels
+from examples.speech_recognition.utils.lexicon_trie import build_lexicon_trie
+from examples.speech_recognition.utils.lm_scoring import BatchedLMScorer
 from fairseq import tasks
-from fairseq.utils import apply_to_sample
+from fairseq.data.data_utils import ctc_greedy_decode
 from omegaconf import open_dict
 from fairseq.dataclass.utils import convert_namespace_to_omegaconf
 
@@ -77,6 +78,23 @@ class W2lDecoder(object):
         emissions = self.get_emissions(models, encoder_input)
         return self.decode(emissions)
 
+    def generate_async(self, models, sample, **unused):
+        """Like :func:`generate`, but returns a handle whose ``get()`` returns
+        the hypotheses. Decoders that search in worker processes return
+        before the search is done, so that the emissions of the next batch
+        can be computed meanwhile."""
+        encoder_input = {
+            k: v for k, v in sample["net_input"].items() if k != "prev_output_tokens"
+        }
+        emissions = self.get_emissions(models, encoder_input)
+        return self.decode_async(emissions)
+
+    def decode_async(self, emissions):
+        return DecodedBatch(self.decode(emissions))
+
+    def close(self):
+        pass
+
     def get_emissions(self, models, encoder_input):
         """Run encoder and normalize emissions"""
         model = models[0]
@@ -94,6 +112,39 @@ class W2lDecoder(object):
         return torch.LongTensor(list(idxs))
 
 
+class DecodedBatch(object):
+    """The hypotheses of a batch, or a handle to them if *results* are
+    pending :class:`multiprocessing.pool.AsyncResult`'s whose values are
+    converted with *postprocess*."""
+
+    def __init__(self, results, postprocess=None):
+        self.results = results
+        self.postprocess = postprocess
+
+    def get(self):
+        if self.postprocess is None:
+            return self.results
+        return [self.postprocess(r.get()) for r in self.results]
+
+
+# decoder of a worker process, see W2lKenLMDecoder.decode_async
+_worker_decoder = None
+
+
+def _init_decode_worker(decoder=None, args=None, tgt_dict=None):
+    global _worker_decoder
+    if decoder is not None:
+        # inherited through fork: the trie and KenLM built by the parent are
+        # shared copy-on-write
+        _worker_decoder = decoder
+    else:
+        _worker_decoder = W2lKenLMDecoder(args, tgt_dict)
+
+
+def _decode_worker(emissions, b):
+    return _worker_decoder.search(emissions, b)
+
+
 class W2lViterbiDecoder(W2lDecoder):
     def __init__(self, args, tgt_dict):
         super().__init__(args, tgt_dict)
@@ -122,42 +173,79 @@ class W2lViterbiDecoder(W2lDecoder):
         ]
 
 
+class W2lGreedyDecoder(W2lDecoder):
+    """Best-path CTC decoding of the whole batch on the model's device. For
+    CTC (no transitions) this gives the same paths as
+    :class:`W2lViterbiDecoder` without flashlight or copying the emissions
+    to the CPU; padded frames are ignored."""
+
+    def __init__(self, args, tgt_dict):
+        # not calling W2lDecoder.__init__, which needs flashlight
+        self.tgt_dict = tgt_dict
+        self.vocab_size = len(tgt_dict)
+        self.nbest = 1
+        self.blank = (
+            tgt_dict.index("<ctc_blank>")
+            if "<ctc_blank>" in tgt_dict.indices
+            else tgt_dict.bos()
+        )
+
+    def generate(self, models, sample, **unused):
+        encoder_input = {
+            k: v for k, v in sample["net_input"].items() if k != "prev_output_tokens"
+        }
+        model = models[0]
+        encoder_out = model(**encoder_input)
+        if hasattr(model, "get_logits"):
+            emissions = model.get_logits(encoder_out)
+        else:
+            emissions = model.get_normalized_probs(encoder_out, log_probs=True)
+        input_lengths = None
+        if encoder_out.get("padding_mask", None) is not None:
+            input_lengths = (~encoder_out["padding_mask"]).long().sum(-1)
+        return self.decode(emissions.transpose(0, 1), input_lengths)
+
+    def decode(self, emissions, input_lengths=None):
+        tokens, lengths, timesteps, scores = ctc_greedy_decode(
+            emissions,
+            input_lengths,
+            blank_idx=self.blank,
+            pad_idx=self.tgt_dict.pad(),
+        )
+        tokens, lengths = tokens.cpu(), lengths.tolist()
+        timesteps, scores = timesteps.cpu(), scores.tolist()
+        return [
+            [
+                {
+                    "tokens": tokens[b, : lengths[b]],
+                    "score": scores[b],
+                    "timesteps": timesteps[b, : lengths[b]].tolist(),
+                }
+            ]
+            for b in range(len(lengths))
+        ]
+
+
 class W2lKenLMDecoder(W2lDecoder):
     def __init__(self, args, tgt_dict):
         super().__init__(args, tgt_dict)
 
         self.unit_lm = getattr(args, "unit_lm", False)
 
-        if args.lexicon:
-            self.lexicon = load_words(args.lexicon)
-            self.word_dict = create_word_dict(self.lexicon)
-            self.unk_word = self.word_dict.get_index("<unk>")
+        # beam search in a pool of worker processes, see decode_async
+        self.num_workers = getattr(args, "decoder_workers", 0)
+        self.pool = None
+        if self.num_workers > 0:
+            self.worker_args = copy.copy(args)
+            self.worker_args.decoder_workers = 0
 
-            self.lm = KenLM(args.kenlm_model, self.word_dict)
-            self.trie = Trie(self.vocab_size, self.silence)
-
-            start_state = self.lm.start(False)
-            for i, (word, spellings) in enumerate(self.lexicon.items()):
-                word_idx = self.word_dict.get_index(word)
-                _, score = self.lm.score(start_state, word_idx)
-                for spelling in spellings:
-                    spelling_idxs = [tgt_dict.index(token) for token in spelling]
-                    assert (
-                        tgt_dict.unk() not in spelling_idxs
-                    ), f"{spelling} {spelling_idxs}"
-                    self.trie.insert(spelling_idxs, word_idx, score)
-            self.trie.smear(SmearingMode.MAX)
-
-            self.decoder_opts = LexiconDecoderOptions(
-                beam_size=args.beam,
-                beam_size_token=int(getattr(args, "beam_size_token", len(tgt_dict))),
-                beam_threshold=args.beam_threshold,
-                lm_weight=args.lm_weight,
-                word_score=args.word_score,
-                unk_score=args.unk_weight,
-                sil_score=args.sil_weight,
-                log_add=False,
-                criterion_type=self.criterion_type,
+        if args.lexicon:
+            self.word_dict, self.unk_word, self.lm, self.trie = build_lexicon_trie(
+                args.lexicon,
+                args.kenlm_model,
+                tgt_dict,
+                self.silence,
+                cache_dir=getattr(args, "trie_cache_dir", None),
             )
 
             if self.asg_transitions is None:
@@ -165,35 +253,68 @@ class W2lKenLMDecoder(W2lDecoder):
                 # self.asg_transitions = torch.FloatTensor(N, N).zero_()
                 self.asg_transitions = []
 
-            self.decoder = LexiconDecoder(
-                self.decoder_opts,
-                self.trie,
-                self.lm,
-                self.silence,
-                self.blank,
-                self.unk_word,
-                self.asg_transitions,
-                self.unit_lm,
-            )
+            self.unk_weight = args.unk_weight
         else:
             assert args.unit_lm, "lexicon free decoding can only be done with a unit language model"
-            from flashlight.lib.text.decoder import LexiconFreeDecoder, LexiconFreeDecoderOptions
 
             d = {w: [[w]] for w in tgt_dict.symbols}
             self.word_dict = create_word_dict(d)
             self.lm = KenLM(args.kenlm_model, self.word_dict)
+            self.trie = None
+
+        self.beam_size_token = int(getattr(args, "beam_size_token", len(tgt_dict)))
+        self.beam_threshold = args.beam_threshold
+        self.search_params = {}
+        self.set_search_params(
+            beam=args.beam,
+            lm_weight=args.lm_weight,
+            word_score=args.word_score,
+            sil_weight=args.sil_weight,
+        )
+
+    def set_search_params(self, **params):
+        """Rebuilds the beam search with updated *params* (``beam``,
+        ``lm_weight``, ``word_score``, ``sil_weight``), reusing the trie and
+        the KenLM. Lexicon free decoding has no word score. Does not affect
+        worker processes already started by :func:`decode_async`."""
+        self.search_params.update(params)
+        if self.trie is None:
+            from flashlight.lib.text.decoder import LexiconFreeDecoder, LexiconFreeDecoderOptions
+
             self.decoder_opts = LexiconFreeDecoderOptions(
-                beam_size=args.beam,
-                beam_size_token=int(getattr(args, "beam_size_token", len(tgt_dict))),
-                beam_threshold=args.beam_threshold,
-                lm_weight=args.lm_weight,
-                sil_score=args.sil_weight,
+                beam_size=self.search_params["beam"],
+                beam_size_token=self.beam_size_token,
+                beam_threshold=self.beam_threshold,
+                lm_weight=self.search_params["lm_weight"],
+                sil_score=self.search_params["sil_weight"],
                 log_add=False,
                 criterion_type=self.criterion_type,
             )
             self.decoder = LexiconFreeDecoder(
                 self.decoder_opts, self.lm, self.silence, self.blank, []
             )
+            return
+        self.decoder_opts = LexiconDecoderOptions(
+            beam_size=self.search_params["beam"],
+            beam_size_token=self.beam_size_token,
+            beam_threshold=self.beam_threshold,
+            lm_weight=self.search_params["lm_weight"],
+            word_score=self.search_params["word_score"],
+            unk_score=self.unk_weight,
+            sil_score=self.search_params["sil_weight"],
+            log_add=False,
+            criterion_type=self.criterion_type,
+        )
+        self.decoder = LexiconDecoder(
+            self.decoder_opts,
+            self.trie,
+            self.lm,
+            self.silence,
+            self.blank,
+            self.unk_word,
+            self.asg_transitions,
+            self.unit_lm,
+        )
 
     def get_timesteps(self, token_idxs: List[int]) -> List[int]:
         """Returns frame numbers corresponding to every non-blank token.
@@ -216,65 +337,90 @@ class W2lKenLMDecoder(W2lDecoder):
                 timesteps.append(i)
         return timesteps
 
+    def search(self, emissions, b):
+        """Beam search over the emissions of the *b*-th utterance; returns the
+        n-best ``(tokens, score, words)``."""
+        B, T, N = emissions.size()
+        emissions_ptr = emissions.data_ptr() + 4 * b * emissions.stride(0)
+        results = self.decoder.decode(emissions_ptr, T, N)
+        return [
+            (list(result.tokens), result.score, list(result.words))
+            for result in results[: self.nbest]
+        ]
+
+    def make_hypos(self, nbest_results):
+        return [
+            {
+                "tokens": self.get_tokens(tokens),
+                "score": score,
+                "timesteps": self.get_timesteps(tokens),
+                "words": [self.word_dict.get_entry(x) for x in words if x >= 0],
+            }
+            for tokens, score, words in nbest_results
+        ]
+
     def decode(self, emissions):
+        if self.num_workers > 0:
+            return self.decode_async(emissions).get()
         B, T, N = emissions.size()
         hypos = []
         for b in range(B):
-            emissions_ptr = emissions.data_ptr() + 4 * b * emissions.stride(0)
-            results = self.decoder.decode(emissions_ptr, T, N)
-
-            nbest_results = results[: self.nbest]
-            hypos.append(
-                [
-                    {
-                        "tokens": self.get_tokens(result.tokens),
-                        "score": result.score,
-                        "timesteps": self.get_timesteps(result.tokens),
-                        "words": [
-                            self.word_dict.get_entry(x) for x in result.words if x >= 0
-                        ],
-                    }
-                    for result in nbest_results
-                ]
-            )
+            hypos.append(self.make_hypos(self.search(emissions, b)))
         return hypos
 
+    def get_pool(self):
+        if self.pool is None:
+            if "fork" in mp.get_all_start_methods():
+                ctx = mp.get_context("fork")
+                initargs = (self,)
+            else:
+                # KenLM and the trie cannot be pickled, rebuild them per worker
+                ctx = mp.get_context("spawn")
+                initargs = (None, self.worker_args, self.tgt_dict)
+            self.pool = ctx.Pool(
+                self.num_workers, _init_decode_worker, initargs=initargs
+            )
+        return self.pool
+
+    def decode_async(self, emissions):
+        """Searches the utterances of the batch in parallel worker processes.
+        The emissions are moved to shared memory, so only a handle is sent to
+        the workers; the returned :class:`DecodedBatch` yields the hypotheses
+        in batch order."""
+        if self.num_workers <= 0:
+            return super().decode_async(emissions)
+        emissions = emissions.share_memory_()
+        pool = self.get_pool()
+        results = [
+            pool.apply_async(_decode_worker, (emissions, b))
+            for b in range(emissions.size(0))
+        ]
+        return DecodedBatch(results, self.make_hypos)
 
-FairseqLMState = namedtuple("FairseqLMState", ["prefix", "incremental_state", "probs"])
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
 
 class FairseqLM(LM):
-    def __init__(self, dictionary, model):
+    def __init__(self, dictionary, model, max_cache_mb=256):
         LM.__init__(self)
         self.dictionary = dictionary
         self.model = model
         self.unk = self.dictionary.unk()
 
-        self.save_incremental = False  # this currently does not work properly
-        self.max_cache = 20_000
-
         model.cuda()
         model.eval()
         model.make_generation_fast_()
 
+        self.scorer = BatchedLMScorer(model, dictionary, max_cache_mb=max_cache_mb)
         self.states = {}
-        self.stateq = deque()
 
     def start(self, start_with_nothing):
         state = LMState()
-        prefix = torch.LongTensor([[self.dictionary.eos()]])
-        incremental_state = {} if self.save_incremental else None
-        with torch.no_grad():
-            res = self.model(prefix.cuda(), incremental_state=incremental_state)
-            probs = self.model.get_normalized_probs(res, log_probs=True, sample=None)
-
-        if incremental_state is not None:
-            incremental_state = apply_to_sample(lambda x: x.cpu(), incremental_state)
-        self.states[state] = FairseqLMState(
-            prefix.numpy(), incremental_state, probs[0, -1].cpu().numpy()
-        )
-        self.stateq.append(state)
-
+        self.states[state] = (self.dictionary.eos(),)
         return state
 
     def score(self, state: LMState, token_index: int, no_cache: bool = False):
@@ -291,62 +437,14 @@ class FairseqLM(LM):
         --------
         (LMState, float): pair of (new state, score for the current word)
         """
-        curr_state = self.states[state]
-
-        def trim_cache(targ_size):
-            while len(self.stateq) > targ_size:
-                rem_k = self.stateq.popleft()
-                rem_st = self.states[rem_k]
-                rem_st = FairseqLMState(rem_st.prefix, None, None)
-                self.states[rem_k] = rem_st
-
-        if curr_state.probs is None:
-            new_incremental_state = (
-                curr_state.incremental_state.copy()
-                if curr_state.incremental_state is not None
-                else None
-            )
-            with torch.no_grad():
-                if new_incremental_state is not None:
-                    new_incremental_state = apply_to_sample(
-                        lambda x: x.cuda(), new_incremental_state
-                    )
-                elif self.save_incremental:
-                    new_incremental_state = {}
-
-                res = self.model(
-                    torch.from_numpy(curr_state.prefix).cuda(),
-                    incremental_state=new_incremental_state,
-                )
-                probs = self.model.get_normalized_probs(
-                    res, log_probs=True, sample=None
-                )
-
-                if new_incremental_state is not None:
-                    new_incremental_state = apply_to_sample(
-                        lambda x: x.cpu(), new_incremental_state
-                    )
-
-                curr_state = FairseqLMState(
-                    curr_state.prefix, new_incremental_state, probs[0, -1].cpu().numpy()
-                )
-
-            if not no_cache:
-                self.states[state] = curr_state
-                self.stateq.append(state)
-
-        score = curr_state.probs[token_index].item()
-
-        trim_cache(self.max_cache)
+        prefix = self.states[state]
+        score = self.scorer.score(prefix, token_index)
 
         outstate = state.child(token_index)
         if outstate not in self.states and not no_cache:
-            prefix = np.concatenate(
-                [curr_state.prefix, torch.LongTensor([[token_index]])], -1
-            )
-            incr_state = curr_state.incremental_state
-
-            self.states[outstate] = FairseqLMState(prefix, incr_state, None)
+            self.states[outstate] = prefix + (token_index,)
+            if token_index not in (self.unk, self.dictionary.eos()):
+                self.scorer.prefetch(self.states[outstate])
 
         if token_index == self.unk:
             score = float("-inf")
@@ -364,9 +462,9 @@ class FairseqLM(LM):
         return self.score(state, self.dictionary.eos())
 
     def empty_cache(self):
+        # the scorer's cache is keyed by word prefixes and stays valid
         self.states = {}
-        self.stateq = deque()
-        gc.collect()
+        self.scorer.clear_pending()
 
 
 class W2lFairseqLMDecoder(W2lDecoder):
@@ -396,7 +494,9 @@ class W2lFairseqLMDecoder(W2lDecoder):
 
         self.word_dict = task.dictionary
         self.unk_word = self.word_dict.unk()
-        self.lm = FairseqLM(self.word_dict, model)
+        self.lm = FairseqLM(
+            self.word_dict, model, max_cache_mb=getattr(args, "lm_cache_mb", 256)
+        )
 
         if self.lexicon:
             start_state = self.lm.start(False)
@@ -484,3 +584,7 @@ class W2lFairseqLMDecoder(W2lDecoder):
             self.lm.empty_cache()
 
         return hypos
+
+    def close(self):
+        if isinstance(self.lm, FairseqLM):
+            self.lm.scorer.log_stats()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Binarizes label files (e.g. train.ltr, dev_other.wrd) with the dictionary of
+their label type (dict.ltr.txt, dict.wrd.txt). audio_finetuning then reads
+the token ids from train.ltr.bin/.idx instead of encoding the text labels.
+"""
+
+import argparse
+import os
+
+from fairseq.data import Dictionary
+from fairseq.data.audio.binarized_labels import binarize_labels
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data", help="directory with the manifests and labels")
+    parser.add_argument("--splits", nargs="+", required=True)
+    parser.add_argument("--labels", default="ltr", help="label extension")
+    args = parser.parse_args()
+
+    dictionary = Dictionary.load(os.path.join(args.data, f"dict.{args.labels}.txt"))
+    for split in args.splits:
+        label_path = os.path.join(args.data, f"{split}.{args.labels}")
+        num_labels = binarize_labels(label_path, dictionary)
+        print(f"binarized {num_labels} labels of {label_path}")
+
+
+if __name__ == "__main__":
+    main()
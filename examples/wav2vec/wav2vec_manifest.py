@@ -11,6 +11,7 @@ import argparse
 import glob
 import os
 import random
+from multiprocessing import Pool
 
 import soundfile
 
@@ -41,9 +42,58 @@ def get_parser():
         metavar="FRAG",
         help="if set, path must contain this substring for a file to be included in the manifest",
     )
+    parser.add_argument(
+        "--workers",
+        default=os.cpu_count(),
+        type=int,
+        metavar="N",
+        help="number of processes reading audio headers",
+    )
+    parser.add_argument(
+        "--metadata-cache",
+        default=None,
+        type=str,
+        metavar="FILE",
+        help="if set, audio metadata is cached in this file and only read again "
+        "for new or modified files; can be shared by the manifests of all subsets",
+    )
     return parser
 
 
+def load_metadata_cache(path):
+    """Maps file paths to (mtime_ns, frames, sample_rate). The cache is a tsv
+    file that is only appended to; later lines win."""
+    cache = {}
+    if path is not None and os.path.exists(path):
+        with open(path, "r") as f:
+            for line in f:
+                items = line.rstrip("\n").split("\t")
+                if len(items) == 4:
+                    cache[items[0]] = tuple(int(x) for x in items[1:])
+    return cache
+
+
+def read_metadata(file_path):
+    info = soundfile.info(file_path)
+    return os.stat(file_path).st_mtime_ns, info.frames, info.samplerate
+
+
+def update_metadata_cache(file_paths, cache, workers):
+    """Reads the audio headers of the files missing from *cache* (or
+    modified since) in *workers* processes and returns the new entries."""
+    todo = [
+        p for p in file_paths if p not in cache or cache[p][0] != os.stat(p).st_mtime_ns
+    ]
+    if workers > 1 and len(todo) > 1:
+        with Pool(workers) as pool:
+            probed = pool.map(read_metadata, todo, chunksize=64)
+    else:
+        probed = [read_metadata(p) for p in todo]
+    new_entries = dict(zip(todo, probed))
+    cache.update(new_entries)
+    return new_entries
+
+
 def main(args):
     assert args.valid_percent >= 0 and args.valid_percent <= 1.0
 
@@ -54,6 +104,25 @@ def main(args):
     search_path = os.path.join(dir_path, "**/*." + args.ext)
     rand = random.Random(args.seed)
 
+    file_paths = []
+    for fname in glob.iglob(search_path, recursive=True):
+        file_path = os.path.realpath(fname)
+
+        if args.path_must_contain and args.path_must_contain not in file_path:
+            continue
+        file_paths.append(file_path)
+
+    cache = load_metadata_cache(args.metadata_cache)
+    new_entries = update_metadata_cache(file_paths, cache, args.workers)
+    if args.metadata_cache is not None and len(new_entries) > 0:
+        with open(args.metadata_cache, "a") as f:
+            for file_path, metadata in new_entries.items():
+                print(file_path, *metadata, sep="\t", file=f)
+    print(
+        f"read {len(new_entries)} audio headers, "
+        f"{len(file_paths) - len(new_entries)} from the metadata cache"
+    )
+
     valid_f = (
         open(os.path.join(args.dest, "valid.tsv"), "w")
         if args.valid_percent > 0
@@ -66,13 +135,8 @@ def main(args):
         if valid_f is not None:
             print(dir_path, file=valid_f)
 
-        for fname in glob.iglob(search_path, recursive=True):
-            file_path = os.path.realpath(fname)
-
-            if args.path_must_contain and args.path_must_contain not in file_path:
-                continue
-
-            frames = soundfile.info(fname).frames
+        for file_path in file_paths:
+            frames = cache[file_path][1]
             dest = train_f if rand.random() > args.valid_percent else valid_f
             print(
                 "{}\t{}".format(os.path.relpath(file_path, dir_path), frames), file=dest
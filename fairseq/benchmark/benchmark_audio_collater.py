@@ -0,0 +1,96 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Collation time per batch of ``RawAudioDataset.collater`` on LibriSpeech-like
+utterance lengths, batched with ``max_tokens: 3200000`` as in the wav2vec 2.0
+fine-tuning configs, against the previous collater (zero-filled batch,
+``torch.cat`` padding and a second ``F.pad`` copy for buckets)."""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from fairseq.data.audio.raw_audio_dataset import RawAudioDataset
+
+
+class InMemoryAudioDataset(RawAudioDataset):
+    def __init__(self, num_utterances, num_buckets, seed=0):
+        super().__init__(sample_rate=16000, pad=True, shuffle=False)
+        rng = np.random.RandomState(seed)
+        # 1.5 to 35 seconds, most utterances around 12-16 seconds
+        self.sizes = np.clip(rng.normal(14.5, 3.5, num_utterances), 1.5, 35)
+        self.sizes = (self.sizes * 16000).astype(np.int64)
+        self.audio = torch.randn(int(self.sizes.max()))
+        self.set_bucket_info(num_buckets)
+
+    def __getitem__(self, index):
+        return {"id": index, "source": self.audio[: self.sizes[index]]}
+
+
+def previous_collater(dataset, samples):
+    sources = [s["source"] for s in samples]
+    sizes = [len(s) for s in sources]
+    target_size = min(max(sizes), dataset.max_sample_size)
+
+    collated_sources = sources[0].new_zeros(len(sources), target_size)
+    padding_mask = torch.BoolTensor(collated_sources.shape).fill_(False)
+    for i, (source, size) in enumerate(zip(sources, sizes)):
+        diff = size - target_size
+        if diff == 0:
+            collated_sources[i] = source
+        else:
+            collated_sources[i] = torch.cat([source, source.new_full((-diff,), 0.0)])
+            padding_mask[i, diff:] = True
+
+    if dataset.num_buckets > 0:
+        bucket = max(dataset._bucketed_sizes[s["id"]] for s in samples)
+        num_pad = bucket - collated_sources.size(-1)
+        if num_pad:
+            collated_sources = F.pad(collated_sources, (0, num_pad), value=0)
+            padding_mask = F.pad(padding_mask, (0, num_pad), value=True)
+    return {"source": collated_sources, "padding_mask": padding_mask}
+
+
+def time_collater(collate, batches):
+    start = time.perf_counter()
+    for samples in batches:
+        collate(samples)
+    return (time.perf_counter() - start) / len(batches)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-utterances", type=int, default=2000)
+    parser.add_argument("--max-tokens", type=int, default=3200000)
+    parser.add_argument("--num-buckets", type=int, nargs="+", default=[0, 10])
+    args = parser.parse_args()
+
+    for num_buckets in args.num_buckets:
+        dataset = InMemoryAudioDataset(args.num_utterances, num_buckets)
+        indices = np.random.RandomState(1).permutation(len(dataset))
+        batches = [
+            [dataset[i] for i in batch]
+            for batch in dataset.batch_by_size(indices, max_tokens=args.max_tokens)
+        ]
+        new = dataset.collater(batches[0])["net_input"]
+        old = previous_collater(dataset, batches[0])
+        assert torch.equal(new["source"], old["source"])
+        assert torch.equal(new["padding_mask"], old["padding_mask"])
+
+        old_time = time_collater(lambda s: previous_collater(dataset, s), batches)
+        new_time = time_collater(dataset.collater, batches)
+        print(
+            f"buckets={num_buckets}: {len(batches)} batches, "
+            f"previous {1000 * old_time:.1f} ms/batch, "
+            f"collater {1000 * new_time:.1f} ms/batch "
+            f"({old_time / new_time:.2f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Peak memory and time of the forward and backward pass of the CTC loss of
+``CtcCriterion``, on the log-softmax of the logits with ``F.ctc_loss`` and with
+``--ctc-chunk-size`` (:func:`~fairseq.modules.chunked_ctc_loss`), against
+batch size, and the largest batch which fits in memory.
+
+On GPU, the peak memory is the max memory allocated by torch. On CPU, every
+measurement runs in a forked process whose address space is limited to
+``--memory-limit-mb`` more than before the measurement, and its peak
+resident memory increase is reported."""
+
+import argparse
+import multiprocessing as mp
+import resource
+import time
+
+import torch
+import torch.nn.functional as F
+
+from fairseq import utils
+from fairseq.modules import chunked_ctc_loss
+
+
+def native_ctc_loss(logits, targets, input_lengths, target_lengths, chunk_size):
+    lprobs = utils.log_softmax(logits.float(), dim=-1).contiguous()
+    with torch.backends.cudnn.flags(enabled=False):
+        return F.ctc_loss(
+            lprobs, targets, input_lengths, target_lengths, reduction="sum"
+        )
+
+
+def chunked(logits, targets, input_lengths, target_lengths, chunk_size):
+    return chunked_ctc_loss(
+        logits,
+        targets,
+        input_lengths,
+        target_lengths,
+        reduction="sum",
+        chunk_size=chunk_size,
+    )
+
+
+def run(loss_fn, args, bsz, device, dtype):
+    """Seconds taken by the forward and backward pass and the peak memory in
+    MB."""
+    logits = torch.randn(args.frames, bsz, args.vocab, device=device, dtype=dtype)
+    logits.requires_grad_()
+    targets = torch.randint(1, args.vocab, (bsz, args.target_length), device=device)
+    input_lengths = torch.full((bsz,), args.frames, dtype=torch.long, device=device)
+    target_lengths = torch.full(
+        (bsz,), args.target_length, dtype=torch.long, device=device
+    )
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    else:
+        with open("/proc/self/statm") as f:
+            base = int(f.read().split()[1]) * resource.getpagesize()
+    start = time.perf_counter()
+    loss = loss_fn(logits, targets, input_lengths, target_lengths, args.chunk_size)
+    loss.backward()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return time.perf_counter() - start, (peak - base) / 2**20
+
+
+def measure(loss_fn, args, bsz, device, dtype):
+    if device.type == "cuda":
+        try:
+            return run(loss_fn, args, bsz, device, dtype)
+        except RuntimeError:  # out of memory
+            torch.cuda.empty_cache()
+            return None
+    ctx = mp.get_context("fork")
+    parent, child = ctx.Pipe(duplex=False)
+
+    def target():
+        with open("/proc/self/statm") as f:
+            size = int(f.read().split()[0]) * resource.getpagesize()
+        limit = size + args.memory_limit_mb * 2**20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        try:
+            child.send(run(loss_fn, args, bsz, device, dtype))
+        except (RuntimeError, MemoryError):  # out of memory
+            child.send(None)
+
+    p = ctx.Process(target=target)
+    p.start()
+    result = parent.recv()
+    p.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    # 30 seconds of wav2vec 2.0 frames, with letter targets
+    parser.add_argument("--frames", type=int, default=1500)
+    parser.add_argument("--vocab", type=int, default=32)
+    parser.add_argument("--target-length", type=int, default=400)
+    parser.add_argument("--batch-sizes", default="1,2,4,8,16,32,64,128")
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--fp16", action="store_true")
+    parser.add_argument("--memory-limit-mb", type=int, default=4096)
+    parser.add_argument("--cpu", action="store_true")
+    args = parser.parse_args()
+    device = torch.device(
+        "cuda" if torch.cuda.is_available() and not args.cpu else "cpu"
+    )
+    dtype = torch.float16 if args.fp16 else torch.float32
+
+    losses = {"F.ctc_loss": native_ctc_loss, "chunked": chunked}
+    # warm up
+    for loss_fn in losses.values():
+        measure(loss_fn, args, 1, device, dtype)
+
+    max_batch = {name: 0 for name in losses}
+    print(f"{'batch':>6} {'loss':>12} {'peak MB':>10} {'seconds':>8}")
+    for bsz in map(int, args.batch_sizes.split(",")):
+        for name, loss_fn in losses.items():
+            result = measure(loss_fn, args, bsz, device, dtype)
+            if result is None:
+                print(f"{bsz:6d} {name:>12} {'out of memory':>19}")
+                continue
+            max_batch[name] = bsz
+            elapsed, peak_mb = result
+            print(f"{bsz:6d} {name:>12} {peak_mb:10.0f} {elapsed:8.3f}")
+    for name, bsz in max_batch.items():
+        print(f"max batch of {name}: {bsz}")
+
+
+if __name__ == "__main__":
+    main()
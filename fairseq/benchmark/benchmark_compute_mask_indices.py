@@ -0,0 +1,78 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+from torch.utils import benchmark
+
+from fairseq.data.data_utils import compute_mask_indices, compute_mask_indices_batched
+
+# utterances per batch at max_tokens 3200000 and 320x downsampling
+BATCH = [8, 16, 32]
+FRAMES = 10000
+CHANNELS = 768
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def _padding_mask(batch_size):
+    tsz = FRAMES // batch_size
+    lengths = torch.randint(tsz // 2, tsz + 1, (batch_size,))
+    lengths[0] = tsz
+    return (torch.arange(tsz) >= lengths.unsqueeze(1)).to(DEVICE)
+
+
+def per_row(padding_mask, mask_type):
+    """Time and channel masks of one step as computed before, including the
+    copy to the device."""
+    bsz, tsz = padding_mask.shape
+    mask = compute_mask_indices(
+        (bsz, tsz), padding_mask, 0.65, 10, mask_type, 2.0, min_masks=2
+    )
+    channel_mask = compute_mask_indices((bsz, CHANNELS), None, 0.5, 64, mask_type)
+    mask = torch.from_numpy(mask).to(DEVICE)
+    channel_mask = torch.from_numpy(channel_mask).to(DEVICE)
+    return mask, channel_mask
+
+
+def batched(padding_mask, mask_type):
+    bsz, tsz = padding_mask.shape
+    mask = compute_mask_indices_batched(
+        (bsz, tsz), padding_mask, 0.65, 10, mask_type, 2.0, min_masks=2
+    )
+    channel_mask = compute_mask_indices_batched(
+        (bsz, CHANNELS), None, 0.5, 64, mask_type, device=DEVICE
+    )
+    return mask, channel_mask
+
+
+def benchmark_compute_mask_indices(batch_size, mask_type):
+    padding_mask = _padding_mask(batch_size)
+    results = []
+    for fn in [per_row, batched]:
+        results.append(
+            benchmark.Timer(
+                stmt="fn(padding_mask, mask_type)",
+                globals={
+                    "padding_mask": padding_mask,
+                    "mask_type": mask_type,
+                    "fn": fn,
+                },
+                label="wav2vec2 time and channel masks per step",
+                sub_label=f"{fn.__name__}, {mask_type}",
+                description=f"batch {batch_size}",
+            ).blocked_autorange(min_run_time=1)
+        )
+    return results
+
+
+def run_benchmarks():
+    results = []
+    for mask_type in ["static", "normal", "poisson"]:
+        for batch_size in BATCH:
+            results.extend(benchmark_compute_mask_indices(batch_size, mask_type))
+    benchmark.Compare(results).print()
+
+
+if __name__ == "__main__":
+    run_benchmarks()
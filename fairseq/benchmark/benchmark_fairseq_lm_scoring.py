@@ -0,0 +1,117 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Neural LM scoring time of a simulated lexicon beam search: one batch-1
+forward per new LM state, as ``FairseqLM`` did before, versus the
+``BatchedLMScorer`` that scores prefetched expansions in padded batches."""
+
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+import torch
+
+from examples.speech_recognition.utils.lm_scoring import BatchedLMScorer
+from fairseq.data import Dictionary
+from fairseq.models.transformer_lm import (
+    TransformerLanguageModel,
+    transformer_lm_gpt,
+)
+
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def build_lm(vocab_size, layers, embed_dim):
+    """A randomly initialized word-level transformer LM."""
+    dictionary = Dictionary()
+    for i in range(vocab_size):
+        dictionary.add_symbol(f"w{i}")
+    args = argparse.Namespace(
+        decoder_layers=layers,
+        decoder_embed_dim=embed_dim,
+        decoder_ffn_embed_dim=4 * embed_dim,
+        decoder_attention_heads=embed_dim // 64,
+        tokens_per_sample=512,
+    )
+    transformer_lm_gpt(args)
+    task = SimpleNamespace(source_dictionary=dictionary, target_dictionary=dictionary)
+    model = TransformerLanguageModel.build_model(args, task)
+    return dictionary, model.to(DEVICE).eval()
+
+
+class SingleForwardScorer(object):
+    """The previous ``FairseqLM`` scoring: a batch-1 forward over the whole
+    prefix for every prefix seen for the first time."""
+
+    def __init__(self, model):
+        self.model = model
+        self.probs = {}
+
+    def prefetch(self, prefix):
+        pass
+
+    def clear_pending(self):
+        pass
+
+    def score(self, prefix, token):
+        if prefix not in self.probs:
+            with torch.no_grad():
+                res = self.model(torch.LongTensor([prefix]).to(DEVICE))
+                probs = self.model.get_normalized_probs(
+                    res, log_probs=True, sample=None
+                )
+            self.probs[prefix] = probs[0, -1].cpu().numpy()
+        return self.probs[prefix][token].item()
+
+
+def simulate_beam_search(scorer, dictionary, utterances, words, beam, candidates):
+    """Scores the query pattern of a lexicon decoder: every hypothesis of the
+    beam proposes *candidates* next words, the new states are registered with
+    the scorer, and *beam* of them survive."""
+    rng = random.Random(0)
+    vocab = range(dictionary.nspecial, len(dictionary))
+    start = time.perf_counter()
+    for _ in range(utterances):
+        hyps = [(dictionary.eos(),)]
+        for _ in range(words):
+            expansions = []
+            for prefix in hyps:
+                for token in rng.sample(vocab, candidates):
+                    score = scorer.score(prefix, token)
+                    child = prefix + (token,)
+                    scorer.prefetch(child)
+                    expansions.append((score + rng.random(), child))
+            expansions.sort(reverse=True)
+            hyps = [child for _, child in expansions[:beam]]
+        scorer.clear_pending()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab-size", type=int, default=20000)
+    parser.add_argument("--layers", type=int, default=6)
+    parser.add_argument("--embed-dim", type=int, default=512)
+    parser.add_argument("--utterances", type=int, default=4)
+    parser.add_argument("--words", type=int, default=12)
+    parser.add_argument("--beam", type=int, default=16)
+    parser.add_argument("--candidates", type=int, default=8)
+    parser.add_argument("--max-batch", type=int, default=None)
+    args = parser.parse_args()
+
+    dictionary, model = build_lm(args.vocab_size, args.layers, args.embed_dim)
+    search = (args.utterances, args.words, args.beam, args.candidates)
+    single = SingleForwardScorer(model)
+    batched = BatchedLMScorer(model, dictionary, max_batch=args.max_batch)
+    for name, scorer in [("batch-1 forwards", single), ("batched scorer", batched)]:
+        elapsed = simulate_beam_search(scorer, dictionary, *search)
+        print(f"{name:>16}: {elapsed:.2f}s")
+    batched.log_stats()
+    print(batched.stats)
+
+
+if __name__ == "__main__":
+    main()
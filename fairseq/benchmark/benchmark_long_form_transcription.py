@@ -0,0 +1,153 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Peak memory and real-time factor of greedy CTC transcription with a
+randomly initialized wav2vec 2.0 model, on whole utterances and with the
+long-form windows of ``infer.py --long-form-window``, against utterance
+length.
+
+On GPU, the peak memory is the max memory allocated by torch. On CPU, every
+measurement runs in a forked process, whose peak resident memory increase is
+reported, so that running out of memory only fails that measurement."""
+
+import argparse
+import multiprocessing as mp
+import resource
+import time
+from argparse import Namespace
+
+import torch
+from examples.speech_recognition.utils.long_form import LongFormDecoder
+from examples.speech_recognition.w2l_decoder import W2lGreedyDecoder
+from fairseq import options
+from fairseq.data import Dictionary
+from fairseq.dataclass.utils import convert_namespace_to_omegaconf
+from fairseq.models.wav2vec.wav2vec2_asr import Wav2Vec2CtcConfig, Wav2VecCtc
+
+SAMPLE_RATE = 16000
+
+
+def build_model(args, tgt_dict):
+    w2v_args = options.parse_args_and_arch(
+        options.get_training_parser(),
+        [
+            "unused",
+            "--task",
+            "audio_pretraining",
+            "--arch",
+            "wav2vec2",
+            "--extractor-mode",
+            "layer_norm",
+            "--encoder-layers",
+            str(args.encoder_layers),
+            "--encoder-embed-dim",
+            str(args.encoder_embed_dim),
+            "--encoder-ffn-embed-dim",
+            str(4 * args.encoder_embed_dim),
+            "--encoder-attention-heads",
+            str(args.encoder_embed_dim // 64),
+        ],
+    )
+    cfg = Wav2Vec2CtcConfig(
+        w2v_path="unused",
+        w2v_args=convert_namespace_to_omegaconf(w2v_args),
+        normalize=False,
+        data="unused",
+    )
+    return Wav2VecCtc.build_model(cfg, Namespace(target_dictionary=tgt_dict))
+
+
+def transcribe(generator, model, seconds, cuda):
+    """Seconds taken to transcribe *seconds* of audio and the peak memory in
+    MB."""
+    source = torch.randn(1, int(seconds * SAMPLE_RATE))
+    sample = {"net_input": {"source": source, "padding_mask": None}}
+    if cuda:
+        sample["net_input"]["source"] = source.cuda()
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    else:
+        with open("/proc/self/statm") as f:
+            base = int(f.read().split()[1]) * resource.getpagesize()
+    start = time.perf_counter()
+    with torch.no_grad():
+        generator.generate([model], sample)
+    if cuda:
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return time.perf_counter() - start, (peak - base) / 2**20
+
+
+def measure(generator, model, seconds, cuda):
+    if cuda:
+        try:
+            return transcribe(generator, model, seconds, cuda)
+        except RuntimeError:  # out of memory
+            torch.cuda.empty_cache()
+            return None
+    ctx = mp.get_context("fork")
+    parent, child = ctx.Pipe(duplex=False)
+
+    def run():
+        try:
+            child.send(transcribe(generator, model, seconds, cuda))
+        except RuntimeError:  # out of memory
+            child.send(None)
+
+    p = ctx.Process(target=run)
+    p.start()
+    p.join()
+    # killed by the kernel if it ran out of memory
+    return parent.recv() if p.exitcode == 0 else None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lengths", default="10,30,60,120,300,600,1800,3600")
+    parser.add_argument("--window", type=float, default=30.0)
+    parser.add_argument("--overlap", type=float, default=1.0)
+    parser.add_argument("--batch-windows", type=int, default=16)
+    parser.add_argument("--encoder-layers", type=int, default=12)
+    parser.add_argument("--encoder-embed-dim", type=int, default=768)
+    parser.add_argument("--cpu", action="store_true")
+    args = parser.parse_args()
+    cuda = torch.cuda.is_available() and not args.cpu
+
+    tgt_dict = Dictionary()
+    for c in "|ETAONIHSRDLUMWCFGYPBVKXJQZ'":
+        tgt_dict.add_symbol(c)
+    model = build_model(args, tgt_dict).eval()
+    if cuda:
+        model = model.cuda()
+    decoder = W2lGreedyDecoder(Namespace(nbest=1), tgt_dict)
+    generators = {
+        "whole utterance": decoder,
+        "long form": LongFormDecoder(
+            decoder,
+            window=int(args.window * SAMPLE_RATE),
+            overlap=int(args.overlap * SAMPLE_RATE),
+            max_windows=args.batch_windows,
+        ),
+    }
+    # warm up
+    for generator in generators.values():
+        measure(generator, model, args.window, cuda)
+
+    print(f"{'seconds':>8} {'mode':>16} {'peak MB':>10} {'RTF':>8}")
+    for seconds in map(float, args.lengths.split(",")):
+        for name, generator in generators.items():
+            result = measure(generator, model, seconds, cuda)
+            if result is None:
+                print(f"{seconds:8.0f} {name:>16} {'out of memory':>19}")
+                continue
+            elapsed, peak_mb = result
+            print(f"{seconds:8.0f} {name:>16} {peak_mb:10.0f} {elapsed / seconds:8.4f}")
+
+
+if __name__ == "__main__":
+    main()
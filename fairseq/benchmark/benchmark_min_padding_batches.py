@@ -0,0 +1,61 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Padding efficiency, number of batches and batching time of greedy batching
+(``batch_by_size``) and ``batch_by_size_min_padding`` on LibriSpeech-like
+utterance lengths, in the length-sorted order of ``RawAudioDataset`` and in
+manifest order."""
+
+import argparse
+import time
+
+import numpy as np
+
+from fairseq.data import data_utils
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-utterances", type=int, default=281241)
+    parser.add_argument("--max-tokens", type=int, default=3200000)
+    parser.add_argument("--required-batch-size-multiple", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    # 1.5 to 35 seconds, most utterances around 12-16 seconds
+    sizes = np.clip(rng.normal(14.5, 3.5, args.num_utterances), 1.5, 35)
+    sizes = (sizes * 16000).astype(np.int64)
+    orders = {
+        "sorted": np.lexsort([rng.permutation(len(sizes)), sizes])[::-1],
+        "manifest": np.arange(len(sizes)),
+    }
+
+    for name, indices in orders.items():
+        for fn in ["greedy", "min_padding"]:
+            start = time.perf_counter()
+            if fn == "greedy":
+                batches = data_utils.batch_by_size(
+                    indices,
+                    None,
+                    num_tokens_vec=sizes[indices],
+                    max_tokens=args.max_tokens,
+                    required_batch_size_multiple=args.required_batch_size_multiple,
+                )
+            else:
+                batches = data_utils.batch_by_size_min_padding(
+                    indices,
+                    sizes[indices],
+                    max_tokens=args.max_tokens,
+                    required_batch_size_multiple=args.required_batch_size_multiple,
+                )
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name} order, {fn}: {len(batches)} batches, padding efficiency "
+                f"{data_utils.padding_efficiency(batches, sizes):.4%}, {elapsed:.2f} s"
+            )
+
+
+if __name__ == "__main__":
+    main()
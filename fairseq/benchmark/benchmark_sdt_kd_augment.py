@@ -0,0 +1,77 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import random
+import string
+
+import torch
+from torch.utils import benchmark
+
+from fairseq.criterions.ctc_sdt_kd import CtcCriterionSdtKD
+from fairseq.data import Dictionary, data_utils
+from fairseq.data.text_augment import BatchedTextAugment
+
+BATCH = [8, 16, 32, 64]
+MIN_WORDS = 10
+MAX_WORDS = 60
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def _letter_dictionary():
+    vocab = Dictionary()
+    for c in "|" + string.ascii_uppercase + "'":
+        vocab.add_symbol(c)
+    return vocab
+
+
+def _random_targets(vocab, batch_size):
+    random.seed(0)
+    rows = []
+    for _ in range(batch_size):
+        words = [
+            "".join(random.choices(string.ascii_uppercase, k=random.randint(1, 9)))
+            for _ in range(random.randint(MIN_WORDS, MAX_WORDS))
+        ]
+        line = " ".join("|".join(words)) + " |"
+        rows.append(vocab.encode_line(line, append_eos=False).long())
+    tokens = data_utils.collate_tokens(rows, vocab.pad()).to(DEVICE)
+    lengths = torch.LongTensor([len(r) for r in rows]).to(DEVICE)
+    return tokens, lengths
+
+
+def benchmark_sdt_kd_augment(batch_size):
+    vocab = _letter_dictionary()
+    tokens, lengths = _random_targets(vocab, batch_size)
+    augment = BatchedTextAugment(vocab)
+
+    def per_line(tokens, lengths):
+        CtcCriterionSdtKD.txt_augment(tokens, lengths, vocab, num_aug=1)
+
+    def batched(tokens, lengths):
+        augment(tokens, lengths, num_aug=1)
+
+    results = []
+    for fn in [per_line, batched]:
+        results.append(
+            benchmark.Timer(
+                stmt="fn(tokens, lengths)",
+                globals={"tokens": tokens, "lengths": lengths, "fn": fn},
+                label="ctc_sdt_kd text augmentation",
+                sub_label=f"{fn.__name__}",
+                description=f"batch {batch_size}",
+            ).blocked_autorange(min_run_time=1)
+        )
+    return results
+
+
+def run_benchmarks():
+    results = []
+    for batch_size in BATCH:
+        results.extend(benchmark_sdt_kd_augment(batch_size))
+    benchmark.Compare(results).print()
+
+
+if __name__ == "__main__":
+    run_benchmarks()
@@ -0,0 +1,120 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Step time and peak memory of the ctc_sdt_kd negative scoring: one teacher
+forward / matmul / alignment per negative (``score_negatives_loop``) versus
+a single batched pass (``score_negatives``)."""
+
+import argparse
+from argparse import Namespace
+from types import SimpleNamespace
+
+import torch
+from torch.utils import benchmark
+
+from fairseq.benchmark.benchmark_sdt_kd_augment import (
+    _letter_dictionary,
+    _random_targets,
+)
+from fairseq.criterions.ctc_sdt_kd import CtcCriterionSdtKD
+from fairseq.data.text_augment import BatchedTextAugment
+from fairseq.models.roberta import RobertaModel
+
+BATCH = [8, 16, 32]
+FRAMES_PER_TOKEN = 3
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def build_criterion(vocab, teacher_layers=12, embed_dim=768):
+    """A ctc_sdt_kd criterion with a randomly initialized letter RoBERTa
+    teacher, without loading a pretrained checkpoint."""
+    args = Namespace(
+        encoder_layers=teacher_layers,
+        encoder_embed_dim=embed_dim,
+        encoder_ffn_embed_dim=4 * embed_dim,
+        encoder_attention_heads=embed_dim // 64,
+        max_positions=1024,
+    )
+    teacher = RobertaModel.build_model(args, SimpleNamespace(source_dictionary=vocab))
+    criterion = CtcCriterionSdtKD.__new__(CtcCriterionSdtKD)
+    torch.nn.Module.__init__(criterion)
+    criterion.model_lm = SimpleNamespace(model=teacher.to(DEVICE).eval())
+    criterion.target_dictionary = vocab
+    criterion.teacher_layer = -9
+    criterion.teacher_cache_dir = None
+    return criterion
+
+
+def _inputs(vocab, batch_size, embed_dim):
+    tokens, lengths = _random_targets(vocab, batch_size)
+    noisy_target = BatchedTextAugment(vocab)(tokens, lengths)
+    frames = FRAMES_PER_TOKEN * tokens.size(1)
+    encoder_out_kd = torch.randn(frames, batch_size, embed_dim, device=DEVICE)
+    padding_mask = (
+        torch.arange(frames, device=DEVICE)[None, :]
+        >= (FRAMES_PER_TOKEN * lengths)[:, None]
+    )
+    sample = {"target": tokens, "target_lengths": lengths}
+    masks = ((~padding_mask).unsqueeze(-1), ~padding_mask, True)
+    return sample, noisy_target, encoder_out_kd, masks
+
+
+def _peak_memory(fn):
+    if DEVICE.type != "cuda":
+        return float("nan")
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    fn()
+    torch.cuda.synchronize()
+    return torch.cuda.max_memory_allocated() / 2**20
+
+
+def benchmark_sdt_kd_teacher(criterion, vocab, batch_size, embed_dim):
+    sample, noisy_target, encoder_out_kd, masks = _inputs(vocab, batch_size, embed_dim)
+
+    results, outputs = [], {}
+    for fn in [criterion.score_negatives_loop, criterion.score_negatives]:
+
+        @torch.no_grad()
+        def step(fn=fn):
+            outputs[fn.__name__] = fn(sample, noisy_target, encoder_out_kd, *masks)[0]
+
+        peak = _peak_memory(step)
+        results.append(
+            benchmark.Timer(
+                stmt="step()",
+                globals={"step": step},
+                label="ctc_sdt_kd negative scoring",
+                sub_label=f"{fn.__name__} (peak {peak:.0f} MiB)",
+                description=f"batch {batch_size}",
+                num_threads=torch.get_num_threads(),
+            ).blocked_autorange(min_run_time=1)
+        )
+    max_diff = (
+        (outputs["score_negatives"] - outputs["score_negatives_loop"]).abs().max()
+    )
+    return results, max_diff.item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--teacher-layers", type=int, default=12)
+    parser.add_argument("--embed-dim", type=int, default=768)
+    args = parser.parse_args()
+
+    vocab = _letter_dictionary()
+    criterion = build_criterion(vocab, args.teacher_layers, args.embed_dim)
+    results = []
+    for batch_size in BATCH:
+        res, max_diff = benchmark_sdt_kd_teacher(
+            criterion, vocab, batch_size, args.embed_dim
+        )
+        print(f"batch {batch_size}: max |batched - loop| score = {max_diff:.3g}")
+        results.extend(res)
+    benchmark.Compare(results).print()
+
+
+if __name__ == "__main__":
+    main()
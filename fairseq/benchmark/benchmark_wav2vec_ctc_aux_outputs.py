@@ -0,0 +1,112 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Validation throughput of a wav2vec 2.0 CTC model when the encoder computes
+every auxiliary output (text embedding, ``proj_kd``, layer results), as it
+did before ``set_aux_outputs``, versus only the CTC emissions."""
+
+import argparse
+from types import SimpleNamespace
+
+import torch
+from torch.utils import benchmark
+
+from fairseq import options
+from fairseq.benchmark.benchmark_sdt_kd_augment import (
+    _letter_dictionary,
+    _random_targets,
+)
+from fairseq.models.wav2vec.wav2vec2_asr import (
+    AUX_OUTPUTS,
+    Wav2Vec2CtcConfig,
+    Wav2VecCtc,
+)
+
+BATCH = [4, 8]
+SECONDS = 15
+SAMPLE_RATE = 16000
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def build_wav2vec_ctc(vocab, encoder_layers=12, embed_dim=768):
+    """A randomly initialized wav2vec 2.0 CTC model, without loading a
+    pretrained checkpoint."""
+    w2v_args = options.parse_args_and_arch(
+        options.get_training_parser(),
+        [
+            "unused",
+            "--task",
+            "audio_pretraining",
+            "--arch",
+            "wav2vec2",
+            "--encoder-layers",
+            str(encoder_layers),
+            "--encoder-embed-dim",
+            str(embed_dim),
+            "--encoder-ffn-embed-dim",
+            str(4 * embed_dim),
+            "--encoder-attention-heads",
+            str(embed_dim // 64),
+        ],
+    )
+    cfg = Wav2Vec2CtcConfig(w2v_args=w2v_args, data=".", normalize=False)
+    model = Wav2VecCtc.build_model(cfg, SimpleNamespace(target_dictionary=vocab))
+    return model.to(DEVICE).eval()
+
+
+def _sample(vocab, batch_size):
+    target, _ = _random_targets(vocab, batch_size)
+    return {
+        "net_input": {
+            "source": torch.randn(batch_size, SECONDS * SAMPLE_RATE, device=DEVICE),
+            "padding_mask": torch.zeros(
+                batch_size, SECONDS * SAMPLE_RATE, dtype=torch.bool, device=DEVICE
+            ),
+        },
+        "target": target.to(DEVICE),
+    }
+
+
+def benchmark_aux_outputs(model, vocab, batch_size):
+    sample = _sample(vocab, batch_size)
+
+    results = []
+    for name, aux_outputs in [("all aux outputs", AUX_OUTPUTS), ("ctc only", ())]:
+        model.set_aux_outputs(aux_outputs)
+
+        @torch.no_grad()
+        def step():
+            # ctc_sdt_kd passes the target on validation too
+            model(**sample["net_input"], target=sample["target"])
+
+        results.append(
+            benchmark.Timer(
+                stmt="step()",
+                globals={"step": step},
+                label="wav2vec 2.0 CTC validation forward",
+                sub_label=name,
+                description=f"{batch_size} x {SECONDS}s",
+                num_threads=torch.get_num_threads(),
+            ).blocked_autorange(min_run_time=1)
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--encoder-layers", type=int, default=12)
+    parser.add_argument("--embed-dim", type=int, default=768)
+    args = parser.parse_args()
+
+    vocab = _letter_dictionary()
+    model = build_wav2vec_ctc(vocab, args.encoder_layers, args.embed_dim)
+    results = []
+    for batch_size in BATCH:
+        results.extend(benchmark_aux_outputs(model, vocab, batch_size))
+    benchmark.Compare(results).print()
+
+
+if __name__ == "__main__":
+    main()
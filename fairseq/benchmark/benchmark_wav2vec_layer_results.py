@@ -0,0 +1,99 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Peak memory of a wav2vec 2.0 CTC forward (inference) and forward/backward
+(fine-tuning) on long utterances when the encoder keeps the results of every
+transformer layer versus none of them (``result_layers=()``)."""
+
+import argparse
+
+import torch
+
+from fairseq.benchmark.benchmark_sdt_kd_augment import _letter_dictionary
+from fairseq.benchmark.benchmark_wav2vec_ctc_aux_outputs import (
+    DEVICE,
+    SAMPLE_RATE,
+    build_wav2vec_ctc,
+)
+
+SECONDS = [15, 25, 35]
+
+
+def _peak_memory(fn):
+    if DEVICE.type != "cuda":
+        fn()
+        return float("nan")
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    fn()
+    torch.cuda.synchronize()
+    return torch.cuda.max_memory_allocated() / 2**20
+
+
+def _retained_memory(layer_results):
+    """MiB of distinct storages referenced by *layer_results*."""
+    storages = {}
+    for result in layer_results:
+        for t in result:
+            if t is not None:
+                storage = t.untyped_storage()
+                storages[storage.data_ptr()] = storage.nbytes()
+    return sum(storages.values()) / 2**20
+
+
+def benchmark_layer_results(model, batch_size, seconds):
+    source = torch.randn(batch_size, seconds * SAMPLE_RATE, device=DEVICE)
+    padding_mask = torch.zeros_like(source, dtype=torch.bool)
+    w2v_model = model.w2v_encoder.w2v_model
+
+    rows = []
+    for name, result_layers in [("all layers", None), ("none", ())]:
+        model.set_aux_outputs(("layer_results",), result_layers)
+        retained = []
+
+        @torch.no_grad()
+        def infer():
+            res = w2v_model.extract_features(
+                source, padding_mask, result_layers=result_layers
+            )
+            retained.append(_retained_memory(res["layer_results"]))
+
+        def train():
+            net_output = model(source=source, padding_mask=padding_mask)
+            net_output["encoder_out"].float().sum().backward()
+
+        model.eval()
+        infer_peak = _peak_memory(infer)
+        model.train()
+        train_peak = _peak_memory(train)
+        model.zero_grad(set_to_none=True)
+        rows.append((name, retained[-1], infer_peak, train_peak))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--encoder-layers", type=int, default=12)
+    parser.add_argument("--embed-dim", type=int, default=768)
+    parser.add_argument("--batch-size", type=int, default=4)
+    args = parser.parse_args()
+
+    model = build_wav2vec_ctc(_letter_dictionary(), args.encoder_layers, args.embed_dim)
+    print(
+        f"{'utterance':>10} {'layer_results':>14} {'retained MiB':>13} "
+        f"{'infer peak MiB':>15} {'train peak MiB':>15}"
+    )
+    for seconds in SECONDS:
+        for name, retained, infer_peak, train_peak in benchmark_layer_results(
+            model, args.batch_size, seconds
+        ):
+            print(
+                f"{args.batch_size} x {seconds:>3}s {name:>14} {retained:>13.0f} "
+                f"{infer_peak:>15.0f} {train_peak:>15.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -17,7 +17,14 @@ from fairseq import utils
 from fairseq.logging import metrics
 from fairseq.criterions import FairseqCriterion, register_criterion
 from fairseq.dataclass import FairseqDataclass
-from fairseq.data.data_utils import post_process
+from fairseq.data.data_utils import (
+    batch_edit_distance,
+    batch_word_ids,
+    ctc_greedy_decode,
+    letter_word_separator,
+    pack_tokens,
+    post_process,
+)
 from fairseq.tasks import FairseqTask
 from fairseq.logging.meters import safe_round
 
@@ -28,6 +35,15 @@ class CtcCriterionConfig(FairseqDataclass):
         default=False,
         metadata={"help": "zero inf loss when source length <= target length"},
     )
+    ctc_chunk_size: int = field(
+        default=0,
+        metadata={
+            "help": "if > 0, compute the loss on the logits with the log-softmax "
+            "in the CTC recursions, over chunks of this many frames, instead of "
+            "on a (T, B, C) float copy of the log-probs; takes less memory on "
+            "long utterances but is slower"
+        },
+    )
     sentence_avg: bool = II("optimization.sentence_avg")
     post_process: str = field(
         default="letter",
@@ -59,6 +75,13 @@ class CtcCriterionConfig(FairseqDataclass):
         default=0,
         metadata={"help": "lm word score to use with wer_kenlm_model"},
     )
+    wer_trie_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "if set, cache the lexicon trie of wer_kenlm_model in this "
+            "directory and reuse it across runs"
+        },
+    )
 
     wer_args: Optional[str] = field(
         default=None,
@@ -82,6 +105,9 @@ class CtcCriterion(FairseqCriterion):
         self.pad_idx = task.target_dictionary.pad()
         self.eos_idx = task.target_dictionary.eos()
         self.post_process = cfg.post_process
+        self.word_separator = letter_word_separator(
+            task.target_dictionary, cfg.post_process
+        )
 
         self.rdrop_alpha = rdrop_alpha
 
@@ -101,6 +127,7 @@ class CtcCriterion(FairseqCriterion):
             dec_args.criterion = "ctc"
             dec_args.kenlm_model = cfg.wer_kenlm_model
             dec_args.lexicon = cfg.wer_lexicon
+            dec_args.trie_cache_dir = cfg.wer_trie_cache_dir
             dec_args.beam = 50
             dec_args.beam_size_token = min(50, len(task.target_dictionary))
             dec_args.beam_threshold = min(50, len(task.target_dictionary))
@@ -115,13 +142,26 @@ class CtcCriterion(FairseqCriterion):
             self.w2l_decoder = None
 
         self.zero_infinity = cfg.zero_infinity
+        self.ctc_chunk_size = cfg.ctc_chunk_size
         self.sentence_avg = cfg.sentence_avg
 
+    def required_aux_outputs(self):
+        """Auxiliary encoder outputs (see
+        :func:`~fairseq.models.wav2vec.wav2vec2_asr.Wav2VecEncoder.set_aux_outputs`)
+        consumed by this criterion."""
+        return ()
+
     def forward(self, model, sample, reduce=True, **kwargs):
         net_output = model(**sample["net_input"])
-        lprobs = model.get_normalized_probs(
-            net_output, log_probs=True
-        ).contiguous()  # (T, B, C) from the encoder
+        if self.ctc_chunk_size > 0 and hasattr(model, "get_logits"):
+            # normalized by the loss, chunk by chunk
+            lprobs = None
+            ctc_logits = model.get_logits(net_output)
+        else:
+            lprobs = model.get_normalized_probs(
+                net_output, log_probs=True
+            ).contiguous()  # (T, B, C) from the encoder
+            ctc_logits = lprobs
 
         # CTC loss is calculated over duplicated inputs
         # sample is already duplicated for R-Drop
@@ -149,8 +189,8 @@ class CtcCriterion(FairseqCriterion):
                 non_padding_mask = ~net_output["padding_mask"]
                 input_lengths = non_padding_mask.long().sum(-1)
             else:
-                input_lengths = lprobs.new_full(
-                    (lprobs.size(1),), lprobs.size(0), dtype=torch.long
+                input_lengths = ctc_logits.new_full(
+                    (ctc_logits.size(1),), ctc_logits.size(0), dtype=torch.long
                 )
 
         pad_mask = (sample["target"] != self.pad_idx) & (
@@ -162,16 +202,31 @@ class CtcCriterion(FairseqCriterion):
         else:
             target_lengths = pad_mask.sum(-1)
 
-        with torch.backends.cudnn.flags(enabled=False):
-            loss = F.ctc_loss(
-                lprobs,
+        if self.ctc_chunk_size > 0:
+            # fairseq.modules cannot be imported before fairseq.models
+            from fairseq.modules import chunked_ctc_loss
+
+            loss = chunked_ctc_loss(
+                ctc_logits,
                 targets_flat,
                 input_lengths,
                 target_lengths,
                 blank=self.blank_idx,
                 reduction="sum",
                 zero_infinity=self.zero_infinity,
+                chunk_size=self.ctc_chunk_size,
             )
+        else:
+            with torch.backends.cudnn.flags(enabled=False):
+                loss = F.ctc_loss(
+                    lprobs,
+                    targets_flat,
+                    input_lengths,
+                    target_lengths,
+                    blank=self.blank_idx,
+                    reduction="sum",
+                    zero_infinity=self.zero_infinity,
+                )
 
         ntokens = (
             sample["ntokens"] if "ntokens" in sample else target_lengths.sum().item()
@@ -188,63 +243,99 @@ class CtcCriterion(FairseqCriterion):
         if not model.training:
             import editdistance
 
+            if lprobs is None:
+                lprobs = utils.log_softmax(ctc_logits.float(), dim=-1)
+
             with torch.no_grad():
-                lprobs_t = lprobs.transpose(0, 1).float().contiguous().cpu()
-
-                c_err = 0
-                c_len = 0
-                w_errs = 0
-                w_len = 0
-                wv_errs = 0
-                for lp, t, inp_l in zip(
-                    lprobs_t,
+                # greedy decoding of the whole batch on the device
+                pred_tokens, pred_lengths, _, _ = ctc_greedy_decode(
+                    lprobs.transpose(0, 1),
+                    input_lengths,
+                    blank_idx=self.blank_idx,
+                    pad_idx=self.pad_idx,
+                )
+                target = (
                     sample["target_label"]
                     if "target_label" in sample
-                    else sample["target"],
-                    input_lengths,
-                ):
-                    lp = lp[:inp_l].unsqueeze(0)
-
-                    decoded = None
-                    if self.w2l_decoder is not None:
-                        decoded = self.w2l_decoder.decode(lp)
-                        if len(decoded) < 1:
-                            decoded = None
-                        else:
-                            decoded = decoded[0]
-                            if len(decoded) < 1:
-                                decoded = None
-                            else:
-                                decoded = decoded[0]
-
-                    p = (t != self.task.target_dictionary.pad()) & (
-                        t != self.task.target_dictionary.eos()
-                    )
-                    targ = t[p]
-                    targ_units = self.task.target_dictionary.string(targ)
-                    targ_units_arr = targ.tolist()
-
-                    toks = lp.argmax(dim=-1).unique_consecutive()
-                    pred_units_arr = toks[toks != self.blank_idx].tolist()
-
-                    c_err += editdistance.eval(pred_units_arr, targ_units_arr)
-                    c_len += len(targ_units_arr)
+                    else sample["target"]
+                )
+                targ, targ_lengths = pack_tokens(
+                    target,
+                    (target != self.pad_idx) & (target != self.eos_idx),
+                    self.pad_idx,
+                )
+                bsz = targ.size(0)
 
-                    targ_words = post_process(targ_units, self.post_process).split()
+                c_err = (
+                    batch_edit_distance(pred_tokens, pred_lengths, targ, targ_lengths)
+                    .sum()
+                    .item()
+                )
+                c_len = targ_lengths.sum().item()
 
-                    pred_units = self.task.target_dictionary.string(pred_units_arr)
-                    pred_words_raw = post_process(pred_units, self.post_process).split()
+                dictionary = self.task.target_dictionary
 
-                    if decoded is not None and "words" in decoded:
-                        pred_words = decoded["words"]
-                        w_errs += editdistance.eval(pred_words, targ_words)
-                        wv_errs += editdistance.eval(pred_words_raw, targ_words)
-                    else:
-                        dist = editdistance.eval(pred_words_raw, targ_words)
-                        w_errs += dist
-                        wv_errs += dist
+                def to_words(tokens):
+                    units = dictionary.string(tokens)
+                    return post_process(units, self.post_process).split()
 
-                    w_len += len(targ_words)
+                if self.word_separator is not None:
+                    # hypothesis and reference words are numbered together
+                    width = max(pred_tokens.size(1), targ.size(1))
+                    words, word_lengths = batch_word_ids(
+                        torch.cat(
+                            [
+                                F.pad(pred_tokens, (0, width - pred_tokens.size(1))),
+                                F.pad(targ, (0, width - targ.size(1))),
+                            ]
+                        ),
+                        torch.cat([pred_lengths, targ_lengths]),
+                        self.word_separator,
+                        ignore=(dictionary.eos(), dictionary.bos()),
+                    )
+                    wv_dists = batch_edit_distance(
+                        words[:bsz],
+                        word_lengths[:bsz],
+                        words[bsz:],
+                        word_lengths[bsz:],
+                    ).tolist()
+                    w_len = word_lengths[bsz:].sum().item()
+                else:
+                    wv_dists = []
+                    w_len = 0
+                    targ_lines = dictionary.batch_string(
+                        targ, self.post_process, lengths=targ_lengths.cpu()
+                    )
+                    pred_lines = dictionary.batch_string(
+                        pred_tokens, self.post_process, lengths=pred_lengths.cpu()
+                    )
+                    for pred_line, targ_line in zip(pred_lines, targ_lines):
+                        targ_words = targ_line.split()
+                        wv_dists.append(
+                            editdistance.eval(pred_line.split(), targ_words)
+                        )
+                        w_len += len(targ_words)
+
+                wv_errs = w_errs = sum(wv_dists)
+                if self.w2l_decoder is not None:
+                    lprobs_t = lprobs.transpose(0, 1).float().contiguous().cpu()
+                    targ_cpu = targ.cpu()
+                    w_errs = 0
+                    for i, inp_l in enumerate(input_lengths):
+                        decoded = self.w2l_decoder.decode(
+                            lprobs_t[i, :inp_l].unsqueeze(0)
+                        )
+                        if (
+                            len(decoded) > 0
+                            and len(decoded[0]) > 0
+                            and "words" in decoded[0][0]
+                        ):
+                            targ_words = to_words(targ_cpu[i, : targ_lengths[i]])
+                            w_errs += editdistance.eval(
+                                decoded[0][0]["words"], targ_words
+                            )
+                        else:
+                            w_errs += wv_dists[i]
 
                 logging_output["wv_errors"] = wv_errs
                 logging_output["w_errors"] = w_errs
@@ -4,18 +4,31 @@
 # the root directory of this source tree. An additional grant of patent rights
 # can be found in the PATENTS file in the same directory.
 
+import hashlib
+import logging
 import math
+import os
 from argparse import Namespace
 from dataclasses import dataclass, field
 from omegaconf import II
 from typing import Optional
 
+import numpy as np
 import torch
 import torch.nn.functional as F
 from fairseq import metrics, utils
 from fairseq.criterions import FairseqCriterion, register_criterion
 from fairseq.dataclass import FairseqDataclass
-from fairseq.data.data_utils import post_process
+from fairseq.data.data_utils import (
+    batch_edit_distance,
+    batch_word_ids,
+    ctc_greedy_decode,
+    letter_word_separator,
+    pack_tokens,
+    post_process,
+)
+from fairseq.data.mmap_cache import MMapFeatureCache
+from fairseq.data.text_augment import BatchedTextAugment
 from fairseq.tasks import FairseqTask
 from fairseq.logging.meters import safe_round
 import random
@@ -24,6 +37,8 @@ from aligner_pytorch import mas
 
 torch.set_printoptions(threshold=999999)
 
+logger = logging.getLogger(__name__)
+
 
 def pad_list(xs, pad_value):
     """Perform padding for the list of tensors.
@@ -62,6 +77,15 @@ class CtcCriterionConfigSdtKD(FairseqDataclass):
         default=False,
         metadata={"help": "zero inf loss when source length <= target length"},
     )
+    ctc_chunk_size: int = field(
+        default=0,
+        metadata={
+            "help": "if > 0, compute the loss on the logits with the log-softmax "
+            "in the CTC recursions, over chunks of this many frames, instead of "
+            "on a (T, B, C) float copy of the log-probs; takes less memory on "
+            "long utterances but is slower"
+        },
+    )
     pretrained_roberta_dir: str = field(
         default='None',
         metadata={"help": "e.x /home/Workspace/fairseq/pretrained_models/roberta/roberta.base"},
@@ -97,6 +121,13 @@ class CtcCriterionConfigSdtKD(FairseqDataclass):
         default=0,
         metadata={"help": "lm word score to use with wer_kenlm_model"},
     )
+    wer_trie_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "if set, cache the lexicon trie of wer_kenlm_model in this "
+            "directory and reuse it across runs"
+        },
+    )
 
     wer_args: Optional[str] = field(
         default=None,
@@ -104,6 +135,40 @@ class CtcCriterionConfigSdtKD(FairseqDataclass):
             "help": "DEPRECATED: tuple of (wer_kenlm_model, wer_lexicon, wer_lm_weight, wer_word_score)"
         },
     )
+    batched_txt_augment: bool = field(
+        default=True,
+        metadata={
+            "help": "build the swap/deletion/insertion negatives with batched tensor "
+            "ops on the target device instead of the per-line string implementation"
+        },
+    )
+    seed: int = II("common.seed")
+    batched_teacher_forward: bool = field(
+        default=True,
+        metadata={
+            "help": "score the reference and all negatives with one teacher forward, "
+            "one batched matmul and one monotonic alignment call"
+        },
+    )
+    teacher_layer: int = field(
+        default=-9,
+        metadata={
+            "help": "inner state of the teacher LM used as text embedding "
+            "(-1 is the last layer)"
+        },
+    )
+    teacher_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "if set, the teacher hidden states of the training references "
+            "are stored in a memory-mapped cache in this directory, filled lazily "
+            "during the first epoch, and read back instead of running the teacher"
+        },
+    )
+    teacher_cache_fp16: bool = field(
+        default=True, metadata={"help": "store the teacher cache in float16"}
+    )
+    train_subset: str = II("dataset.train_subset")
 
 
 @register_criterion("ctc_sdt_kd", dataclass=CtcCriterionConfigSdtKD)
@@ -120,6 +185,9 @@ class CtcCriterionSdtKD(FairseqCriterion):
         self.pad_idx = task.target_dictionary.pad()
         self.eos_idx = task.target_dictionary.eos()
         self.post_process = cfg.post_process
+        self.word_separator = letter_word_separator(
+            task.target_dictionary, cfg.post_process
+        )
 
         self.rdrop_alpha = rdrop_alpha
 
@@ -139,6 +207,7 @@ class CtcCriterionSdtKD(FairseqCriterion):
             dec_args.criterion = "ctc"
             dec_args.kenlm_model = cfg.wer_kenlm_model
             dec_args.lexicon = cfg.wer_lexicon
+            dec_args.trie_cache_dir = cfg.wer_trie_cache_dir
             dec_args.beam = 50
             dec_args.beam_size_token = min(50, len(task.target_dictionary))
             dec_args.beam_threshold = min(50, len(task.target_dictionary))
@@ -153,6 +222,7 @@ class CtcCriterionSdtKD(FairseqCriterion):
             self.w2l_decoder = None
 
         self.zero_infinity = cfg.zero_infinity
+        self.ctc_chunk_size = cfg.ctc_chunk_size
         self.sentence_avg = cfg.sentence_avg
 
         from fairseq.models.roberta import RobertaModel
@@ -162,6 +232,26 @@ class CtcCriterionSdtKD(FairseqCriterion):
         self.model_lm = model_lm
         self.target_dictionary = task.target_dictionary
         self.criterion_kl=torch.nn.KLDivLoss(reduction="none")
+        self.batched_teacher_forward = cfg.batched_teacher_forward
+        self.teacher_layer = cfg.teacher_layer
+        self.teacher_cache_dir = cfg.teacher_cache_dir
+        self.teacher_cache_dtype = np.float16 if cfg.teacher_cache_fp16 else np.float32
+        self.teacher_checkpoint = os.path.join(cfg.pretrained_roberta_dir, "checkpoint_best.pt")
+        self.train_subset = cfg.train_subset
+        self.teacher_cache = None
+        if cfg.batched_txt_augment:
+            self.txt_augmenter = BatchedTextAugment(self.target_dictionary, seed=cfg.seed)
+        else:
+            self.txt_augmenter = None
+
+    def required_aux_outputs(self):
+        """Auxiliary encoder outputs (see
+        :func:`~fairseq.models.wav2vec.wav2vec2_asr.Wav2VecEncoder.set_aux_outputs`)
+        consumed by this criterion: the distillation branch only runs in
+        training."""
+        if self.model_lm is not None and self.training:
+            return ("encoder_out_kd",)
+        return ()
 
     def lm_forward(self, tokens_tensor, model_lm, num_layer=-9):
         # num_layer: -1 ~ -13
@@ -177,6 +267,82 @@ class CtcCriterionSdtKD(FairseqCriterion):
         # logits=model_lm.model.forward(tokens_tensor)[0].detach()
         return logits[0].detach(), logits[1]["inner_states"][num_layer].detach().transpose(0,1)
 
+    def get_teacher_cache(self):
+        """Lazily opens the teacher cache of the training subset; its layout
+        is derived from the target lengths of the dataset."""
+        if self.teacher_cache is None:
+            dataset = self.task.dataset(self.train_subset)
+            # measured once by AddTargetDataset, rather than re-tokenizing
+            # every label here
+            sizes = getattr(dataset, "get_label_sizes", lambda: None)()
+            if sizes is None:
+                sizes = [dataset.size(i)[1] for i in range(len(dataset))]
+            sizes = np.asarray(sizes, dtype=np.int64)
+            embed_dim = self.model_lm.model.encoder.sentence_encoder.embed_tokens.embedding_dim
+            fingerprint = hashlib.md5(sizes.tobytes())
+            fingerprint.update(
+                f"{os.path.abspath(self.teacher_checkpoint)}:"
+                f"{os.path.getmtime(self.teacher_checkpoint)}:"
+                f"{self.teacher_layer}".encode()
+            )
+            self.teacher_cache = MMapFeatureCache(
+                os.path.join(
+                    self.teacher_cache_dir,
+                    f"{self.train_subset}.layer{self.teacher_layer}",
+                ),
+                sizes,
+                feature_shape=(embed_dim,),
+                dtype=self.teacher_cache_dtype,
+                fingerprint=fingerprint.hexdigest(),
+            )
+            logger.info(
+                f"teacher cache: {self.teacher_cache.num_filled}/{len(sizes)} "
+                f"references cached at {self.teacher_cache.path}"
+            )
+        return self.teacher_cache
+
+    def cached_lm_forward(self, sample):
+        """Teacher embeddings (B,T,f) of the reference ``sample["target"]``,
+        read from the teacher cache where possible; missing entries are
+        computed with a single teacher forward and written to the cache.
+
+        Padded positions of cached rows are zero; they are masked out by
+        every consumer of the embeddings."""
+        cache = self.get_teacher_cache()
+        tokens, lengths = sample["target"], sample["target_lengths"].tolist()
+        ids = sample["id"].tolist()
+        hits = [i for i, idx in enumerate(ids) if idx in cache]
+        misses = [i for i, idx in enumerate(ids) if idx not in cache]
+
+        embed = None
+        if len(misses) > 0:
+            _, embed_miss = self.lm_forward(tokens[misses], self.model_lm, num_layer=self.teacher_layer)
+            embed = embed_miss.new_zeros(tokens.size() + embed_miss.size()[-1:])
+            embed[misses] = embed_miss
+            embed_miss = embed_miss.float().cpu().numpy()
+            for j, i in enumerate(misses):
+                cache[ids[i]] = embed_miss[j, : lengths[i]]
+
+        nbytes = 0
+        if len(hits) > 0:
+            cached = np.zeros(
+                (len(hits), tokens.size(1)) + cache.feature_shape, dtype=cache.dtype
+            )
+            for j, i in enumerate(hits):
+                cached[j, : lengths[i]] = cache[ids[i]]
+                nbytes += cache.entry_nbytes(ids[i])
+            cached = torch.from_numpy(cached).to(tokens.device)
+            if embed is None:
+                embed = cached.new_zeros(tokens.size() + cached.size()[-1:], dtype=torch.float)
+            embed[hits] = cached.to(embed.dtype)
+
+        stats = {
+            "teacher_cache_hits": len(hits),
+            "teacher_cache_misses": len(misses),
+            "teacher_cache_bytes": nbytes,
+        }
+        return embed, stats
+
     def lm_forward_roberta(self, lines, model_lm, num_layer=-1):
         # logits:
         #torch.Size([8, 240, 33]),  # (00)output layer (33: num letters)
@@ -195,7 +361,238 @@ class CtcCriterionSdtKD(FairseqCriterion):
         logits=model_lm.model.forward(new_lines, return_all_hiddens=True)
         return logits[0].detach(), logits[1]["inner_states"][-1].detach().transpose(0,1), mask
 
-    def txt_augment(self, txt, target_length, dict, num_aug=1):
+    def _spaced_tokens(self, tokens):
+        # Interleave tokens with a spacer id so that the token-level edit
+        # distance equals the character-level distance between the
+        # ``Dictionary.string`` outputs of letter (single character) targets.
+        not_pad = tokens.ne(self.pad_idx)
+        lengths = not_pad.long().sum(-1)
+        # move any non-trailing padding out of the way, as ``.replace(' <pad>','')`` did
+        tokens = tokens.gather(1, torch.sort((~not_pad).long(), dim=-1, stable=True).indices)
+        spaced = tokens.new_full((tokens.size(0), max(2 * tokens.size(1) - 1, 0)), len(self.target_dictionary))
+        spaced[:, ::2] = tokens
+        return spaced, (2 * lengths - 1).clamp(min=0)
+
+    def levenshtein_matrix(self, reference, hypotheses, normalize=True):
+        """B x K edit distances between the rows of *reference* (B x T) and
+        the same rows of each of the K tensors in *hypotheses*, in one batched
+        call. With *normalize*, distances are divided by the longer string."""
+        ref, ref_lens = self._spaced_tokens(reference)
+        hyps, hyp_lens = zip(*[self._spaced_tokens(h) for h in hypotheses])
+        width = max(h.size(1) for h in hyps)
+        hyps = torch.cat([F.pad(h, (0, width - h.size(1)), value=self.pad_idx) for h in hyps])
+        hyp_lens = torch.cat(hyp_lens)
+        ref_lens = ref_lens.repeat(len(hypotheses))
+
+        dist = batch_edit_distance(hyps, hyp_lens, ref.repeat(len(hypotheses), 1), ref_lens).float()
+        if normalize:
+            dist = dist / torch.maximum(ref_lens, hyp_lens).clamp(min=1)
+        return dist.view(len(hypotheses), -1).t()
+
+    @staticmethod
+    def batched_mas(scores, text_lengths):
+        """Monotonic alignment search over a batch of padded score matrices
+        (N x T x T'); row ``i`` is aligned over its first ``text_lengths[i]``
+        text positions and all T' frames, exactly as ``mas`` on the unpadded
+        matrix would.
+
+        The public ``mas`` aligns every row over the full padded width, so
+        this calls its kernel ``aligner_pytorch.mas_c.compute_mas_alignement``
+        directly (as ``mas`` does), with per-row lengths. The kernel fills
+        ``paths`` in place and takes C-contiguous numpy buffers:
+        ``paths`` (N x T x T', int32, zeros), ``values`` (N x T x T', float32,
+        overwritten), ``ms`` (N, int32 text lengths) and ``ns`` (N, int32
+        frame counts). If the kernel cannot be imported, each row is aligned
+        with ``mas`` on its unpadded matrix instead."""
+        try:
+            from aligner_pytorch.mas_c import compute_mas_alignement
+        except ImportError:
+            paths = torch.zeros_like(scores, dtype=torch.int32)
+            for i, m in enumerate(text_lengths.tolist()):
+                paths[i, :m] = mas(scores[i : i + 1, :m])[0]
+            return paths
+
+        values = scores.detach().to(device="cpu", dtype=torch.float32, copy=True).contiguous().numpy()
+        paths = np.zeros(values.shape, dtype=np.int32)
+        ms = text_lengths.to(device="cpu", dtype=torch.int32).contiguous().numpy()
+        ns = np.full(values.shape[0], values.shape[2], dtype=np.int32)
+        compute_mas_alignement(paths, values, ms, ns)
+        return torch.from_numpy(paths).to(device=scores.device)
+
+    def score_negatives(
+        self,
+        sample,
+        noisy_target,
+        encoder_out_kd,
+        encoder_out_kd_mask,
+        encoder_out_kd_mask2,
+        encoder_masking,
+        max_projection_axis="mas",
+        print_option=False,
+    ):
+        """Scores the reference (``noisy_target[0]``) and every negative
+        against the speech embeddings.
+
+        All K targets are right-padded to a common width and scored with a
+        single (K*B) x T teacher forward, one batched matmul against
+        *encoder_out_kd* and one monotonic alignment call. Every target keeps
+        its own width in the alignment and the averages, so the scores match
+        :func:`score_negatives_loop`.
+
+        Returns:
+            tuple: score matrix (B x K), numerator embeddings (B x T x f),
+            numerator alignment, numerator word-wise scores and the teacher
+            cache statistics
+        """
+        pad = self.target_dictionary.pad()
+        num_targets, bsz = len(noisy_target), noisy_target[0].size(0)
+        widths = torch.tensor([t.size(1) for t in noisy_target], device=encoder_out_kd.device)
+        max_width, ref_width = int(widths.max()), noisy_target[0].size(1)
+        tokens = torch.cat([F.pad(t, (0, max_width - t.size(1)), value=pad) for t in noisy_target]) # K*B x T
+
+        teacher_cache_stats = {}
+        if self.teacher_cache_dir is not None:
+            # the reference never changes across epochs
+            embed_ref, teacher_cache_stats = self.cached_lm_forward(sample) # B,T,f
+            _, embed = self.lm_forward(tokens[bsz:], self.model_lm, num_layer=self.teacher_layer)
+            embed_ref = F.pad(embed_ref, (0, 0, 0, max_width - ref_width)).to(embed.dtype)
+            embed = torch.cat([embed_ref, embed])
+        else:
+            _, embed = self.lm_forward(tokens, self.model_lm, num_layer=self.teacher_layer) # K*B,T,f
+        embed = embed.view(num_targets, bsz, max_width, -1)
+        target_mask = tokens.ne(pad).view(num_targets, bsz, max_width)
+
+        speech = (encoder_out_kd.transpose(0,1)*encoder_out_kd_mask).transpose(1,2) # B,f,T'
+        score_mat_negative = torch.matmul(embed, speech) * target_mask.unsqueeze(-1) # K,B,T,T'
+
+        # noisy_target[0] is true label (numerator)
+        embed_numerator = embed[0, :, :ref_width].clone().detach() # True label: numerator
+        score_numerator = score_mat_negative[0, :, :ref_width]
+        align_numerator = score_numerator.transpose(1,2).max(-1).indices # to check alignment between ctc&lm
+        score_mat_negative_word_wise = score_numerator.max(-1).values * target_mask[0, :, :ref_width] # B x T
+        score_mat_negative_word_wise = score_mat_negative_word_wise / score_mat_negative_word_wise.sum(1).unsqueeze(1) # B x T (normalize)
+
+        if max_projection_axis == 'speech' or print_option:
+            # rows beyond a target's own width did not exist in the per-target loop
+            beyond_width = (torch.arange(max_width, device=widths.device) >= widths.unsqueeze(-1)) # K x T
+            score_mat_speech = score_mat_negative.masked_fill(
+                beyond_width[:, None, :, None], float("-inf")
+            ).max(2).values # K x B x T'
+            if encoder_masking:
+                # average
+                score_mat_speech = ((score_mat_speech * encoder_out_kd_mask2).sum(-1) / encoder_out_kd_mask2.sum(-1)) # K x B
+            else:
+                # average
+                score_mat_speech = ((score_mat_speech).sum(-1) / score_mat_speech.size(-1))  # K x B
+
+        if max_projection_axis=='speech':
+            score_mat = score_mat_speech
+        elif max_projection_axis == 'text':
+            # max & average
+            score_mat = score_mat_negative.max(-1).values # K x B x T
+            score_mat = (score_mat*target_mask).sum(-1) / target_mask.sum(-1) # K x B
+        elif max_projection_axis == 'mas':
+            masks = self.batched_mas(
+                score_mat_negative.flatten(0, 1), widths.repeat_interleave(bsz)
+            ).view_as(score_mat_negative) # K x B x T x T'
+            score_mat = (score_mat_negative * masks).sum(-1)
+            score_mat = (score_mat * target_mask).sum(-1) / widths.unsqueeze(-1) # K x B (mean over each width)
+
+            if print_option:
+                print('score_mat_neg mas:', score_mat)
+                print('score_mat_neg max:', score_mat_speech.sum(-1))
+                print('mask 1, mas text:', torch.argmax(masks[0, 0, :ref_width], dim=-1))
+                print('mask 2, max text:', score_numerator.max(-1).indices[0])
+                print('mask 1, mas speech:', torch.argmax(masks[0, 0, :ref_width].transpose(0,1), dim=-1))
+                print('mask 2, max speech:', align_numerator[0])
+
+        return score_mat.t(), embed_numerator, align_numerator, score_mat_negative_word_wise, teacher_cache_stats
+
+    def score_negatives_loop(
+        self,
+        sample,
+        noisy_target,
+        encoder_out_kd,
+        encoder_out_kd_mask,
+        encoder_out_kd_mask2,
+        encoder_masking,
+        max_projection_axis="mas",
+        print_option=False,
+    ):
+        """Reference implementation of :func:`score_negatives` that runs the
+        teacher, the matmul and the alignment once per entry of *noisy_target*."""
+        teacher_cache_stats = {}
+        # score matrix for noise target (B x T')
+        for idx in range(len(noisy_target)):
+            roberta=False
+            if roberta:
+                # use roberta base (that doesn't share vocabulary)
+                lines = self.target_dictionary.string(noisy_target[idx])
+                logits, embed_denominator, target_mask_tmp = self.lm_forward_roberta(lines, self.model_lm)
+            else:
+                # use masked LM that share the same vocabulary (letter voca)
+                if idx == 0 and self.teacher_cache_dir is not None:
+                    # the reference never changes across epochs
+                    embed_denominator, teacher_cache_stats = self.cached_lm_forward(sample) # B,T,f
+                else:
+                    logits, embed_denominator = self.lm_forward(noisy_target[idx], self.model_lm, num_layer=self.teacher_layer) # B,T,f
+                target_mask_tmp = (noisy_target[idx] != self.target_dictionary.pad()) # 1 is the padding idx, B x T
+            score_mat_negative = torch.matmul(embed_denominator, (encoder_out_kd.transpose(0,1)*encoder_out_kd_mask).transpose(1,2)) * target_mask_tmp.unsqueeze(-1) # B,T,T'
+            if idx == 0:
+                # noisy_target[0] is true label (numerator)
+                embed_numerator = embed_denominator.clone().detach() # True label: numerator
+                align_numerator = score_mat_negative.transpose(1,2).max(-1).indices # to check alignment between ctc&lm
+                score_mat_negative_word_wise = score_mat_negative.max(-1).values * target_mask_tmp # B x T
+                score_mat_negative_word_wise = score_mat_negative_word_wise / score_mat_negative_word_wise.sum(1).unsqueeze(1) # B x T (normalize)
+
+            if max_projection_axis=='speech':
+                # max
+                score_mat_negative = score_mat_negative.transpose(1,2).max(-1).values # B x T'
+                if encoder_masking:
+                    # average
+                    score_mat_negative = ((score_mat_negative * encoder_out_kd_mask2).sum(1) / encoder_out_kd_mask2.sum(-1)) # B
+                else:
+                    # average
+                    score_mat_negative = ((score_mat_negative).sum(1) / score_mat_negative.size(-1))  # B
+            elif max_projection_axis == 'text':
+                # max & average (max_projection_axis == 'text')
+                score_mat_negative = score_mat_negative.max(-1).values # B x T
+                score_mat_negative = (score_mat_negative*target_mask_tmp).sum(1) / target_mask_tmp.sum(-1) # B
+            elif max_projection_axis == 'mas':
+                if print_option:
+                    score_mat_negative2 = score_mat_negative.transpose(1,2).max(-1).values # B x T'
+                    if encoder_masking:
+                        # average
+                        score_mat_negative2 = ((score_mat_negative2 * encoder_out_kd_mask2).sum(1) / encoder_out_kd_mask2.sum(-1)) # B
+                    else:
+                        # average
+                        score_mat_negative2 = ((score_mat_negative2).sum(1) / score_mat_negative2.size(-1))  # B
+                    score_mat_negative2_position1 = score_mat_negative.transpose(1,2).max(-1).indices # B x T'
+                    score_mat_negative2_position2 = score_mat_negative.max(-1).indices # B x T'
+                masks = mas(score_mat_negative) # B x T' x T
+
+                # target_mask_tmp # B x T
+                # print('target_mask_tmp:', target_mask_tmp.size()) # target_mask_tmp: torch.Size([8, 248])
+                # raise ValueError('score_mat_negative:', score_mat_negative.size()) # torch.Size([8, 248, 778])
+                score_mat_negative = (score_mat_negative * masks).sum(-1)
+                score_mat_negative = (score_mat_negative * target_mask_tmp).mean(-1)
+
+                if print_option:
+                    print('score_mat_neg mas:', score_mat_negative)
+                    print('score_mat_neg max:', score_mat_negative2.sum(-1))
+                    print('mask 1, mas text:', torch.argmax(masks[0], dim=-1))
+                    print('mask 2, max text:', score_mat_negative2_position2[0])
+                    print('mask 1, mas speech:', torch.argmax(masks[0].transpose(0,1), dim=-1))
+                    print('mask 2, max speech:', score_mat_negative2_position1[0])
+            if idx == 0:
+                score_mat = score_mat_negative.unsqueeze(-1) # B,#aug
+            else:
+                score_mat = torch.cat((score_mat, score_mat_negative.unsqueeze(-1)), dim=-1) # B,#aug
+
+        return score_mat, embed_numerator, align_numerator, score_mat_negative_word_wise, teacher_cache_stats
+
+    @staticmethod
+    def txt_augment(txt, target_length, dict, num_aug=1):
         def partial_shuffle(lst, imin, imax):
             lst[imin:imax] = sorted(lst[imin:imax], key=lambda x: random.random())
             return lst
@@ -264,9 +661,15 @@ class CtcCriterionSdtKD(FairseqCriterion):
     def forward(self, model, sample, reduce=True, **kwargs):
         net_output = model(**sample["net_input"], target=sample["target"])
         # raise ValueError('net otutput:', net_output)
-        lprobs = model.get_normalized_probs(
-            net_output, log_probs=True
-        ).contiguous()  # (T, B, C) from the encoder
+        if self.ctc_chunk_size > 0 and hasattr(model, "get_logits"):
+            # normalized by the loss, chunk by chunk
+            lprobs = None
+            ctc_logits = model.get_logits(net_output)
+        else:
+            lprobs = model.get_normalized_probs(
+                net_output, log_probs=True
+            ).contiguous()  # (T, B, C) from the encoder
+            ctc_logits = lprobs
 
         # CTC loss is calculated over duplicated inputs
         # sample is already duplicated for R-Drop
@@ -294,8 +697,8 @@ class CtcCriterionSdtKD(FairseqCriterion):
                 non_padding_mask = ~net_output["padding_mask"]
                 input_lengths = non_padding_mask.long().sum(-1)
             else:
-                input_lengths = lprobs.new_full(
-                    (lprobs.size(1),), lprobs.size(0), dtype=torch.long
+                input_lengths = ctc_logits.new_full(
+                    (ctc_logits.size(1),), ctc_logits.size(0), dtype=torch.long
                 )
 
         pad_mask = (sample["target"] != self.pad_idx) & (
@@ -307,19 +710,35 @@ class CtcCriterionSdtKD(FairseqCriterion):
         else:
             target_lengths = pad_mask.sum(-1)
 
-        with torch.backends.cudnn.flags(enabled=False):
-            loss = F.ctc_loss(
-                lprobs,
+        if self.ctc_chunk_size > 0:
+            # fairseq.modules cannot be imported before fairseq.models
+            from fairseq.modules import chunked_ctc_loss
+
+            loss = chunked_ctc_loss(
+                ctc_logits,
                 targets_flat,
                 input_lengths,
                 target_lengths,
                 blank=self.blank_idx,
                 reduction="sum",
                 zero_infinity=self.zero_infinity,
+                chunk_size=self.ctc_chunk_size,
             )
+        else:
+            with torch.backends.cudnn.flags(enabled=False):
+                loss = F.ctc_loss(
+                    lprobs,
+                    targets_flat,
+                    input_lengths,
+                    target_lengths,
+                    blank=self.blank_idx,
+                    reduction="sum",
+                    zero_infinity=self.zero_infinity,
+                )
 
 
         num_update = model.get_num_updates()
+        teacher_cache_stats = {}
         if self.model_lm is not None and self.training and num_update > -1:
             if torch.randperm(3000)[0] == 0:
                 print_option=True
@@ -358,13 +777,16 @@ class CtcCriterionSdtKD(FairseqCriterion):
                 encoder_masking = False
 
             # text data augmentation1 (insertion/deletion/swap error)
-            noisy_target = self.txt_augment(sample["target"], sample["target_lengths"], self.target_dictionary, num_aug=1) # noise_type+1 x B x T
+            if self.txt_augmenter is not None:
+                noisy_target = self.txt_augmenter(sample["target"], sample["target_lengths"], num_aug=1, step=num_update) # noise_type+1 x B x T
+            else:
+                noisy_target = self.txt_augment(sample["target"], sample["target_lengths"], self.target_dictionary, num_aug=1) # noise_type+1 x B x T
 
             # text data augmentation2 (LM based perturbation)
             lm_based_aug = False
             if lm_based_aug:
                 rand_idx = torch.randperm(len(noisy_target))[0]
-                logits, _ = self.lm_forward(noisy_target[rand_idx], self.model_lm) 
+                logits, _ = self.lm_forward(noisy_target[rand_idx], self.model_lm, num_layer=self.teacher_layer) 
                 logits = torch.argmax(logits, dim=-1)
                 logits_mask = (noisy_target[rand_idx] == self.target_dictionary.pad()).to(logits.dtype)
                 logits = logits * (1-logits_mask) + logits_mask
@@ -377,89 +799,30 @@ class CtcCriterionSdtKD(FairseqCriterion):
             else:
                 levenshtein=torch.zeros(sample["target"].size(0), len(noisy_target)).to(net_output["encoder_out_kd"].device) # B x #aug
 
-            str_ref = []
-            for idx_batch in range(sample["target"].size(0)):
-                str_line = self.target_dictionary.string(sample["target"][idx_batch]).replace(' <pad>','')
-                str_ref.append(str_line)
+            # get levenshtein distance (column 0 is the reference itself)
+            levenshtein[:, 1:len(noisy_target)] = self.levenshtein_matrix(
+                sample["target"], noisy_target[1:], normalize=use_length_norm_for_editdistance
+            )
 
             max_projection_axis='mas' # 'speech' # 'text'
 
-            # score matrix for noise target (B x T')
-            for idx in range(len(noisy_target)):
-                roberta=False
-                if roberta:
-                    # use roberta base (that doesn't share vocabulary)
-                    lines = self.target_dictionary.string(noisy_target[idx])
-                    logits, embed_denominator, target_mask_tmp = self.lm_forward_roberta(lines, self.model_lm)
-                else:
-                    # use masked LM that share the same vocabulary (letter voca)
-                    logits, embed_denominator = self.lm_forward(noisy_target[idx], self.model_lm) # B,T,f
-                    target_mask_tmp = (noisy_target[idx] != self.target_dictionary.pad()) # 1 is the padding idx, B x T
-                score_mat_negative = torch.matmul(embed_denominator, (net_output["encoder_out_kd"].transpose(0,1)*encoder_out_kd_mask).transpose(1,2)) * target_mask_tmp.unsqueeze(-1) # B,T,T'
-                if idx == 0:
-                    # noisy_target[0] is true label (numerator)
-                    embed_numerator = embed_denominator.clone().detach() # True label: numerator
-                    align_numerator = score_mat_negative.transpose(1,2).max(-1).indices # to check alignment between ctc&lm
-                    score_mat_negative_word_wise = score_mat_negative.max(-1).values * target_mask_tmp # B x T
-                    score_mat_negative_word_wise = score_mat_negative_word_wise / score_mat_negative_word_wise.sum(1).unsqueeze(1) # B x T (normalize)
-
-                if max_projection_axis=='speech':
-                    # max
-                    score_mat_negative = score_mat_negative.transpose(1,2).max(-1).values # B x T'
-                    if encoder_masking:
-                        # average
-                        score_mat_negative = ((score_mat_negative * encoder_out_kd_mask2).sum(1) / encoder_out_kd_mask2.sum(-1)) # B
-                    else:
-                        # average
-                        score_mat_negative = ((score_mat_negative).sum(1) / score_mat_negative.size(-1))  # B
-                elif max_projection_axis == 'text':
-                    # max & average (max_projection_axis == 'text')
-                    score_mat_negative = score_mat_negative.max(-1).values # B x T
-                    score_mat_negative = (score_mat_negative*target_mask_tmp).sum(1) / target_mask_tmp.sum(-1) # B
-                elif max_projection_axis == 'mas':
-                    if print_option:
-                        score_mat_negative2 = score_mat_negative.transpose(1,2).max(-1).values # B x T'
-                        if encoder_masking:
-                            # average
-                            score_mat_negative2 = ((score_mat_negative2 * encoder_out_kd_mask2).sum(1) / encoder_out_kd_mask2.sum(-1)) # B
-                        else:
-                            # average
-                            score_mat_negative2 = ((score_mat_negative2).sum(1) / score_mat_negative2.size(-1))  # B
-                        score_mat_negative2_position1 = score_mat_negative.transpose(1,2).max(-1).indices # B x T'
-                        score_mat_negative2_position2 = score_mat_negative.max(-1).indices # B x T'
-                    masks = mas(score_mat_negative) # B x T' x T
-
-                    # target_mask_tmp # B x T
-                    # print('target_mask_tmp:', target_mask_tmp.size()) # target_mask_tmp: torch.Size([8, 248])
-                    # raise ValueError('score_mat_negative:', score_mat_negative.size()) # torch.Size([8, 248, 778])
-                    score_mat_negative = (score_mat_negative * masks).sum(-1)
-                    score_mat_negative = (score_mat_negative * target_mask_tmp).mean(-1)
-
-                    if print_option:
-                        print('score_mat_neg mas:', score_mat_negative)
-                        print('score_mat_neg max:', score_mat_negative2.sum(-1))
-                        print('mask 1, mas text:', torch.argmax(masks[0], dim=-1))
-                        print('mask 2, max text:', score_mat_negative2_position2[0])
-                        print('mask 1, mas speech:', torch.argmax(masks[0].transpose(0,1), dim=-1))
-                        print('mask 2, max speech:', score_mat_negative2_position1[0])
-                if idx == 0:
-                    score_mat = score_mat_negative.unsqueeze(-1) # B,#aug
-                else:
-                    score_mat = torch.cat((score_mat, score_mat_negative.unsqueeze(-1)), dim=-1) # B,#aug
-
-                    # get levenshtein distance
-                    for idx_batch in range(len(sample["target"])):
-                        str_denom = self.target_dictionary.string(noisy_target[idx][idx_batch]).replace(' <pad>','')
-                        assert levenshtein[idx_batch][idx] == 0
-                        if use_length_norm_for_editdistance:
-                            len_str = max(len(str_ref[idx_batch]), len(str_denom))
-                            levenshtein[idx_batch][idx] = editdistance.eval(str_ref[idx_batch], str_denom) / len_str
-                        else:
-                            levenshtein[idx_batch][idx] = editdistance.eval(str_ref[idx_batch], str_denom)
+            # score matrix for noise target (B x #aug)
+            score_negatives = self.score_negatives if self.batched_teacher_forward else self.score_negatives_loop
+            score_mat, embed_numerator, align_numerator, score_mat_negative_word_wise, teacher_cache_stats = score_negatives(
+                sample,
+                noisy_target,
+                net_output["encoder_out_kd"],
+                encoder_out_kd_mask,
+                encoder_out_kd_mask2,
+                encoder_masking,
+                max_projection_axis=max_projection_axis,
+                print_option=print_option,
+            )
 
             # score matrix for samples in batch
             # for i in range(0, net_output["target_embed"].size(1) - 1):
             if use_batch_samples:
+                batch_sample_targets = []
                 for i in range(0, embed_numerator.size(0) - 1):
                     idx=(torch.arange(embed_numerator.size(0)) - (i+1)) % embed_numerator.size(0)
                     idx=idx.tolist() # [1,2,3,4,5,6,...,B,0]
@@ -480,17 +843,12 @@ class CtcCriterionSdtKD(FairseqCriterion):
                         score_mat_negative = (score_mat_negative*target_mask[idx]).sum(1) / target_mask[idx].sum(-1) # B
 
                     score_mat = torch.cat((score_mat, score_mat_negative.unsqueeze(-1)), dim=-1) # B x #aug
+                    batch_sample_targets.append(sample["target"][idx])
 
-                    # get levenshtein distance
-                    for j in range(embed_numerator.size(0)):
-                        str_denom = str_ref[idx[j]]
-                        assert levenshtein[j][len(noisy_target) + i] == 0
-
-                        if use_length_norm_for_editdistance:
-                            len_str = max(len(str_ref[idx_batch]), len(str_denom))
-                            levenshtein[j][len(noisy_target) + i] = editdistance.eval(str_ref[j], str_denom) / len_str
-                        else:
-                            levenshtein[j][len(noisy_target) + i] = editdistance.eval(str_ref[j], str_denom)
+                # get levenshtein distance
+                levenshtein[:, len(noisy_target):] = self.levenshtein_matrix(
+                    sample["target"], batch_sample_targets, normalize=use_length_norm_for_editdistance
+                )
 
             if use_length_norm_for_editdistance:
                 temperature_lev = 1.5
@@ -531,67 +889,98 @@ class CtcCriterionSdtKD(FairseqCriterion):
             "nsentences": sample["id"].numel(),
             "sample_size": sample_size,
         }
+        logging_output.update(teacher_cache_stats)
 
         if not model.training:
             import editdistance
 
+            if lprobs is None:
+                lprobs = utils.log_softmax(ctc_logits.float(), dim=-1)
+
             with torch.no_grad():
-                lprobs_t = lprobs.transpose(0, 1).float().contiguous().cpu()
-
-                c_err = 0
-                c_len = 0
-                w_errs = 0
-                w_len = 0
-                wv_errs = 0
-                for lp, t, inp_l in zip(
-                    lprobs_t,
+                # greedy decoding of the whole batch on the device
+                pred_tokens, pred_lengths, _, _ = ctc_greedy_decode(
+                    lprobs.transpose(0, 1),
+                    input_lengths,
+                    blank_idx=self.blank_idx,
+                    pad_idx=self.pad_idx,
+                )
+                target = (
                     sample["target_label"]
                     if "target_label" in sample
-                    else sample["target"],
-                    input_lengths,
-                ):
-                    lp = lp[:inp_l].unsqueeze(0)
-
-                    decoded = None
-                    if self.w2l_decoder is not None:
-                        decoded = self.w2l_decoder.decode(lp)
-                        if len(decoded) < 1:
-                            decoded = None
-                        else:
-                            decoded = decoded[0]
-                            if len(decoded) < 1:
-                                decoded = None
-                            else:
-                                decoded = decoded[0]
-
-                    p = (t != self.task.target_dictionary.pad()) & (
-                        t != self.task.target_dictionary.eos()
-                    )
-                    targ = t[p]
-                    targ_units = self.task.target_dictionary.string(targ)
-                    targ_units_arr = targ.tolist()
-
-                    toks = lp.argmax(dim=-1).unique_consecutive()
-                    pred_units_arr = toks[toks != self.blank_idx].tolist()
-
-                    c_err += editdistance.eval(pred_units_arr, targ_units_arr)
-                    c_len += len(targ_units_arr)
+                    else sample["target"]
+                )
+                targ, targ_lengths = pack_tokens(
+                    target,
+                    (target != self.pad_idx) & (target != self.eos_idx),
+                    self.pad_idx,
+                )
+                bsz = targ.size(0)
 
-                    targ_words = post_process(targ_units, self.post_process).split()
+                c_err = (
+                    batch_edit_distance(pred_tokens, pred_lengths, targ, targ_lengths)
+                    .sum()
+                    .item()
+                )
+                c_len = targ_lengths.sum().item()
 
-                    pred_units = self.task.target_dictionary.string(pred_units_arr)
-                    pred_words_raw = post_process(pred_units, self.post_process).split()
+                dictionary = self.task.target_dictionary
 
-                    if decoded is not None and "words" in decoded:
-                        pred_words = decoded["words"]
-                        w_errs += editdistance.eval(pred_words, targ_words)
-                        wv_errs += editdistance.eval(pred_words_raw, targ_words)
-                    else:
-                        dist = editdistance.eval(pred_words_raw, targ_words)
-                        w_errs += dist
-                        wv_errs += dist
+                def to_words(tokens):
+                    units = dictionary.string(tokens)
+                    return post_process(units, self.post_process).split()
 
-                    w_len += len(targ_words)
+                if self.word_separator is not None:
+                    # hypothesis and reference words are numbered together
+                    width = max(pred_tokens.size(1), targ.size(1))
+                    words, word_lengths = batch_word_ids(
+                        torch.cat(
+                            [
+                                F.pad(pred_tokens, (0, width - pred_tokens.size(1))),
+                                F.pad(targ, (0, width - targ.size(1))),
+                            ]
+                        ),
+                        torch.cat([pred_lengths, targ_lengths]),
+                        self.word_separator,
+                        ignore=(dictionary.eos(), dictionary.bos()),
+                    )
+                    wv_dists = batch_edit_distance(
+                        words[:bsz],
+                        word_lengths[:bsz],
+                        words[bsz:],
+                        word_lengths[bsz:],
+                    ).tolist()
+                    w_len = word_lengths[bsz:].sum().item()
+                else:
+                    wv_dists = []
+                    w_len = 0
+                    pred_tokens_cpu, targ_cpu = pred_tokens.cpu(), targ.cpu()
+                    for i in range(bsz):
+                        targ_words = to_words(targ_cpu[i, : targ_lengths[i]])
+                        pred_words_raw = to_words(pred_tokens_cpu[i, : pred_lengths[i]])
+                        wv_dists.append(editdistance.eval(pred_words_raw, targ_words))
+                        w_len += len(targ_words)
+
+                wv_errs = w_errs = sum(wv_dists)
+                if self.w2l_decoder is not None:
+                    lprobs_t = lprobs.transpose(0, 1).float().contiguous().cpu()
+                    targ_cpu = targ.cpu()
+                    w_errs = 0
+                    for i, inp_l in enumerate(input_lengths):
+                        decoded = self.w2l_decoder.decode(
+                            lprobs_t[i, :inp_l].unsqueeze(0)
+                        )
+                        if (
+                            len(decoded) > 0
+                            and len(decoded[0]) > 0
+                            and "words" in decoded[0][0]
+                        ):
+                            targ_words = to_words(targ_cpu[i, : targ_lengths[i]])
+                            w_errs += editdistance.eval(
+                                decoded[0][0]["words"], targ_words
+                            )
+                        else:
+                            w_errs += wv_dists[i]
 
                 logging_output["wv_errors"] = wv_errs
                 logging_output["w_errors"] = w_errs
@@ -635,6 +1024,22 @@ class CtcCriterionSdtKD(FairseqCriterion):
         w_total = sum(log.get("w_total", 0) for log in logging_outputs)
         metrics.log_scalar("_w_total", w_total)
 
+        cache_hits = sum(log.get("teacher_cache_hits", 0) for log in logging_outputs)
+        cache_misses = sum(log.get("teacher_cache_misses", 0) for log in logging_outputs)
+        if cache_hits + cache_misses > 0:
+            metrics.log_scalar("_teacher_cache_hits", cache_hits)
+            metrics.log_scalar("_teacher_cache_misses", cache_misses)
+            metrics.log_derived(
+                "teacher_cache_hit_rate",
+                lambda meters: safe_round(
+                    meters["_teacher_cache_hits"].sum * 100.0
+                    / (meters["_teacher_cache_hits"].sum + meters["_teacher_cache_misses"].sum),
+                    3,
+                ),
+            )
+            cache_bytes = sum(log.get("teacher_cache_bytes", 0) for log in logging_outputs)
+            metrics.log_scalar("teacher_cache_mb", cache_bytes / 2 ** 20, round=1)
+
         if c_total > 0:
             metrics.log_derived(
                 "uer",
@@ -3,9 +3,11 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import numpy as np
 import torch
 
 from . import BaseWrapperDataset, data_utils
+from fairseq.data.audio.binarized_labels import BinarizedLabels
 from fairseq.data.text_compressor import TextCompressor, TextCompressionLevel
 
 
@@ -31,8 +33,13 @@ class AddTargetDataset(BaseWrapperDataset):
         self.label_len_fn = label_len_fn
         self.add_to_input = add_to_input
         self.text_compressor = TextCompressor(level=text_compression_level)
+        # binarized labels are token ids already and know their lengths
+        self.binarized = isinstance(labels, BinarizedLabels)
+        self.label_sizes = labels.sizes if self.binarized else None
 
     def get_label(self, index, process_fn=None):
+        if self.binarized:
+            return self.labels[index]
         lbl = self.labels[index]
         lbl = self.text_compressor.decompress(lbl)
         return lbl if process_fn is None else process_fn(lbl)
@@ -42,11 +49,27 @@ class AddTargetDataset(BaseWrapperDataset):
         item["label"] = self.get_label(index, process_fn=self.process_label)
         return item
 
+    def get_label_sizes(self):
+        """Lengths of all labels, measured once with *label_len_fn* unless
+        the labels are binarized."""
+        if self.label_sizes is None and self.label_len_fn is not None:
+            self.label_sizes = np.fromiter(
+                (self.label_len_fn(self.get_label(i)) for i in range(len(self.labels))),
+                dtype=np.int64,
+                count=len(self.labels),
+            )
+        return self.label_sizes
+
     def size(self, index):
         sz = self.dataset.size(index)
+        if self.label_sizes is not None:
+            return sz, self.label_sizes[index]
         own_sz = self.label_len_fn(self.get_label(index))
         return sz, own_sz
 
+    def num_tokens_vec(self, indices):
+        return self.dataset.num_tokens_vec(indices)
+
     def collater(self, samples):
         collated = self.dataset.collater(samples)
         if len(collated) == 0:
@@ -77,6 +100,24 @@ class AddTargetDataset(BaseWrapperDataset):
         return collated
 
     def filter_indices_by_size(self, indices, max_sizes):
+        if max_sizes is None:
+            return indices, []
+        if isinstance(max_sizes, (tuple, list)) and len(max_sizes) == 2:
+            try:
+                # the audio size is its number of tokens, see RawAudioDataset
+                sizes = self.dataset.num_tokens_vec(indices)
+            except NotImplementedError:
+                sizes = None
+            label_sizes = self.get_label_sizes()
+            if sizes is not None and label_sizes is not None:
+                max_size, max_label_size = max_sizes
+                keep = np.ones(len(indices), dtype=bool)
+                if max_size is not None:
+                    keep &= sizes <= max_size
+                if max_label_size is not None:
+                    keep &= label_sizes[indices] <= max_label_size
+                return indices[keep], indices[~keep].tolist()
+
         indices, ignored = data_utils._filter_by_size_dynamic(
             indices, self.size, max_sizes
         )
@@ -0,0 +1,103 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from fairseq.data.indexed_dataset import MMapIndexedDataset, make_builder
+
+
+def _file_md5(path):
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _dictionary_md5(dictionary):
+    return hashlib.md5("\n".join(dictionary.symbols).encode()).hexdigest()
+
+
+def binarize_labels(label_path, dictionary, output_prefix=None):
+    """Encodes every line of the label file *label_path* (e.g. ``train.ltr``)
+    with *dictionary*, the way ``AudioFinetuningTask`` does on the fly, and
+    writes the token ids to ``{output_prefix}.bin`` and ``{output_prefix}.idx``
+    (by default next to *label_path*, e.g. ``train.ltr.bin``).
+
+    The hashes of the label file and of the dictionary are written to
+    ``{output_prefix}.json``, see :meth:`BinarizedLabels.matches`."""
+    output_prefix = output_prefix or label_path
+    builder = make_builder(
+        output_prefix + ".bin", impl="mmap", vocab_size=len(dictionary)
+    )
+    num_labels = 0
+    with open(label_path, "r") as f:
+        for line in f:
+            builder.add_item(
+                dictionary.encode_line(line, append_eos=False, add_if_not_exist=False)
+            )
+            num_labels += 1
+    builder.finalize(output_prefix + ".idx")
+    with open(output_prefix + ".json", "w") as f:
+        json.dump(
+            {
+                "labels": _file_md5(label_path),
+                "dictionary": _dictionary_md5(dictionary),
+            },
+            f,
+        )
+    return num_labels
+
+
+class BinarizedLabels(object):
+    """Token ids written by :func:`binarize_labels`, read from a memory map.
+
+    The lines of *skipped_indices* (the audio files the dataset skipped) are
+    left out, so labels line up with the dataset. :attr:`sizes` holds the
+    length of every label.
+    """
+
+    def __init__(self, path, skipped_indices=()):
+        self.dataset = MMapIndexedDataset(path)
+        self.indices = None
+        sizes = self.dataset.sizes
+        if len(skipped_indices) > 0:
+            keep = np.ones(len(self.dataset), dtype=bool)
+            keep[list(skipped_indices)] = False
+            self.indices = np.flatnonzero(keep)
+            sizes = sizes[self.indices]
+        self.sizes = sizes.astype(np.int64)
+
+    def __getitem__(self, index):
+        if self.indices is not None:
+            index = self.indices[index]
+        return self.dataset[int(index)]
+
+    def __len__(self):
+        return len(self.sizes)
+
+    @staticmethod
+    def exists(path):
+        return MMapIndexedDataset.exists(path)
+
+    @staticmethod
+    def matches(path, dictionary, label_path=None):
+        """Whether the labels at *path* were binarized from the current
+        content of *label_path* (by default *path*) with *dictionary*. Labels
+        binarized without a ``{path}.json`` sidecar never match."""
+        meta_path = path + ".json"
+        label_path = label_path or path
+        if not (os.path.exists(meta_path) and os.path.exists(label_path)):
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        return meta == {
+            "labels": _file_md5(label_path),
+            "dictionary": _dictionary_md5(dictionary),
+        }
@@ -4,6 +4,7 @@
 # LICENSE file in the root directory of this source tree.
 
 
+import hashlib
 import logging
 import os
 import sys
@@ -15,7 +16,14 @@ import torch
 import torch.nn.functional as F
 
 from .. import FairseqDataset
-from ..data_utils import compute_block_mask_1d, get_buckets, get_bucketed_sizes
+from ..data_utils import (
+    batch_by_size_min_padding,
+    compute_block_mask_1d,
+    get_buckets,
+    get_bucketed_sizes,
+    padding_efficiency,
+)
+from ..mmap_cache import MMapFeatureCache
 from fairseq.data.audio.audio_utils import (
     parse_path,
     read_from_stored_zip,
@@ -47,6 +55,8 @@ class RawAudioDataset(FairseqDataset):
         expand_adjacent: bool = False,
         mask_dropout: float = 0,
         non_overlapping: bool = False,
+        min_padding_batches: bool = False,
+        feature_cache_key: str = None,
     ):
         super().__init__()
 
@@ -72,6 +82,8 @@ class RawAudioDataset(FairseqDataset):
         self.expand_adjacent = expand_adjacent
         self.mask_dropout = mask_dropout
         self.non_overlapping = non_overlapping
+        self.min_padding_batches = min_padding_batches
+        self.feature_cache_key = feature_cache_key
 
     def __getitem__(self, index):
         raise NotImplementedError()
@@ -109,10 +121,6 @@ class RawAudioDataset(FairseqDataset):
 
         return t[slices]
 
-    @staticmethod
-    def _bucket_tensor(tensor, num_pad, value):
-        return F.pad(tensor, (0, num_pad), value=value)
-
     def collater(self, samples):
         samples = [s for s in samples if s["source"] is not None]
         if len(samples) == 0:
@@ -126,35 +134,40 @@ class RawAudioDataset(FairseqDataset):
         else:
             target_size = min(min(sizes), self.max_sample_size)
 
-        collated_sources = sources[0].new_zeros(len(sources), target_size)
-        padding_mask = (
-            torch.BoolTensor(collated_sources.shape).fill_(False) if self.pad else None
+        # allocate the batch at its bucketed width right away, so every
+        # source is copied exactly once
+        width = target_size
+        if hasattr(self, "num_buckets") and self.num_buckets > 0:
+            assert self.pad, "Cannot bucket without padding first."
+            width = max(target_size, *(self._bucketed_sizes[s["id"]] for s in samples))
+
+        # in the main process, take the batch from the cached pinned memory
+        # so that the data loader does not copy it again for pin_memory
+        pin = torch.cuda.is_available() and torch.utils.data.get_worker_info() is None
+        collated_sources = torch.empty(
+            (len(sources), width), dtype=sources[0].dtype, pin_memory=pin
         )
+        cropped = []
         for i, (source, size) in enumerate(zip(sources, sizes)):
-            diff = size - target_size
-            if diff == 0:
-                collated_sources[i] = source
-            elif diff < 0:
-                assert self.pad
-                collated_sources[i] = torch.cat(
-                    [source, source.new_full((-diff,), 0.0)]
-                )
-                padding_mask[i, diff:] = True
+            if size > target_size:
+                source = self.crop_to_max_size(source, target_size)
+                size = target_size
+                cropped.append(i)
             else:
-                collated_sources[i] = self.crop_to_max_size(source, target_size)
+                assert size == target_size or self.pad
+            collated_sources[i, :size] = source
+            collated_sources[i, size:] = 0
 
         input = {"source": collated_sources}
         out = {"id": torch.LongTensor([s["id"] for s in samples])}
+        if self.feature_cache_key is not None:
+            # the conv features of cropped sources are not cached
+            input["feature_cache_key"] = self.feature_cache_key
+            input["feature_cache_ids"] = out["id"].clone()
+            input["feature_cache_ids"][cropped] = -1
         if self.pad:
-            input["padding_mask"] = padding_mask
-
-        if hasattr(self, "num_buckets") and self.num_buckets > 0:
-            assert self.pad, "Cannot bucket without padding first."
-            bucket = max(self._bucketed_sizes[s["id"]] for s in samples)
-            num_pad = bucket - collated_sources.size(-1)
-            if num_pad:
-                input["source"] = self._bucket_tensor(collated_sources, num_pad, 0)
-                input["padding_mask"] = self._bucket_tensor(padding_mask, num_pad, True)
+            lengths = torch.LongTensor(sizes).clamp_(max=target_size)
+            input["padding_mask"] = torch.arange(width) >= lengths.unsqueeze(1)
 
         if "precomputed_mask" in samples[0]:
             target_size = self._get_mask_indices_dims(target_size)
@@ -183,6 +196,14 @@ class RawAudioDataset(FairseqDataset):
     def num_tokens(self, index):
         return self.size(index)
 
+    def num_tokens_vec(self, indices):
+        """Vectorized :func:`num_tokens`, which lets batching skip the
+        per-index callback."""
+        sizes = self.sizes[indices]
+        if self.pad:
+            return sizes
+        return np.minimum(sizes, self.max_sample_size)
+
     def size(self, index):
         """Return an example's size as a float or tuple. This value is used when
         filtering a dataset with ``--max-positions``."""
@@ -225,7 +246,43 @@ class RawAudioDataset(FairseqDataset):
                 f"{self.buckets}"
             )
 
+    def batch_by_size(
+        self,
+        indices,
+        max_tokens=None,
+        max_sentences=None,
+        required_batch_size_multiple=1,
+    ):
+        if self.min_padding_batches:
+            batches = batch_by_size_min_padding(
+                indices,
+                self.num_tokens_vec(indices),
+                max_tokens=max_tokens,
+                max_sentences=max_sentences,
+                required_batch_size_multiple=required_batch_size_multiple,
+            )
+        else:
+            batches = super().batch_by_size(
+                indices,
+                max_tokens=max_tokens,
+                max_sentences=max_sentences,
+                required_batch_size_multiple=required_batch_size_multiple,
+            )
+
+        if self.pad and len(batches) > 0:
+            sizes = np.minimum(self.sizes, self.max_sample_size)
+            padded_sizes = (
+                self._bucketed_sizes if getattr(self, "num_buckets", 0) > 0 else None
+            )
+            logger.info(
+                f"{len(batches)} batches, padding efficiency "
+                f"{padding_efficiency(batches, sizes, padded_sizes):.2%}"
+            )
+        return batches
+
     def filter_indices_by_size(self, indices, max_sizes):
+        # max_positions of audio models is not in samples; long audio is
+        # cropped to max_sample_size instead
         return indices, []
 
 
@@ -242,8 +299,29 @@ class FileAudioDataset(RawAudioDataset):
         num_buckets=0,
         compute_mask=False,
         text_compression_level=TextCompressionLevel.none,
+        audio_cache_dir=None,
+        audio_cache_dtype="int16",
+        min_padding_batches=False,
+        feature_cache_key=None,
         **mask_compute_kwargs,
     ):
+        """
+        Args:
+            audio_cache_dir (str, optional): if set, decoded waveforms are
+                cached in a memory-mapped file in this directory the first
+                time they are read, so that later epochs skip decoding
+            audio_cache_dtype (str, optional): storage type of the cache;
+                "int16" is lossless for 16-bit sources such as LibriSpeech
+                FLAC, "float16" keeps the range of floating point sources
+            min_padding_batches (bool, optional): place the batch boundaries
+                to minimize padding (see
+                :func:`fairseq.data.data_utils.batch_by_size_min_padding`)
+                instead of filling batches greedily
+            feature_cache_key (str, optional): if set, batches carry the
+                indices of their uncropped sources, under which models with a
+                :class:`~fairseq.models.wav2vec.feature_cache.ConvFeatureCache`
+                cache their conv features
+        """
         super().__init__(
             sample_rate=sample_rate,
             max_sample_size=max_sample_size,
@@ -252,6 +330,8 @@ class FileAudioDataset(RawAudioDataset):
             pad=pad,
             normalize=normalize,
             compute_mask=compute_mask,
+            min_padding_batches=min_padding_batches,
+            feature_cache_key=feature_cache_key,
             **mask_compute_kwargs,
         )
 
@@ -290,7 +370,48 @@ class FileAudioDataset(RawAudioDataset):
 
         self.set_bucket_info(num_buckets)
 
-    def __getitem__(self, index):
+        self.audio_cache_path = None
+        self._audio_cache = None
+        if audio_cache_dir is not None:
+            self.audio_cache_path = os.path.join(
+                audio_cache_dir, os.path.splitext(os.path.basename(manifest_path))[0]
+            )
+            self.audio_cache_dtype = np.dtype(audio_cache_dtype)
+            assert self.audio_cache_dtype in [np.int16, np.float16], audio_cache_dtype
+            h = hashlib.md5()
+            with open(manifest_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+            h.update(f"min_sample_size={min_sample_size}".encode())
+            self.audio_cache_fingerprint = h.hexdigest()
+            cache = self.get_audio_cache()
+            logger.info(
+                f"audio cache {self.audio_cache_path}: "
+                f"{cache.num_filled}/{len(cache)} files decoded"
+            )
+
+    def get_audio_cache(self):
+        """Returns the decoded waveform cache, opened once per process (e.g.
+        per data loader worker), or ``None`` if caching is disabled."""
+        if self.audio_cache_path is None:
+            return None
+        if self._audio_cache is None or self._audio_cache_pid != os.getpid():
+            self._audio_cache = MMapFeatureCache(
+                self.audio_cache_path,
+                self.sizes,
+                dtype=self.audio_cache_dtype,
+                fingerprint=self.audio_cache_fingerprint,
+            )
+            self._audio_cache_pid = os.getpid()
+        return self._audio_cache
+
+    def __getstate__(self):
+        # memory maps are reopened by get_audio_cache in the new process
+        state = self.__dict__.copy()
+        state["_audio_cache"] = None
+        return state
+
+    def read_audio(self, index, dtype="float32"):
         import soundfile as sf
 
         fn = self.fnames[index]
@@ -307,7 +428,7 @@ class FileAudioDataset(RawAudioDataset):
         wav = None
         for i in range(retry):
             try:
-                wav, curr_sample_rate = sf.read(path_or_fp, dtype="float32")
+                wav, curr_sample_rate = sf.read(path_or_fp, dtype=dtype)
                 break
             except Exception as e:
                 logger.warning(
@@ -317,8 +438,31 @@ class FileAudioDataset(RawAudioDataset):
 
         if wav is None:
             raise Exception(f"Failed to load {path_or_fp}")
+        return wav, curr_sample_rate
 
-        feats = torch.from_numpy(wav).float()
+    def __getitem__(self, index):
+        cache = self.get_audio_cache()
+        if cache is None:
+            wav, curr_sample_rate = self.read_audio(index)
+        elif index in cache:
+            # zero-copy slice of the memory map
+            wav, curr_sample_rate = cache[index], self.sample_rate
+        else:
+            wav, curr_sample_rate = self.read_audio(
+                index, "int16" if self.audio_cache_dtype == np.int16 else "float32"
+            )
+            if (
+                wav.shape == (self.sizes[index],)
+                and curr_sample_rate == self.sample_rate
+            ):
+                cache[index] = wav
+                wav = cache[index]
+
+        if wav.dtype == np.int16:
+            # same scaling as soundfile's float32 conversion of 16-bit PCM
+            feats = torch.from_numpy(wav.astype(np.float32)).div_(1 << 15)
+        else:
+            feats = torch.from_numpy(wav.astype(np.float32, copy=False))
         feats = self.postprocess(feats, curr_sample_rate)
 
         v = {"id": index, "source": feats}
@@ -355,6 +499,8 @@ class BinarizedAudioDataset(RawAudioDataset):
         normalize=False,
         num_buckets=0,
         compute_mask=False,
+        min_padding_batches=False,
+        feature_cache_key=None,
         **mask_compute_kwargs,
     ):
         super().__init__(
@@ -365,6 +511,8 @@ class BinarizedAudioDataset(RawAudioDataset):
             pad=pad,
             normalize=normalize,
             compute_mask=compute_mask,
+            min_padding_batches=min_padding_batches,
+            feature_cache_key=feature_cache_key,
             **mask_compute_kwargs,
         )
 
@@ -371,6 +371,86 @@ def batch_by_size(
         return batch_fixed_shapes_fast(indices, num_tokens_fn, fixed_shapes_sorted)
 
 
+def batch_by_size_min_padding(
+    indices,
+    num_tokens_vec,
+    max_tokens=None,
+    max_sentences=None,
+    required_batch_size_multiple=1,
+):
+    """
+    Like :func:`batch_by_size`, splits *indices* into batches of consecutive
+    indices, but places the batch boundaries by dynamic programming instead of
+    filling each batch greedily. The result has the fewest batches that satisfy
+    *max_tokens* and *max_sentences* (never more than :func:`batch_by_size`)
+    and, among those, the fewest padding tokens.
+
+    Args:
+        indices (np.array): ordered array of dataset indices
+        num_tokens_vec (np.array): number of tokens of each index in *indices*
+        max_tokens (int, optional): max number of padded tokens in each batch
+            (default: None).
+        max_sentences (int, optional): max number of sentences in each
+            batch (default: None).
+        required_batch_size_multiple (int, optional): require batch size to
+            be less than N or a multiple of N (default: 1).
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    sizes = np.asarray(num_tokens_vec, dtype=np.int64)
+    if len(indices) == 0:
+        return []
+    assert (
+        max_tokens is None or sizes.max() <= max_tokens
+    ), f"Sentences lengths should not exceed max_tokens={max_tokens}"
+
+    max_bsz = len(indices) if max_sentences is None else max_sentences
+    if max_tokens is not None:
+        max_bsz = min(max_bsz, max_tokens // max(sizes.min(), 1))
+    max_bsz = max(max_bsz, 1)
+    bszs = np.arange(1, max_bsz + 1)
+    invalid_bsz = (bszs >= required_batch_size_multiple) & (
+        bszs % required_batch_size_multiple != 0
+    )
+
+    # The real tokens are the same for every split, so minimizing the padded
+    # tokens minimizes padding. A batch costs more than all padded tokens
+    # together, so that the number of batches is minimized first.
+    batch_cost = len(indices) * sizes.max() + 1
+    infinity = np.iinfo(np.int64).max
+    cost = np.zeros(len(indices) + 1, dtype=np.int64)
+    batch_start = np.zeros(len(indices) + 1, dtype=np.int64)
+    for end in range(1, len(indices) + 1):
+        # candidate batches are [end - bsz, end) for bsz = 1, ..., k
+        k = min(end, max_bsz)
+        padded = np.maximum.accumulate(sizes[end - k : end][::-1]) * bszs[:k]
+        candidates = cost[end - k : end][::-1] + padded + batch_cost
+        invalid = invalid_bsz[:k].copy()
+        if max_tokens is not None:
+            invalid |= padded > max_tokens
+        invalid[0] = False
+        candidates[invalid] = infinity
+        best = candidates.argmin()
+        cost[end] = candidates[best]
+        batch_start[end] = end - 1 - best
+
+    boundaries = []
+    end = batch_start[len(indices)]
+    while end > 0:
+        boundaries.append(end)
+        end = batch_start[end]
+    return np.split(indices, boundaries[::-1])
+
+
+def padding_efficiency(batches, sizes, padded_sizes=None):
+    """Fraction of the collated tokens of *batches* that are not padding.
+    *sizes* (and *padded_sizes*, the sizes of the samples when collated, e.g.
+    bucketed) are indexed by dataset index."""
+    padded_sizes = sizes if padded_sizes is None else padded_sizes
+    num_tokens = sum(int(sizes[b].sum()) for b in batches)
+    num_padded = sum(int(padded_sizes[b].max()) * len(b) for b in batches if len(b))
+    return num_tokens / max(num_padded, 1)
+
+
 def post_process(sentence: str, symbol: str):
     if symbol == "sentencepiece":
         sentence = sentence.replace(" ", "").replace("\u2581", " ").strip()
@@ -588,6 +668,110 @@ def compute_mask_indices(
     return mask
 
 
+def _unmask_random(mask: torch.Tensor, num: torch.Tensor) -> torch.Tensor:
+    """Unmasks *num[i]* uniformly chosen masked positions of every row."""
+    keys = torch.rand(mask.shape, device=mask.device).masked_fill_(~mask, 2)
+    order = keys.argsort(dim=-1)
+    drop = torch.arange(mask.size(1), device=mask.device) < num.unsqueeze(1)
+    return mask & ~torch.zeros_like(mask).scatter_(1, order, drop)
+
+
+def compute_mask_indices_batched(
+    shape: Tuple[int, int],
+    padding_mask: Optional[torch.Tensor],
+    mask_prob: float,
+    mask_length: int,
+    mask_type: str = "static",
+    mask_other: float = 0.0,
+    min_masks: int = 0,
+    require_same_masks: bool = True,
+    mask_dropout: float = 0.0,
+    device: Optional[torch.device] = None,
+) -> torch.Tensor:
+    """
+    Samples the same span masks as :func:`compute_mask_indices` (without
+    *no_overlap*) for all rows at once, with torch on *device* (by default
+    the device of *padding_mask*).
+
+    Span starts are drawn without replacement by taking the smallest of
+    random keys, spans are painted with a cumulative sum over their
+    boundaries, and masks are removed for *require_same_masks* and
+    *mask_dropout* by the same random ranking. Sampling uses the torch RNG.
+
+    Returns:
+        a `(bsz, tsz)` boolean tensor
+    """
+    bsz, all_sz = shape
+    if device is None:
+        device = padding_mask.device if padding_mask is not None else "cpu"
+    if padding_mask is not None:
+        sz = all_sz - padding_mask.to(device).long().sum(-1)
+    else:
+        sz = torch.full((bsz,), all_sz, dtype=torch.long, device=device)
+
+    num_mask = (
+        # add a random number for probabilistic rounding
+        mask_prob * sz / float(mask_length)
+        + torch.rand(bsz, device=device)
+    ).long()
+    num_mask.clamp_(min=min_masks)
+    max_masks = min(int(num_mask.max()), all_sz)
+    positions = torch.arange(all_sz, device=device)
+    spans = positions[:max_masks] < num_mask.unsqueeze(1)
+
+    span_shape = (bsz, max_masks)
+    if mask_type == "static":
+        lengths = torch.full(span_shape, mask_length, device=device)
+    elif mask_type == "uniform":
+        lengths = torch.randint(
+            int(mask_other), mask_length * 2 + 1, span_shape, device=device
+        )
+    elif mask_type == "normal":
+        lengths = torch.normal(
+            float(mask_length), float(mask_other), span_shape, device=device
+        )
+        lengths = lengths.round().clamp_(min=1)
+    elif mask_type == "poisson":
+        lengths = torch.full(span_shape, float(mask_length), device=device)
+        lengths = torch.poisson(lengths)
+    else:
+        raise Exception("unknown mask selection " + mask_type)
+    lengths = lengths.long() * spans
+
+    # rows whose spans all have length 0 get a single span instead
+    empty = (lengths.sum(-1) == 0) & (num_mask > 0)
+    if max_masks > 0 and empty.any():
+        lengths[:, 0] = torch.where(
+            empty, (sz - 1).clamp(max=mask_length), lengths[:, 0]
+        )
+        spans[:, 1:] &= ~empty.unsqueeze(1)
+        lengths *= spans
+
+    min_len = lengths.masked_fill(~spans, all_sz).min(-1).values
+    min_len = torch.where(sz - min_len <= num_mask, sz - num_mask - 1, min_len)
+    num_starts = (sz - min_len).clamp(1, all_sz)
+    keys = torch.rand(bsz, all_sz, device=device)
+    keys.masked_fill_(positions >= num_starts.unsqueeze(1), 2)
+    starts = keys.topk(max_masks, dim=-1, largest=False).indices
+    ends = torch.minimum(starts + lengths, sz.unsqueeze(1))
+
+    boundaries = torch.zeros(bsz, all_sz + 1, dtype=torch.long, device=device)
+    boundaries.scatter_add_(1, starts, spans.long())
+    boundaries.scatter_add_(1, ends, -spans.long())
+    mask = boundaries[:, :all_sz].cumsum(-1) > 0
+
+    num_masked = mask.sum(-1)
+    if (num_masked >= sz).any():
+        raise ValueError("the entire sequence is masked")
+
+    if require_same_masks:
+        mask = _unmask_random(mask, num_masked - num_masked.min())
+    if mask_dropout > 0:
+        num_masked = mask.sum(-1)
+        mask = _unmask_random(mask, (num_masked * mask_dropout).round().long())
+    return mask
+
+
 def compute_block_mask_2d(
     shape: Tuple[int, int],
     mask_prob: float,
@@ -872,6 +1056,194 @@ def lengths_to_mask(lens):
     return ~lengths_to_padding_mask(lens)
 
 
+def batch_edit_distance(
+    hyps: torch.Tensor,
+    hyp_lens: torch.Tensor,
+    refs: torch.Tensor,
+    ref_lens: torch.Tensor,
+) -> torch.Tensor:
+    """Levenshtein distance between every row of *hyps* and the same row of
+    *refs*, computed on the tensors' device.
+
+    Rows are processed in parallel; the DP iterates over the reference axis
+    and resolves the insertion chain of each row with a cumulative minimum,
+    so it takes ``refs.size(1)`` vectorized steps.
+
+    Args:
+        hyps (LongTensor): padded hypotheses of shape `(N, T_hyp)`
+        hyp_lens (LongTensor): hypothesis lengths of shape `(N,)`
+        refs (LongTensor): padded references of shape `(N, T_ref)`
+        ref_lens (LongTensor): reference lengths of shape `(N,)`
+
+    Returns:
+        LongTensor: edit distances of shape `(N,)`, identical to
+        ``editdistance.eval(hyp[:hyp_len].tolist(), ref[:ref_len].tolist())``
+    """
+    assert hyps.size(0) == refs.size(0)
+    device = hyps.device
+    hyp_lens = hyp_lens.to(device).long()
+    ref_lens = ref_lens.to(device).long()
+    steps = torch.arange(hyps.size(1) + 1, device=device)
+
+    dist = steps.unsqueeze(0).repeat(hyps.size(0), 1)
+    out = hyp_lens.clone()
+    max_ref_len = int(ref_lens.max()) if ref_lens.numel() > 0 else 0
+    for i in range(1, min(refs.size(1), max_ref_len) + 1):
+        cost = hyps.ne(refs[:, i - 1 : i]).long()
+        best = torch.minimum(dist[:, 1:] + 1, dist[:, :-1] + cost)
+        best = torch.cat([best.new_full((best.size(0), 1), i), best], dim=1)
+        dist = (best - steps).cummin(dim=1).values + steps
+        out = torch.where(
+            ref_lens == i, dist.gather(1, hyp_lens.unsqueeze(1)).squeeze(1), out
+        )
+    return out
+
+
+def ctc_greedy_decode(
+    emissions: torch.Tensor,
+    input_lengths: Optional[torch.Tensor] = None,
+    blank_idx: int = 0,
+    pad_idx: int = 1,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Best-path CTC decoding of a batch on the emissions' device: frame-wise
+    argmax, then repeated labels are collapsed and blanks removed with masks.
+
+    Args:
+        emissions (Tensor): scores of shape `(B, T, C)`
+        input_lengths (LongTensor, optional): number of valid frames per row
+        blank_idx (int, optional): CTC blank (default: 0)
+        pad_idx (int, optional): padding of the returned tokens (default: 1)
+
+    Returns:
+        tuple:
+            - tokens (LongTensor): right-padded hypotheses of shape `(B, N)`
+            - lengths (LongTensor): hypothesis lengths of shape `(B,)`
+            - timesteps (LongTensor): first frame of every token, padded with
+              -1, of shape `(B, N)`
+            - scores (Tensor): sum of the best score of every valid frame, of
+              shape `(B,)`
+    """
+    bsz, tsz, _ = emissions.shape
+    best_scores, best = emissions.max(dim=-1)
+    frames = torch.arange(tsz, device=emissions.device).expand(bsz, tsz)
+    if input_lengths is None:
+        valid = torch.ones_like(best, dtype=torch.bool)
+    else:
+        valid = frames < input_lengths.to(emissions.device).unsqueeze(1)
+
+    keep = valid & best.ne(blank_idx)
+    keep[:, 1:] &= best[:, 1:].ne(best[:, :-1])
+    lengths = keep.long().sum(-1)
+
+    max_len = int(lengths.max()) if bsz > 0 else 0
+    # kept frames go to their rank in the row, dropped ones to a spill column
+    dest = torch.where(keep, keep.long().cumsum(-1) - 1, max_len)
+    tokens = best.new_full((bsz, max_len + 1), pad_idx)
+    tokens.scatter_(1, dest, best)
+    timesteps = frames.new_full((bsz, max_len + 1), -1)
+    timesteps.scatter_(1, dest, frames)
+    scores = best_scores.masked_fill(~valid, 0).sum(-1)
+    return tokens[:, :max_len], lengths, timesteps[:, :max_len], scores
+
+
+def pack_tokens(
+    tokens: torch.Tensor, keep: torch.Tensor, pad_idx: int = 1
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Moves the tokens selected by the boolean mask *keep* to the front of
+    their row, in order, and pads the rest of the row with *pad_idx*.
+
+    Returns:
+        tuple: packed tokens of the same shape as *tokens* and the number of
+        kept tokens per row
+    """
+    lengths = keep.long().sum(-1)
+    order = (~keep).to(torch.uint8).sort(dim=-1, stable=True).indices
+    packed = tokens.gather(-1, order)
+    positions = torch.arange(tokens.size(-1), device=tokens.device)
+    packed.masked_fill_(positions >= lengths.unsqueeze(-1), pad_idx)
+    return packed, lengths
+
+
+def letter_word_separator(dictionary, symbol: str) -> Optional[int]:
+    """Index of the ``|`` word separator if ``post_process(dictionary.string(
+    tokens), symbol).split()`` can be computed on token ids with
+    :func:`batch_word_ids`, else None.
+
+    That is the case for *symbol* "letter" when no symbol printed by
+    :func:`Dictionary.string` is empty, contains whitespace or a ``|``, or is
+    a prefix of another one, so that equal words have equal spellings.
+    """
+    if symbol != "letter" or "|" not in dictionary.indices:
+        return None
+    separator = dictionary.index("|")
+    printed = [
+        s
+        for i, s in enumerate(dictionary.symbols)
+        if i not in (dictionary.eos(), dictionary.bos(), separator)
+    ]
+    if any("|" in s or s.split() != [s] for s in printed):
+        return None
+    printed.sort()
+    if any(b.startswith(a) for a, b in zip(printed, printed[1:])):
+        return None
+    return separator
+
+
+def batch_word_ids(
+    tokens: torch.Tensor,
+    lengths: torch.Tensor,
+    separator: int,
+    ignore: Tuple[int, ...] = (),
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Splits every row of *tokens* into words at *separator* tokens, on the
+    tensors' device, and numbers the words so that equal spellings get the
+    same id across the whole batch.
+
+    Tokens in *ignore* are dropped before splitting; empty words (leading,
+    trailing or repeated separators) are skipped, like ``str.split()``.
+
+    Args:
+        tokens (LongTensor): padded rows of shape `(N, T)`
+        lengths (LongTensor): row lengths of shape `(N,)`
+        separator (int): word separator index
+        ignore (tuple, optional): token indices to drop
+
+    Returns:
+        tuple:
+            - words (LongTensor): word ids of shape `(N, W)`, padded with -1
+            - word_lengths (LongTensor): number of words per row
+    """
+    num_rows, num_tokens = tokens.shape
+    positions = torch.arange(num_tokens, device=tokens.device)
+    keep = positions < lengths.to(tokens.device).unsqueeze(1)
+    for idx in ignore:
+        keep &= tokens.ne(idx)
+    # padding with separators ends the last word of every row
+    tokens, _ = pack_tokens(tokens, keep, separator)
+
+    letter = tokens.ne(separator)
+    start = letter.clone()
+    start[:, 1:] &= ~letter[:, :-1]
+    word_lengths = start.long().sum(-1)
+    max_words = int(word_lengths.max()) if num_rows > 0 else 0
+    words = tokens.new_full((num_rows, max_words), -1)
+    num_words = int(word_lengths.sum())
+    if num_words == 0:
+        return words, word_lengths
+
+    word_in_row = start.long().cumsum(-1) - 1
+    first_letter = torch.where(start, positions, 0).cummax(-1).values
+    char_in_word = positions - first_letter
+    word_offsets = word_lengths.cumsum(0) - word_lengths
+    spellings = tokens.new_full((num_words, int(char_in_word[letter].max()) + 1), -1)
+    spellings[
+        (word_offsets.unsqueeze(1) + word_in_row)[letter], char_in_word[letter]
+    ] = tokens[letter]
+    _, ids = torch.unique(spellings, dim=0, return_inverse=True)
+    words[start.nonzero(as_tuple=True)[0], word_in_row[start]] = ids
+    return words, word_lengths
+
+
 def get_buckets(sizes, num_buckets):
     buckets = np.unique(
         np.percentile(
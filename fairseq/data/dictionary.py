@@ -7,8 +7,8 @@ import os
 from collections import Counter
 from multiprocessing import Pool
 
+import numpy as np
 import torch
-from fairseq import utils
 from fairseq.data import data_utils
 from fairseq.file_chunker_utils import Chunker, find_offsets
 from fairseq.file_io import PathManager
@@ -77,43 +77,103 @@ class Dictionary:
     ):
         """Helper for converting a tensor of token indices to a string.
 
-        Can optionally remove BPE symbols or escape <unk> words.
+        Can optionally remove BPE symbols or escape <unk> words. The rows of
+        2-D tensors are converted with :func:`batch_string` and joined by
+        newlines.
         """
         if torch.is_tensor(tensor) and tensor.dim() == 2:
-            return "\n".join(
-                self.string(
-                    t,
-                    bpe_symbol,
-                    escape_unk,
-                    extra_symbols_to_ignore,
-                    include_eos=include_eos,
-                )
-                for t in tensor
+            rows = tensor
+        else:
+            rows = [tensor]
+        return "\n".join(
+            self.batch_string(
+                rows,
+                bpe_symbol,
+                escape_unk=escape_unk,
+                extra_symbols_to_ignore=extra_symbols_to_ignore,
+                unk_string=unk_string,
+                include_eos=include_eos,
+                separator=separator,
             )
+        )
 
-        extra_symbols_to_ignore = set(extra_symbols_to_ignore or [])
-        if not include_eos:
-            extra_symbols_to_ignore.add(self.eos())
+    def batch_string(
+        self,
+        tensor,
+        bpe_symbol=None,
+        escape_unk=False,
+        extra_symbols_to_ignore=None,
+        unk_string=None,
+        include_eos=False,
+        separator=" ",
+        lengths=None,
+    ):
+        """Converts each row of a ``B x T`` tensor of token indices to a string.
 
-        def token_string(i):
-            if i == self.unk():
-                if unk_string is not None:
-                    return unk_string
-                else:
-                    return self.unk_string(escape_unk)
-            else:
-                return self[i]
+        The symbols of the whole batch are looked up at once in an array of
+        the symbols of the dictionary. Takes the arguments of :func:`string`;
+        if *lengths* is given, only the first ``lengths[i]`` tokens of row *i*
+        are converted, e.g. to skip the padding of the batch.
+        """
+        if torch.is_tensor(tensor):
+            ids = tensor.detach().cpu().numpy()
+        elif len(tensor) > 0 and torch.is_tensor(tensor[0]):
+            ids = torch.stack([t.detach().cpu() for t in tensor]).numpy()
+        else:
+            ids = np.asarray(tensor)
+        ids = ids.astype(np.int64, copy=False)
 
+        ignore = set(extra_symbols_to_ignore or [])
+        if not include_eos:
+            ignore.add(self.eos())
         if hasattr(self, "bos_index"):
-            extra_symbols_to_ignore.add(self.bos())
-
-        sent = separator.join(
-            token_string(i)
-            for i in tensor
-            if utils.item(i) not in extra_symbols_to_ignore
-        )
-
-        return data_utils.post_process(sent, bpe_symbol)
+            ignore.add(self.bos())
+        keep = ~np.isin(ids, list(ignore))
+        if lengths is not None:
+            lengths = np.asarray(lengths).reshape(-1, 1)
+            keep &= np.arange(ids.shape[1]) < lengths
+
+        table = self.symbol_table()
+        kept = ids[keep]
+        tokens = table[np.minimum(kept, len(table) - 1)]
+        if unk_string is None:
+            unk_string = self.unk_string(escape_unk)
+        if unk_string != table[self.unk()]:
+            tokens[kept == self.unk()] = unk_string
+
+        tokens = tokens.tolist()
+        ends = np.cumsum(keep.sum(axis=1)).tolist()
+        return [
+            data_utils.post_process(separator.join(tokens[start:end]), bpe_symbol)
+            for start, end in zip([0] + ends, ends)
+        ]
+
+    def symbol_table(self):
+        """Returns the symbols as an array indexed by token index. Indices
+        past the end of the dictionary map to the last entry, the <unk> word."""
+        key = (id(self.symbols), len(self.symbols), len(self))
+        if getattr(self, "_symbol_table_key", None) != key:
+            symbols = [self[i] for i in range(len(self))] + [self.unk_word]
+            self._symbol_table = np.empty(len(symbols), dtype=object)
+            self._symbol_table[:] = symbols
+            self._char_table = None
+            # letter dictionaries get a table from unicode code points to
+            # token indices, see encode_lines()
+            letters = [
+                (ord(sym), i)
+                for i, sym in enumerate(symbols[self.nspecial : -1], self.nspecial)
+                if len(sym) == 1
+            ]
+            if len(letters) == len(self) - self.nspecial:
+                chars = np.arange(max([128] + [c + 1 for c, _ in letters]))
+                self._char_table = np.full(len(chars), self.unk(), dtype=np.int64)
+                for c, i in letters:
+                    self._char_table[c] = i
+                # whitespace as matched by tokenize_line
+                space = np.array([chr(c).isspace() for c in chars])
+                self._char_table[space] = -1
+            self._symbol_table_key = key
+        return self._symbol_table
 
     def unk_string(self, escape=False):
         """Return unknown string, optionally escaped as: <<unk>>"""
@@ -310,24 +370,82 @@ class Dictionary:
         append_eos=True,
         reverse_order=False,
     ) -> torch.IntTensor:
+        if (
+            not add_if_not_exist
+            and line_tokenizer is tokenize_line
+            and consumer is None
+            and not reverse_order
+        ):
+            ids = self._encode_letters([line], append_eos)
+            if ids is not None:
+                return ids[0]
+
         words = line_tokenizer(line)
         if reverse_order:
             words = list(reversed(words))
-        nwords = len(words)
-        ids = torch.IntTensor(nwords + 1 if append_eos else nwords)
-
-        for i, word in enumerate(words):
+        ids = []
+        for word in words:
             if add_if_not_exist:
                 idx = self.add_symbol(word)
             else:
                 idx = self.index(word)
             if consumer is not None:
                 consumer(word, idx)
-            ids[i] = idx
+            ids.append(idx)
         if append_eos:
-            ids[nwords] = self.eos_index
+            ids.append(self.eos_index)
+        return torch.IntTensor(ids)
+
+    def encode_lines(
+        self,
+        lines,
+        add_if_not_exist=True,
+        append_eos=True,
+    ):
+        """Batched :func:`encode_line` with the default tokenizer. Lookups
+        (``add_if_not_exist=False``) in a letter dictionary encode all lines at
+        once through a table from code points to token indices."""
+        ids = None
+        if not add_if_not_exist:
+            ids = self._encode_letters(lines, append_eos)
+        if ids is None:
+            ids = [
+                self.encode_line(
+                    line, add_if_not_exist=add_if_not_exist, append_eos=append_eos
+                )
+                for line in lines
+            ]
         return ids
 
+    def _encode_letters(self, lines, append_eos):
+        """Encodes *lines* if the dictionary only has single character symbols
+        and the words of all lines are single characters; returns None
+        otherwise."""
+        self.symbol_table()
+        char_table = self._char_table
+        if char_table is None or len(lines) == 0:
+            return None
+        codes = np.frombuffer("".join(lines).encode("utf-32-le"), dtype=np.uint32)
+        if len(codes) > 0 and codes.max() >= len(char_table):
+            return None
+        ids = char_table[codes]
+        is_word = ids >= 0
+        # words of more than one character
+        multi = is_word[1:] & is_word[:-1]
+        ends = np.cumsum([len(line) for line in lines])
+        multi[ends[(ends > 0) & (ends < len(codes))] - 1] = False
+        if multi.any():
+            return None
+
+        line_ids = np.repeat(np.arange(len(lines)), [len(line) for line in lines])
+        num_words = np.bincount(line_ids[is_word], minlength=len(lines))
+        ids = ids[is_word].astype(np.int32)
+        if append_eos:
+            offsets = np.cumsum(num_words)
+            ids = np.insert(ids, offsets, self.eos_index)
+            num_words = num_words + 1
+        return list(torch.from_numpy(ids).split(np.asarray(num_words).tolist()))
+
     @staticmethod
     def _add_file_to_dictionary_single_worker(
         filename,
@@ -0,0 +1,198 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class MMapFeatureCache(object):
+    """A disk-backed cache of variable-length arrays, one per dataset index.
+
+    Entries are laid out back-to-back in a single memory-mapped file whose
+    layout (offsets) is fixed up front from *sizes*, so the cache can be
+    filled lazily and in any order, including concurrently by several
+    processes on the same host. Each entry has a "filled" flag stored in the
+    same file, which is only set after the entry has been written.
+
+    A JSON sidecar records *fingerprint*; if it does not match the one
+    passed in (e.g. because the dataset, the model or the settings that
+    produced the features changed) the cache is discarded and recreated.
+    Processes opening the cache at the same time (e.g. distributed ranks)
+    take an ``O_EXCL`` lock file to (re)create it, so that none of them maps a
+    file which is then replaced.
+
+    Args:
+        path (str): cache file prefix; ``{path}.bin`` and ``{path}.json``
+            are created
+        sizes (np.ndarray): number of rows of each entry
+        feature_shape (tuple, optional): trailing shape of every row
+        dtype (np.dtype, optional): storage type (default: float16)
+        fingerprint (str, optional): identifies the cached content
+        readonly (bool, optional): open an existing cache without filling it
+    """
+
+    _ALIGN = 4096
+    # creating the (sparse) file takes well under this many seconds, older
+    # lock files are left over by killed processes
+    _LOCK_TIMEOUT = 60
+
+    def __init__(
+        self,
+        path,
+        sizes,
+        feature_shape=(),
+        dtype=np.float16,
+        fingerprint=None,
+        readonly=False,
+    ):
+        self.path = path
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.offsets = np.zeros(len(self.sizes) + 1, dtype=np.int64)
+        np.cumsum(self.sizes, out=self.offsets[1:])
+        self.feature_shape = tuple(feature_shape)
+        self.dtype = np.dtype(dtype)
+        self.readonly = readonly
+        self.meta = {
+            "fingerprint": fingerprint,
+            "num_entries": len(self.sizes),
+            "num_rows": int(self.offsets[-1]),
+            "feature_shape": list(self.feature_shape),
+            "dtype": self.dtype.str,
+        }
+
+        if not self._is_valid():
+            if readonly:
+                raise FileNotFoundError(f"no valid feature cache at {path}")
+            self._create_locked()
+        self._open()
+
+    @property
+    def data_path(self):
+        return self.path + ".bin"
+
+    @property
+    def meta_path(self):
+        return self.path + ".json"
+
+    @property
+    def lock_path(self):
+        return self.path + ".lock"
+
+    @property
+    def _header_bytes(self):
+        n = self.meta["num_entries"]
+        return (n + self._ALIGN - 1) // self._ALIGN * self._ALIGN
+
+    def _is_valid(self):
+        if not (os.path.exists(self.data_path) and os.path.exists(self.meta_path)):
+            return False
+        with open(self.meta_path) as f:
+            meta = json.load(f)
+        return meta == self.meta
+
+    def _create_locked(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        while True:
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    stale = time.time() - os.path.getmtime(self.lock_path)
+                except FileNotFoundError:
+                    continue
+                if stale > self._LOCK_TIMEOUT:
+                    logger.warning(f"removing stale lock file {self.lock_path}")
+                    try:
+                        os.remove(self.lock_path)
+                    except FileNotFoundError:
+                        pass
+                else:
+                    time.sleep(0.1)
+                continue
+            try:
+                # another process may have created it while we were waiting
+                if not self._is_valid():
+                    if os.path.exists(self.meta_path):
+                        logger.warning(
+                            f"feature cache {self.path} is stale, rebuilding it"
+                        )
+                    self._create()
+            finally:
+                os.close(fd)
+                os.remove(self.lock_path)
+            return
+
+    def _create(self):
+        nbytes = self._header_bytes + int(self.offsets[-1]) * self._row_bytes
+        tmp_path = f"{self.data_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            # sparse file; blocks are only allocated as entries are filled
+            f.truncate(nbytes)
+        os.replace(tmp_path, self.data_path)
+        tmp_path = f"{self.meta_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.meta_path)
+        logger.info(
+            f"created feature cache {self.path} "
+            f"({len(self.sizes)} entries, {nbytes / 2 ** 30:.2f} GiB)"
+        )
+
+    @property
+    def _row_bytes(self):
+        return int(np.prod(self.feature_shape, dtype=np.int64)) * self.dtype.itemsize
+
+    def _open(self):
+        mode = "r" if self.readonly else "r+"
+        num_entries = self.meta["num_entries"]
+        self._filled = np.memmap(
+            self.data_path, dtype=np.uint8, mode=mode, shape=(max(num_entries, 1),)
+        )
+        self._data = np.memmap(
+            self.data_path,
+            dtype=self.dtype,
+            mode=mode,
+            offset=self._header_bytes,
+            shape=(max(int(self.offsets[-1]), 1),) + self.feature_shape,
+        )
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __contains__(self, index):
+        return bool(self._filled[index])
+
+    def __getitem__(self, index):
+        """Returns a read-only view of entry *index* (no copy)."""
+        assert index in self, f"entry {index} is not cached"
+        view = self._data[self.offsets[index] : self.offsets[index + 1]]
+        view.flags.writeable = False
+        return view
+
+    def __setitem__(self, index, value):
+        assert not self.readonly
+        value = np.asarray(value)
+        expected = (int(self.sizes[index]),) + self.feature_shape
+        assert value.shape == expected, f"expected {expected}, got {value.shape}"
+        self._data[self.offsets[index] : self.offsets[index + 1]] = value
+        self._filled[index] = 1
+
+    def entry_nbytes(self, index):
+        return int(self.sizes[index]) * self._row_bytes
+
+    @property
+    def num_filled(self):
+        return int(np.count_nonzero(self._filled[: len(self)]))
+
+    def flush(self):
+        if not self.readonly:
+            self._data.flush()
+            self._filled.flush()
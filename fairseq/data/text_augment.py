@@ -0,0 +1,139 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from typing import List, Optional
+
+import torch
+
+
+class BatchedTextAugment(object):
+    """Generate word-swap, span-deletion and span-insertion negatives for a
+    batch of letter targets using only tensor ops on the targets' device.
+
+    The distribution of the generated negatives matches the per-line
+    augmentation of the ``ctc_sdt_kd`` criterion:
+
+    - *swap*: a span of at least two consecutive words (delimited by
+      *word_separator*) is randomly permuted; the trailing chunk after the
+      last separator is never moved.
+    - *deletion*: a contiguous span of ``1 .. len // 2`` tokens is removed
+      and the row is right-padded.
+    - *insertion*: one token is repeated ``1 .. max_insert_len`` extra times;
+      the output is ``max_insert_len`` columns wider than the input.
+
+    Args:
+        dictionary (~fairseq.data.Dictionary): target dictionary
+        word_separator (str, optional): symbol separating words
+            (default: "|")
+        max_insert_len (int, optional): maximum number of inserted tokens
+            (default: 4)
+        seed (int, optional): base seed; together with the *step* passed to
+            :func:`__call__` it makes the augmentation reproducible
+            (default: 1)
+    """
+
+    def __init__(self, dictionary, word_separator="|", max_insert_len=4, seed=1):
+        self.pad_idx = dictionary.pad()
+        self.sep_idx = dictionary.index(word_separator)
+        self.max_insert_len = max_insert_len
+        self.seed = seed
+
+    def __call__(
+        self,
+        tokens: torch.Tensor,
+        lengths: Optional[torch.Tensor] = None,
+        num_aug: int = 1,
+        step: int = 0,
+    ) -> List[torch.Tensor]:
+        """Returns ``[tokens, swap_1, del_1, ins_1, ..., swap_n, del_n, ins_n]``
+        for ``n = num_aug``.
+
+        Args:
+            tokens (LongTensor): right-padded targets of shape `(B, T)`
+            lengths (LongTensor, optional): number of non-pad tokens per row
+            num_aug (int): number of (swap, deletion, insertion) triples
+            step (int): mixed into the seed, e.g. the number of updates
+        """
+        if lengths is None:
+            lengths = tokens.ne(self.pad_idx).long().sum(-1)
+        lengths = lengths.to(tokens.device)
+        generator = torch.Generator(device=tokens.device)
+        generator.manual_seed(int(hash((self.seed, step)) % 1e6))
+
+        txt_auged = [tokens]
+        for _ in range(num_aug):
+            txt_auged.append(self.swap(tokens, lengths, generator))
+            txt_auged.append(self.delete(tokens, lengths, generator))
+            txt_auged.append(self.insert(tokens, lengths, generator))
+        return txt_auged
+
+    @staticmethod
+    def _randint(high: torch.Tensor, generator: torch.Generator) -> torch.Tensor:
+        """Per-row uniform sample from ``[0, high)``; *high* must be >= 1."""
+        u = torch.rand(high.shape, generator=generator, device=high.device)
+        return torch.minimum((u * high).long(), high - 1)
+
+    def _gather(self, tokens, src):
+        out = tokens.gather(1, src.clamp(min=0, max=tokens.size(1) - 1))
+        return out.masked_fill_(src >= tokens.size(1), self.pad_idx)
+
+    def swap(self, tokens, lengths, generator):
+        bsz, tsz = tokens.shape
+        pos = torch.arange(tsz, device=tokens.device)
+        is_sep = tokens.eq(self.sep_idx) & (pos[None, :] < lengths[:, None])
+        # number of chunks ``str.split("|")`` would produce
+        num_chunks = is_sep.long().sum(-1) + 1
+
+        swap_len = torch.minimum(
+            self._randint(num_chunks, generator) // 2 + 2, num_chunks - 1
+        )
+        start = torch.minimum(
+            self._randint((num_chunks - swap_len - 1).clamp(min=1), generator),
+            num_chunks - swap_len - 1,
+        )
+        apply = num_chunks > 3
+
+        # a word and its trailing separator move together
+        word_idx = is_sep.long().cumsum(-1) - is_sep.long()
+        in_span = (
+            (word_idx >= start[:, None])
+            & (word_idx < (start + swap_len)[:, None])
+            & apply[:, None]
+        )
+        word_rand = torch.rand(
+            bsz, tsz, generator=generator, device=tokens.device, dtype=torch.double
+        ).gather(1, word_idx)
+        key = torch.where(
+            in_span,
+            start[:, None] + word_rand * swap_len[:, None],
+            word_idx.double(),
+        )
+        order = torch.sort(key, dim=-1, stable=True).indices
+        return tokens.gather(1, order)
+
+    def delete(self, tokens, lengths, generator):
+        del_len = self._randint((lengths // 2).clamp(min=1), generator) + 1
+        start = self._randint((lengths - del_len).clamp(min=1), generator)
+        del_len = del_len * (lengths > del_len)
+
+        pos = torch.arange(tokens.size(1), device=tokens.device)[None, :]
+        src = pos + (pos >= start[:, None]) * del_len[:, None]
+        return self._gather(tokens, src)
+
+    def insert(self, tokens, lengths, generator):
+        ins_len = (
+            self._randint(torch.full_like(lengths, self.max_insert_len), generator) + 1
+        )
+        start = self._randint((lengths - ins_len).clamp(min=1), generator)
+        ins_len = ins_len * (lengths > ins_len)
+
+        pos = torch.arange(tokens.size(1) + self.max_insert_len, device=tokens.device)[
+            None, :
+        ]
+        start, ins_len = start[:, None], ins_len[:, None]
+        src = torch.where(
+            pos < start, pos, torch.where(pos < start + ins_len, start, pos - ins_len)
+        )
+        return self._gather(tokens, src)
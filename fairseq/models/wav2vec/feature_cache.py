@@ -0,0 +1,111 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+import torch
+
+from fairseq.data.mmap_cache import MMapFeatureCache
+
+logger = logging.getLogger(__name__)
+
+
+def conv_fingerprint(w2v_model):
+    """Hash of the configuration and weights of the convolutional feature
+    extractor of a :class:`~fairseq.models.wav2vec.Wav2Vec2Model`."""
+    h = hashlib.md5()
+    cfg = w2v_model.cfg
+    h.update(f"{cfg.conv_feature_layers}:{cfg.extractor_mode}:{cfg.conv_bias}".encode())
+    for name, t in sorted(w2v_model.feature_extractor.state_dict().items()):
+        h.update(name.encode())
+        h.update(t.detach().float().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
+class ConvFeatureCache(object):
+    """Caches the outputs of a frozen convolutional feature extractor (i.e.
+    with ``feature_grad_mult`` 0), before ``layer_norm`` and
+    ``post_extract_proj``, so that later epochs skip the conv stack.
+
+    There is one :class:`~fairseq.data.mmap_cache.MMapFeatureCache` of
+    float16 frames per dataset, keyed by dataset index and filled lazily as
+    batches are computed. Caches are rebuilt when the conv weights, whose hash
+    is taken by :func:`update`, or the dataset sizes change.
+
+    Batches differ across epochs, so features are only cached when they do
+    not depend on the rest of the batch: with ``extractor_mode`` layer_norm,
+    or for unpadded batches otherwise (the group norm of the default
+    extractor normalizes over the padding).
+
+    Args:
+        cache_dir (str): directory of the cache files
+        dtype (np.dtype, optional): storage type (default: float16)
+    """
+
+    def __init__(self, cache_dir, dtype=np.float16):
+        self.cache_dir = cache_dir
+        self.dtype = np.dtype(dtype)
+        self.caches = {}
+
+    def update(self, w2v_model, datasets):
+        """Opens the caches of *datasets*, a dict of dataset keys to the
+        sample sizes of their entries, for the current conv weights of
+        *w2v_model*."""
+        fingerprint = conv_fingerprint(w2v_model)
+        for key, sizes in datasets.items():
+            frames = w2v_model._get_feat_extract_output_lengths(
+                torch.from_numpy(np.asarray(sizes, dtype=np.int64))
+            ).numpy()
+            h = hashlib.md5(fingerprint.encode())
+            h.update(frames.tobytes())
+            cache = MMapFeatureCache(
+                os.path.join(self.cache_dir, key),
+                frames,
+                feature_shape=(w2v_model.embed,),
+                dtype=self.dtype,
+                fingerprint=h.hexdigest(),
+            )
+            self.caches[key] = cache
+            logger.info(
+                f"conv feature cache {cache.path}: "
+                f"{cache.num_filled}/{len(cache)} entries cached"
+            )
+
+    def get(self, key, ids, num_frames, dtype=torch.float32, device=None):
+        """Cached features ``(B, C, num_frames)`` of the dataset entries
+        *ids*, zero-padded, or ``None`` unless all of them are cached."""
+        cache = self.caches.get(key, None)
+        ids = ids.tolist()
+        if cache is None or not all(id >= 0 and id in cache for id in ids):
+            return None
+        out = np.zeros((len(ids), num_frames) + cache.feature_shape, cache.dtype)
+        for i, id in enumerate(ids):
+            out[i, : cache.sizes[id]] = cache[id]
+        out = torch.from_numpy(out).to(device=device, dtype=dtype)
+        return out.transpose(1, 2)
+
+    def put(self, key, ids, features):
+        """Stores the features ``(B, C, T)`` of the dataset entries *ids*
+        which are not cached yet; entries with a negative id are skipped."""
+        cache = self.caches.get(key, None)
+        if cache is None:
+            return
+        rows = [i for i, id in enumerate(ids.tolist()) if id >= 0 and id not in cache]
+        if len(rows) == 0:
+            return
+        features = features[rows].transpose(1, 2).float().cpu().numpy()
+        for feats, i in zip(features, rows):
+            id = int(ids[i])
+            cache[id] = feats[: cache.sizes[id]].astype(cache.dtype)
+
+    def __getstate__(self):
+        # e.g. copies of the model for EMA do not copy the memory maps; the
+        # caches are reopened by the next update
+        state = self.__dict__.copy()
+        state["caches"] = {}
+        return state
@@ -13,7 +13,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from fairseq import utils
-from fairseq.data.data_utils import compute_mask_indices
+from fairseq.data.data_utils import compute_mask_indices, compute_mask_indices_batched
 from fairseq.dataclass import ChoiceEnum, FairseqDataclass
 from fairseq.distributed import fsdp_wrap
 from fairseq.models import BaseFairseqModel, register_model
@@ -333,6 +333,8 @@ class Wav2Vec2Model(BaseFairseqModel):
         self.dropout_features = nn.Dropout(cfg.dropout_features)
 
         self.feature_grad_mult = cfg.feature_grad_mult
+        # a ConvFeatureCache of the frozen feature extractor, set by the task
+        self.feature_cache = None
 
         self.quantizer = None
         self.input_quantizer = None
@@ -421,26 +423,24 @@ class Wav2Vec2Model(BaseFairseqModel):
         B, T, C = x.shape
 
         if self.mask_channel_prob > 0 and self.mask_channel_before:
-            mask_channel_indices = compute_mask_indices(
-                (B, C),
-                None,
-                self.mask_channel_prob,
-                self.mask_channel_length,
-                self.mask_channel_selection,
-                self.mask_channel_other,
-                no_overlap=self.no_mask_channel_overlap,
-                min_space=self.mask_channel_min_space,
-            )
-            mask_channel_indices = (
-                torch.from_numpy(mask_channel_indices)
-                .to(x.device)
-                .unsqueeze(1)
-                .expand(-1, T, -1)
-            )
+            mask_channel_indices = self._compute_mask_channel_indices(x)
             x[mask_channel_indices] = 0
 
         if self.mask_prob > 0:
-            if mask_indices is None:
+            if mask_indices is None and not self.no_mask_overlap:
+                mask_indices = compute_mask_indices_batched(
+                    (B, T),
+                    padding_mask,
+                    self.mask_prob,
+                    self.mask_length,
+                    self.mask_selection,
+                    self.mask_other,
+                    min_masks=2,
+                    require_same_masks=self.cfg.require_same_masks,
+                    mask_dropout=self.cfg.mask_dropout,
+                    device=x.device,
+                )
+            elif mask_indices is None:
                 mask_indices = compute_mask_indices(
                     (B, T),
                     padding_mask,
@@ -461,26 +461,37 @@ class Wav2Vec2Model(BaseFairseqModel):
 
         if self.mask_channel_prob > 0 and not self.mask_channel_before:
             if mask_channel_indices is None:
-                mask_channel_indices = compute_mask_indices(
-                    (B, C),
-                    None,
-                    self.mask_channel_prob,
-                    self.mask_channel_length,
-                    self.mask_channel_selection,
-                    self.mask_channel_other,
-                    no_overlap=self.no_mask_channel_overlap,
-                    min_space=self.mask_channel_min_space,
-                )
-                mask_channel_indices = (
-                    torch.from_numpy(mask_channel_indices)
-                    .to(x.device)
-                    .unsqueeze(1)
-                    .expand(-1, T, -1)
-                )
+                mask_channel_indices = self._compute_mask_channel_indices(x)
             x = index_put(x, mask_channel_indices, 0)
 
         return x, mask_indices
 
+    def _compute_mask_channel_indices(self, x):
+        B, T, C = x.shape
+        if self.no_mask_channel_overlap:
+            mask_channel_indices = compute_mask_indices(
+                (B, C),
+                None,
+                self.mask_channel_prob,
+                self.mask_channel_length,
+                self.mask_channel_selection,
+                self.mask_channel_other,
+                no_overlap=self.no_mask_channel_overlap,
+                min_space=self.mask_channel_min_space,
+            )
+            mask_channel_indices = torch.from_numpy(mask_channel_indices).to(x.device)
+        else:
+            mask_channel_indices = compute_mask_indices_batched(
+                (B, C),
+                None,
+                self.mask_channel_prob,
+                self.mask_channel_length,
+                self.mask_channel_selection,
+                self.mask_channel_other,
+                device=x.device,
+            )
+        return mask_channel_indices.unsqueeze(1).expand(-1, T, -1)
+
     def sample_negatives(self, y, num, padding_count=None):
 
         if self.n_negatives == 0 and self.cross_sample_negatives == 0:
@@ -588,15 +599,43 @@ class Wav2Vec2Model(BaseFairseqModel):
         mask_indices=None,
         mask_channel_indices=None,
         padding_count=None,
+        result_layers=None,
+        feature_cache_key=None,
+        feature_cache_ids=None,
     ):
 
-        if self.feature_grad_mult > 0:
+        features = None
+        use_cache = (
+            self.feature_cache is not None
+            and feature_cache_ids is not None
+            and self.feature_grad_mult == 0
+            # the group norm of the default extractor normalizes over the
+            # padding too, so padded batches may not match the cached features
+            and (
+                self.cfg.extractor_mode == "layer_norm"
+                or padding_mask is None
+                or not padding_mask.any()
+            )
+        )
+        if use_cache:
+            features = self.feature_cache.get(
+                feature_cache_key,
+                feature_cache_ids,
+                self._get_feat_extract_output_lengths(
+                    torch.tensor(source.size(1))
+                ).item(),
+                dtype=source.dtype,
+                device=source.device,
+            )
+        if features is None and self.feature_grad_mult > 0:
             features = self.feature_extractor(source)
             if self.feature_grad_mult != 1.0:
                 features = GradMultiply.apply(features, self.feature_grad_mult)
-        else:
+        elif features is None:
             with torch.no_grad():
                 features = self.feature_extractor(source)
+            if use_cache:
+                self.feature_cache.put(feature_cache_key, feature_cache_ids, features)
 
         features_pen = features.float().pow(2).mean()
 
@@ -672,7 +711,9 @@ class Wav2Vec2Model(BaseFairseqModel):
             y = unmasked_features
             mask_indices = None
 
-        x, layer_results = self.encoder(x, padding_mask=padding_mask, layer=layer)
+        x, layer_results = self.encoder(
+            x, padding_mask=padding_mask, layer=layer, result_layers=result_layers
+        )
 
         if features_only:
             return {
@@ -774,9 +815,30 @@ class Wav2Vec2Model(BaseFairseqModel):
         x = self.layer_norm(x)
         return self.quantizer.forward_idx(x)
 
-    def extract_features(self, source, padding_mask, mask=False, layer=None):
+    def extract_features(
+        self,
+        source,
+        padding_mask,
+        mask=False,
+        layer=None,
+        result_layers=None,
+        feature_cache_key=None,
+        feature_cache_ids=None,
+    ):
+        """*result_layers* restricts the returned ``layer_results`` to the
+        given encoder layers (all of them if ``None``), see
+        :func:`TransformerEncoder.extract_features`. The features of the
+        dataset entries *feature_cache_ids* are read from and written to
+        ``feature_cache``, if set."""
         res = self.forward(
-            source, padding_mask, mask=mask, features_only=True, layer=layer
+            source,
+            padding_mask,
+            mask=mask,
+            features_only=True,
+            layer=layer,
+            result_layers=result_layers,
+            feature_cache_key=feature_cache_key,
+            feature_cache_ids=feature_cache_ids,
         )
         return res
 
@@ -999,8 +1061,10 @@ class TransformerEncoder(nn.Module):
 
         self.apply(init_bert_params)
 
-    def forward(self, x, padding_mask=None, layer=None):
-        x, layer_results = self.extract_features(x, padding_mask, layer)
+    def forward(self, x, padding_mask=None, layer=None, result_layers=None):
+        x, layer_results = self.extract_features(
+            x, padding_mask, layer, result_layers=result_layers
+        )
 
         if self.layer_norm_first and layer is None:
             x = self.layer_norm(x)
@@ -1013,7 +1077,15 @@ class TransformerEncoder(nn.Module):
         padding_mask=None,
         tgt_layer=None,
         min_layer=0,
+        result_layers=None,
     ):
+        """Returns the encoder output and the ``(x, z, lr)`` results of the
+        layers from *min_layer* on. Every kept result holds a full T x B x C
+        activation alive, so callers that only need the final output (e.g.
+        CTC fine-tuning and inference) should pass *result_layers*, the
+        indices of the layers to keep results for (negative indices count
+        from the last layer, an empty collection keeps none)."""
+        keep_layer = self._keep_layer_fn(min_layer, result_layers)
 
         if padding_mask is not None:
             x = index_put(x, padding_mask, 0)
@@ -1049,7 +1121,7 @@ class TransformerEncoder(nn.Module):
                 x, (z, lr) = layer(
                     x, self_attn_padding_mask=padding_mask, need_weights=False
                 )
-                if i >= min_layer:
+                if keep_layer(i):
                     layer_results.append((x, z, lr))
             if i == tgt_layer:
                 r = x
@@ -1076,6 +1148,16 @@ class TransformerEncoder(nn.Module):
 
         return x, layer_results
 
+    def _keep_layer_fn(self, min_layer=0, result_layers=None):
+        if result_layers is None:
+            return lambda i: i >= min_layer
+        num_layers = len(self.layers)
+        assert all(
+            -num_layers <= i < num_layers for i in result_layers
+        ), f"result_layers {result_layers} out of range for {num_layers} layers"
+        keep = {i % num_layers for i in result_layers}
+        return lambda i: i >= min_layer and i in keep
+
     def max_positions(self):
         """Maximum output length supported by the encoder."""
         return self.args.max_positions
@@ -1129,7 +1211,11 @@ class ConformerEncoder(TransformerEncoder):
 
         self.apply(init_bert_params)
 
-    def extract_features(self, x, padding_mask=None, tgt_layer=None):
+    def extract_features(
+        self, x, padding_mask=None, tgt_layer=None, result_layers=None
+    ):
+        keep_layer = self._keep_layer_fn(result_layers=result_layers)
+
         if padding_mask is not None:
             x = index_put(x, padding_mask, 0)
 
@@ -1157,7 +1243,7 @@ class ConformerEncoder(TransformerEncoder):
                     need_weights=False,
                     position_emb=position_emb,
                 )
-                if tgt_layer is not None:
+                if tgt_layer is not None and keep_layer(i):
                     layer_results.append((x, z))
             if i == tgt_layer:
                 r = x
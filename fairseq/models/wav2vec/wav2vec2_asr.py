@@ -28,12 +28,15 @@ from fairseq.models import (
     FairseqIncrementalDecoder,
     register_model,
 )
-from fairseq.models.wav2vec.wav2vec2 import MASKING_DISTRIBUTION_CHOICES
+from fairseq.models.wav2vec.wav2vec2 import MASKING_DISTRIBUTION_CHOICES, Wav2Vec2Model
 from fairseq.modules import LayerNorm, PositionalEmbedding, TransformerDecoderLayer
 from fairseq.tasks import FairseqTask
 
 logger = logging.getLogger(__name__)
 
+# outputs of Wav2VecEncoder.forward besides "encoder_out" and "padding_mask"
+AUX_OUTPUTS = ("target_embed", "encoder_out_kd", "layer_results")
+
 def _pre_hook(
     state_dict,
     prefix,
@@ -329,6 +332,9 @@ class Wav2VecCtc(BaseFairseqModel):
         else:
             return utils.softmax(logits.float(), dim=-1)
 
+    def set_aux_outputs(self, aux_outputs, result_layers=None):
+        self.w2v_encoder.set_aux_outputs(aux_outputs, result_layers)
+
     def forward(self, **kwargs):
         x = self.w2v_encoder(**kwargs)
         return x
@@ -610,6 +616,23 @@ class Wav2VecEncoder(FairseqEncoder):
         self.layer_norm2 = torch.nn.LayerNorm(d)
         self.layer_norm3 = torch.nn.LayerNorm(d)
 
+        self.aux_outputs = set(AUX_OUTPUTS)
+        self.result_layers = None
+
+    def set_aux_outputs(self, aux_outputs, result_layers=None):
+        """Restricts the auxiliary outputs computed by :func:`forward` to
+        *aux_outputs* (a subset of ``AUX_OUTPUTS``); the others are returned
+        as ``None``. All of them are computed by default.
+
+        If "layer_results" is requested, *result_layers* optionally selects
+        the transformer layers whose results are kept (default: all);
+        otherwise no per-layer results are held during the forward."""
+        unknown = set(aux_outputs) - set(AUX_OUTPUTS)
+        if len(unknown) > 0:
+            raise ValueError(f"unknown auxiliary outputs: {sorted(unknown)}")
+        self.aux_outputs = set(aux_outputs)
+        self.result_layers = None if result_layers is None else tuple(result_layers)
+
     def load_model_weights(self, state, model, cfg):
         if cfg.ddp_backend == "fully_sharded":
             from fairseq.distributed import FullyShardedDataParallel
@@ -669,7 +692,27 @@ class Wav2VecEncoder(FairseqEncoder):
         """Set the number of parameters updates."""
         return self.num_updates
 
-    def forward(self, source, padding_mask, target=None, **kwargs):
+    def embed_target(self, target):
+        embed = self.embed(target)
+        embed = embed.transpose(0,1) #.to(x.dtype)
+        target_mask = (target == 1)
+
+        residual = embed
+        embed = self.layer_norm1(embed)
+        embed, _ = self.multihead_attn1(self.linear_q1(embed),self.linear_k1(embed),self.linear_v1(embed), key_padding_mask=target_mask)
+        embed = embed + residual
+        residual = embed
+        embed = self.layer_norm2(embed)
+        embed, _ = self.multihead_attn2(self.linear_q2(embed),self.linear_k2(embed),self.linear_v2(embed), key_padding_mask=target_mask)
+        embed = embed + residual
+        residual = embed
+        embed = self.layer_norm3(embed)
+        embed, _ = self.multihead_attn3(self.linear_q3(embed),self.linear_k3(embed),self.linear_v3(embed), key_padding_mask=target_mask)
+        return embed
+
+    def forward(self, source, padding_mask, target=None, aux_outputs=None, **kwargs):
+        if aux_outputs is None:
+            aux_outputs = self.aux_outputs
 
         w2v_args = {
             "source": source,
@@ -679,6 +722,14 @@ class Wav2VecEncoder(FairseqEncoder):
 
         if self.is_d2v_multi:
             w2v_args["mode"] = "AUDIO"
+        elif isinstance(self.w2v_model, Wav2Vec2Model):
+            w2v_args["result_layers"] = (
+                self.result_layers if "layer_results" in aux_outputs else ()
+            )
+            # set by datasets of tasks with a feature_cache_dir
+            if "feature_cache_ids" in kwargs:
+                w2v_args["feature_cache_key"] = kwargs["feature_cache_key"]
+                w2v_args["feature_cache_ids"] = kwargs["feature_cache_ids"]
 
         ft = self.freeze_finetune_updates <= self.num_updates
 
@@ -693,31 +744,18 @@ class Wav2VecEncoder(FairseqEncoder):
 
         x = self.final_dropout(x)
 
-        if self.proj:
+        if self.proj and "encoder_out_kd" in aux_outputs:
             x_kd = self.proj_kd(x)
             # x_kd2 = self.proj_kd2(x)
-            x = self.proj(x)
-            # x = torch.log_softmax(x * 0.6, dim=-1)
         else:
             x_kd = None
             # x_kd2 = None
+        if self.proj:
+            x = self.proj(x)
+            # x = torch.log_softmax(x * 0.6, dim=-1)
 
-        if target is not None:
-            embed = self.embed(target)
-            embed = embed.transpose(0,1) #.to(x.dtype)
-            target_mask = (target == 1)
-
-            residual = embed
-            embed = self.layer_norm1(embed)
-            embed, _ = self.multihead_attn1(self.linear_q1(embed),self.linear_k1(embed),self.linear_v1(embed), key_padding_mask=target_mask)
-            embed = embed + residual
-            residual = embed
-            embed = self.layer_norm2(embed)
-            embed, _ = self.multihead_attn2(self.linear_q2(embed),self.linear_k2(embed),self.linear_v2(embed), key_padding_mask=target_mask)
-            embed = embed + residual
-            residual = embed
-            embed = self.layer_norm3(embed)
-            embed, _ = self.multihead_attn3(self.linear_q3(embed),self.linear_k3(embed),self.linear_v3(embed), key_padding_mask=target_mask)
+        if target is not None and "target_embed" in aux_outputs:
+            embed = self.embed_target(target)
         else:
             embed = None
 
@@ -726,26 +764,12 @@ class Wav2VecEncoder(FairseqEncoder):
             "encoder_out": x,  # T x B x C
             "encoder_out_kd": x_kd,  # T x B x C
             "padding_mask": padding_mask,  # B x T,
-            "layer_results": res["layer_results"],
+            "layer_results": res["layer_results"] if "layer_results" in aux_outputs else None,
         }  #"encoder_out_kd2": x_kd2,  # T x B x C
 
     def forward_txt(self, source, padding_mask, target=None, **kwargs):
         if target is not None:
-            embed = self.embed(target)
-            embed = embed.transpose(0,1) #.to(x.dtype)
-            target_mask = (target == 1)
-
-            residual = embed
-            embed = self.layer_norm1(embed)
-            embed, _ = self.multihead_attn1(self.linear_q1(embed),self.linear_k1(embed),self.linear_v1(embed), key_padding_mask=target_mask)
-            embed = embed + residual
-            residual = embed
-            embed = self.layer_norm2(embed)
-            embed, _ = self.multihead_attn2(self.linear_q2(embed),self.linear_k2(embed),self.linear_v2(embed), key_padding_mask=target_mask)
-            embed = embed + residual
-            residual = embed
-            embed = self.layer_norm3(embed)
-            embed, _ = self.multihead_attn3(self.linear_q3(embed),self.linear_k3(embed),self.linear_v3(embed), key_padding_mask=target_mask)
+            embed = self.embed_target(target)
         else:
             embed = None
 
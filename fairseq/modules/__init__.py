@@ -9,6 +9,7 @@ from .adaptive_softmax import AdaptiveSoftmax
 from .base_layer import BaseLayer
 from .beamable_mm import BeamableMM
 from .character_token_embedder import CharacterTokenEmbedder
+from .chunked_ctc_loss import chunked_ctc_loss
 from .conv_tbc import ConvTBC
 from .cross_entropy import cross_entropy
 from .downsampled_multihead_attention import DownsampledMultiHeadAttention
@@ -57,6 +58,7 @@ __all__ = [
     "BaseLayer",
     "BeamableMM",
     "CharacterTokenEmbedder",
+    "chunked_ctc_loss",
     "ConvTBC",
     "cross_entropy",
     "DownsampledMultiHeadAttention",
@@ -0,0 +1,240 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import math
+
+import torch
+import torch.nn.functional as F
+from torch.autograd.function import once_differentiable
+
+NEG_INF = float("-inf")
+
+
+def _logaddexp3(a, b, c):
+    m = torch.max(torch.max(a, b), c)
+    # states which are unreachable from all three stay at -inf instead of nan
+    m = m.masked_fill(m == NEG_INF, 0)
+    return m + ((a - m).exp() + (b - m).exp() + (c - m).exp()).log()
+
+
+def _alpha_step(alpha, emissions, skip):
+    """Forward variables ``(B, S)`` of a frame, from those of the previous
+    frame and the log-probs of the extended targets at this frame."""
+    a1 = F.pad(alpha, (1, 0), value=NEG_INF)[:, :-1]
+    a2 = F.pad(alpha, (2, 0), value=NEG_INF)[:, :-2].masked_fill(~skip, NEG_INF)
+    return _logaddexp3(alpha, a1, a2) + emissions
+
+
+def _beta_step(beta, emissions, skip):
+    """Backward variables ``(B, S)`` of the previous frame, from those of a
+    frame and the log-probs of the extended targets at this frame."""
+    b = beta + emissions
+    b1 = F.pad(b, (0, 1), value=NEG_INF)[:, 1:]
+    b2 = F.pad(b, (0, 2), value=NEG_INF)[:, 2:]
+    b2 = b2.masked_fill(~F.pad(skip, (0, 2), value=False)[:, 2:], NEG_INF)
+    return _logaddexp3(b, b1, b2)
+
+
+def _extend_targets(targets, target_lengths, blank):
+    """Targets interleaved with blanks ``(B, 2 * S + 1)`` and whether each
+    state can be reached by skipping the blank before it."""
+    bsz = target_lengths.size(0)
+    max_len = int(target_lengths.max()) if bsz > 0 else 0
+    positions = torch.arange(max_len, device=target_lengths.device)
+    valid = positions < target_lengths.unsqueeze(1)
+    if targets.dim() == 1:
+        # concatenated targets, as accepted by F.ctc_loss
+        offsets = torch.cumsum(target_lengths, 0) - target_lengths
+        index = (offsets.unsqueeze(1) + positions).clamp(max=targets.numel() - 1)
+        padded = targets[index] if max_len > 0 else targets.new_zeros(bsz, 0)
+    else:
+        padded = targets[:, :max_len]
+    padded = padded.masked_fill(~valid, blank)
+
+    ext = padded.new_full((bsz, 2 * max_len + 1), blank)
+    ext[:, 1::2] = padded
+    skip = torch.zeros_like(ext, dtype=torch.bool)
+    skip[:, 2:] = (ext[:, 2:] != blank) & (ext[:, 2:] != ext[:, :-2])
+    return ext, skip
+
+
+def _normalize_chunk(logits, ext, dtype):
+    """Logits of a chunk and their log-normalizers in *dtype*, and the
+    log-probs of the extended targets ``(T, B, S)``."""
+    logits = logits.to(dtype)
+    lse = torch.logsumexp(logits, dim=-1, keepdim=True)
+    index = ext.unsqueeze(0).expand(logits.size(0), -1, -1)
+    return logits, lse, logits.gather(2, index) - lse
+
+
+class ChunkedCtcLoss(torch.autograd.Function):
+    @staticmethod
+    def forward(
+        ctx, logits, ext, skip, input_lengths, target_lengths, chunk_size, zero_inf
+    ):
+        tsz, bsz, _ = logits.shape
+        dtype = torch.promote_types(logits.dtype, torch.float32)
+        frames = torch.arange(tsz, device=logits.device).unsqueeze(1)
+        active = frames < input_lengths.unsqueeze(0)
+
+        # a virtual start state before the first frame
+        alpha = logits.new_full(ext.shape, NEG_INF, dtype=dtype)
+        alpha[:, 0] = 0
+        checkpoints = []
+        for start in range(0, tsz, chunk_size):
+            checkpoints.append(alpha)
+            _, _, emissions = _normalize_chunk(
+                logits[start : start + chunk_size], ext, dtype
+            )
+            for i in range(emissions.size(0)):
+                alpha = torch.where(
+                    active[start + i].unsqueeze(1),
+                    _alpha_step(alpha, emissions[i], skip),
+                    alpha,
+                )
+
+        # the alphas of each utterance are kept from its last frame on
+        batch = torch.arange(bsz, device=logits.device)
+        last = 2 * target_lengths
+        log_probs = torch.logaddexp(
+            alpha[batch, last],
+            alpha[batch, (last - 1).clamp(min=0)].masked_fill(last == 0, NEG_INF),
+        )
+        loss = -log_probs
+        finite = torch.isfinite(loss)
+        if zero_inf:
+            loss = loss.masked_fill(~finite, 0)
+
+        ctx.chunk_size = chunk_size
+        ctx.zero_inf = zero_inf
+        ctx.save_for_backward(
+            logits,
+            ext,
+            skip,
+            active,
+            target_lengths,
+            log_probs,
+            finite,
+            torch.stack(checkpoints) if tsz > 0 else alpha.unsqueeze(0),
+        )
+        return loss
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        (
+            logits,
+            ext,
+            skip,
+            active,
+            target_lengths,
+            log_probs,
+            finite,
+            checkpoints,
+        ) = ctx.saved_tensors
+        tsz, bsz, _ = logits.shape
+        dtype = checkpoints.dtype
+        chunk_size = ctx.chunk_size
+
+        scale = grad_output.to(dtype).view(1, -1, 1)
+        keep = active
+        if ctx.zero_inf:
+            keep = active & finite
+
+        batch = torch.arange(bsz, device=logits.device)
+        last = 2 * target_lengths
+        beta = torch.full_like(checkpoints[0], NEG_INF)
+        beta[batch[last > 0], last[last > 0] - 1] = 0
+        beta[batch, last] = 0
+
+        grad = torch.empty_like(logits)
+        for c in reversed(range(len(checkpoints))):
+            start = c * chunk_size
+            end = min(start + chunk_size, tsz)
+            chunk, lse, emissions = _normalize_chunk(logits[start:end], ext, dtype)
+            chunk_active = active[start:end].unsqueeze(2)
+
+            # alphas of the chunk are recomputed from its checkpoint
+            alphas = torch.empty_like(emissions)
+            alpha = checkpoints[c]
+            for i in range(end - start):
+                alpha = torch.where(
+                    chunk_active[i], _alpha_step(alpha, emissions[i], skip), alpha
+                )
+                alphas[i] = alpha
+            # betas exclude the emission at their frame
+            betas = torch.empty_like(emissions)
+            for i in reversed(range(end - start)):
+                betas[i] = beta
+                beta = torch.where(
+                    chunk_active[i], _beta_step(beta, emissions[i], skip), beta
+                )
+
+            # softmax minus the posteriors of the states of each label
+            posteriors = (alphas + betas - log_probs.view(1, -1, 1)).exp_()
+            chunk_grad = (chunk - lse).exp_()
+            chunk_grad.scatter_add_(
+                2, ext.unsqueeze(0).expand_as(posteriors), posteriors.neg_()
+            )
+            chunk_grad = torch.where(
+                keep[start:end].unsqueeze(2), chunk_grad * scale, 0.0
+            )
+            grad[start:end] = chunk_grad
+        return grad, None, None, None, None, None, None
+
+
+def chunked_ctc_loss(
+    logits,
+    targets,
+    input_lengths,
+    target_lengths,
+    blank=0,
+    reduction="mean",
+    zero_infinity=False,
+    chunk_size=None,
+):
+    """Connectionist Temporal Classification loss of *unnormalized* logits,
+    with the same arguments and results as :func:`torch.nn.functional.ctc_loss`
+    given ``log_softmax(logits)``.
+
+    The log-softmax is computed in the alpha/beta recursions, over chunks of
+    *chunk_size* frames, and the forward variables are only kept at the chunk
+    boundaries and recomputed in the backward pass. Besides the gradient, the
+    memory taken is linear in *chunk_size* rather than in the number of frames,
+    there is no float copy of half precision logits, and the recursions are
+    accumulated in (at least) float32. This is slower than the native loss,
+    which it is meant to replace on long utterances.
+
+    Args:
+        logits (Tensor): ``(T, B, C)`` unnormalized (or log-normalized) scores
+        targets (LongTensor): ``(B, S)`` padded targets or their concatenation
+        input_lengths (LongTensor): ``(B,)`` number of frames
+        target_lengths (LongTensor): ``(B,)`` number of targets
+        blank (int, optional): blank label (default: 0)
+        reduction (str, optional): ``'none'``, ``'mean'`` or ``'sum'``
+        zero_infinity (bool, optional): zero infinite losses, and their
+            gradients, of utterances too short for their targets
+        chunk_size (int, optional): frames per chunk (default: ``sqrt(T)``)
+    """
+    tsz = logits.size(0)
+    if chunk_size is None:
+        chunk_size = int(math.ceil(math.sqrt(tsz)))
+    chunk_size = max(chunk_size, 1)
+    device = logits.device
+    input_lengths = torch.as_tensor(input_lengths, dtype=torch.long, device=device)
+    target_lengths = torch.as_tensor(target_lengths, dtype=torch.long, device=device)
+    ext, skip = _extend_targets(targets.to(device), target_lengths, blank)
+
+    loss = ChunkedCtcLoss.apply(
+        logits, ext, skip, input_lengths, target_lengths, chunk_size, zero_infinity
+    )
+    if reduction == "none":
+        return loss
+    elif reduction == "sum":
+        return loss.sum()
+    elif reduction == "mean":
+        return (loss / target_lengths.clamp(min=1)).mean()
+    else:
+        raise ValueError(f"invalid reduction: {reduction}")
@@ -15,6 +15,7 @@ from dataclasses import dataclass, field
 from typing import Optional, Any
 
 from fairseq.data import AddTargetDataset, Dictionary, encoders
+from fairseq.data.audio.binarized_labels import BinarizedLabels
 from fairseq.tasks.audio_pretraining import AudioPretrainingTask, AudioPretrainingConfig
 from fairseq.dataclass import FairseqDataclass
 from fairseq.dataclass.configs import GenerationConfig
@@ -137,21 +138,36 @@ class AudioFinetuningTask(AudioPretrainingTask):
         data_path = self.cfg.data
         label_path = os.path.join(data_path, f"{split}.{task_cfg.labels}")
         skipped_indices = getattr(self.datasets[split], "skipped_indices", set())
-        text_compressor = TextCompressor(level=text_compression_level)
-        with open(label_path, "r") as f:
-            labels = [
-                text_compressor.compress(l)
-                for i, l in enumerate(f)
-                if i not in skipped_indices
-            ]
+        process_label = LabelEncoder(self.target_dictionary)
+        binarized = BinarizedLabels.exists(label_path)
+        if binarized and not BinarizedLabels.matches(
+            label_path, self.target_dictionary
+        ):
+            logger.warning(
+                f"{label_path}.bin was not binarized from the current {label_path} "
+                f"and dict.{task_cfg.labels}.txt, loading the text labels instead; "
+                "rerun examples/wav2vec/binarize_labels.py to update it"
+            )
+            binarized = False
+        if binarized:
+            # written by examples/wav2vec/binarize_labels.py
+            logger.info(f"loading binarized labels from {label_path}.bin")
+            labels = BinarizedLabels(label_path, skipped_indices)
+            process_label = None
+        else:
+            text_compressor = TextCompressor(level=text_compression_level)
+            with open(label_path, "r") as f:
+                labels = [
+                    text_compressor.compress(l)
+                    for i, l in enumerate(f)
+                    if i not in skipped_indices
+                ]
 
         assert len(labels) == len(self.datasets[split]), (
             f"labels length ({len(labels)}) and dataset length "
             f"({len(self.datasets[split])}) do not match"
         )
 
-        process_label = LabelEncoder(self.target_dictionary)
-
         self.datasets[split] = AddTargetDataset(
             self.datasets[split],
             labels,
@@ -170,7 +186,23 @@ class AudioFinetuningTask(AudioPretrainingTask):
         model."""
         return self.state.target_dictionary
 
+    def _set_aux_outputs(self, model, criterion):
+        # let the model skip auxiliary outputs the criterion does not consume
+        if hasattr(model, "set_aux_outputs") and hasattr(
+            criterion, "required_aux_outputs"
+        ):
+            model.set_aux_outputs(criterion.required_aux_outputs())
+
+    def train_step(
+        self, sample, model, criterion, optimizer, update_num, ignore_grad=False
+    ):
+        self._set_aux_outputs(model, criterion)
+        return super().train_step(
+            sample, model, criterion, optimizer, update_num, ignore_grad
+        )
+
     def valid_step(self, sample, model, criterion):
+        self._set_aux_outputs(model, criterion)
         loss, sample_size, logging_output = super().valid_step(sample, model, criterion)
         if self.cfg.eval_wer and self.cfg.autoregressive:
             metrics = self._inference_with_wer(self.sequence_generator, sample, model)
@@ -15,6 +15,7 @@ from typing import Optional
 from omegaconf import MISSING, II
 
 from fairseq.data import BinarizedAudioDataset, FileAudioDataset, SubsampleDataset
+from fairseq.data.audio.raw_audio_dataset import RawAudioDataset
 from fairseq.dataclass import FairseqDataclass, ChoiceEnum
 from fairseq.data.text_compressor import TextCompressionLevel
 
@@ -23,6 +24,8 @@ from . import FairseqTask, register_task
 
 logger = logging.getLogger(__name__)
 
+AUDIO_CACHE_DTYPE_CHOICES = ChoiceEnum(["int16", "float16"])
+
 
 @dataclass
 class AudioMaskingConfig:
@@ -74,6 +77,13 @@ class AudioPretrainingConfig(FairseqDataclass):
         default=0,
         metadata={"help": "number of buckets"},
     )
+    min_padding_batches: bool = field(
+        default=False,
+        metadata={
+            "help": "place the batch boundaries to minimize padding, with as few "
+            "batches as greedy batching, instead of filling batches greedily"
+        },
+    )
     tpu: bool = II("common.tpu")
     text_compression_level: ChoiceEnum([x.name for x in TextCompressionLevel]) = field(
         default="none",
@@ -82,6 +92,31 @@ class AudioPretrainingConfig(FairseqDataclass):
             "target texts): none/low/high (default: none). "
         },
     )
+    audio_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "if set, cache decoded waveforms of the manifest datasets in "
+            "memory-mapped files in this directory, so that files are decoded once "
+            "instead of every epoch"
+        },
+    )
+    audio_cache_dtype: AUDIO_CACHE_DTYPE_CHOICES = field(
+        default="int16",
+        metadata={
+            "help": "storage type of --audio-cache-dir; int16 is lossless for "
+            "16-bit audio"
+        },
+    )
+    feature_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "if set, the outputs of the frozen conv feature extractor of "
+            "wav2vec 2.0 models (feature_grad_mult 0) are cached in memory-mapped "
+            "float16 files in this directory, one per dataset, and reused in later "
+            "epochs; a cache is rebuilt when the conv weights change. Unless "
+            "extractor_mode is layer_norm, only unpadded batches use the cache"
+        },
+    )
 
     rebuild_batches: bool = True
     precompute_mask_config: Optional[AudioMaskingConfig] = None
@@ -121,6 +156,8 @@ class AudioPretrainingTask(FairseqTask):
             TextCompressionLevel, str(self.cfg.text_compression_level)
         )
 
+        feature_cache_key = split if self.cfg.feature_cache_dir is not None else None
+
         compute_mask = task_cfg.precompute_mask_config is not None
         mask_args = {}
         if compute_mask:
@@ -137,6 +174,8 @@ class AudioPretrainingTask(FairseqTask):
                 normalize=task_cfg.normalize,
                 num_buckets=self.cfg.num_batch_buckets or int(self.cfg.tpu),
                 compute_mask=compute_mask,
+                min_padding_batches=self.cfg.min_padding_batches,
+                feature_cache_key=feature_cache_key,
                 **mask_args,
             )
         else:
@@ -151,7 +190,11 @@ class AudioPretrainingTask(FairseqTask):
                 normalize=task_cfg.normalize,
                 num_buckets=self.cfg.num_batch_buckets or int(self.cfg.tpu),
                 text_compression_level=text_compression_level,
+                audio_cache_dir=self.cfg.audio_cache_dir,
+                audio_cache_dtype=str(self.cfg.audio_cache_dtype),
                 compute_mask=compute_mask,
+                min_padding_batches=self.cfg.min_padding_batches,
+                feature_cache_key=feature_cache_key,
                 **mask_args,
             )
 
@@ -185,6 +228,49 @@ class AudioPretrainingTask(FairseqTask):
 
         return model
 
+    def begin_epoch(self, epoch, model):
+        self.update_feature_cache(model)
+
+    def begin_valid_epoch(self, epoch, model):
+        self.update_feature_cache(model)
+
+    def update_feature_cache(self, model):
+        """Lets the frozen feature extractors of *model* cache their outputs
+        for the loaded datasets in ``feature_cache_dir``. Called before every
+        epoch, so that caches of outdated conv weights are rebuilt."""
+        if self.cfg.feature_cache_dir is None:
+            return
+        from fairseq.models.wav2vec import Wav2Vec2Model
+        from fairseq.models.wav2vec.feature_cache import ConvFeatureCache
+
+        datasets = {}
+        for dataset in self.datasets.values():
+            while not isinstance(dataset, RawAudioDataset) and hasattr(
+                dataset, "dataset"
+            ):
+                dataset = dataset.dataset
+            if getattr(dataset, "feature_cache_key", None) is not None:
+                datasets[dataset.feature_cache_key] = dataset.sizes
+
+        for m in model.modules():
+            if not isinstance(m, Wav2Vec2Model):
+                continue
+            if m.feature_grad_mult != 0:
+                logger.warning(
+                    "feature_cache_dir is ignored, the feature extractor is "
+                    f"trained (feature_grad_mult {m.feature_grad_mult})"
+                )
+                continue
+            if m.feature_cache is None:
+                if m.cfg.extractor_mode != "layer_norm":
+                    logger.warning(
+                        "the conv features of padded batches depend on their "
+                        f"padding with extractor_mode {m.cfg.extractor_mode}, "
+                        "only unpadded batches use feature_cache_dir"
+                    )
+                m.feature_cache = ConvFeatureCache(self.cfg.feature_cache_dir)
+            m.feature_cache.update(m, datasets)
+
     def post_save(self, cp_path, num_updates):
         if self.cfg.post_save_script is not None:
             logger.info(f"launching {self.cfg.post_save_script}")
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+import io
+import json
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from argparse import Namespace
+
+import torch
+from examples.speech_recognition.serve import AsrServer, make_http_server
+from examples.speech_recognition.w2l_decoder import W2lGreedyDecoder
+from fairseq import options
+from fairseq.data import Dictionary
+from fairseq.data.data_utils import post_process
+from fairseq.dataclass.utils import convert_namespace_to_omegaconf
+from fairseq.models.wav2vec.wav2vec2_asr import Wav2Vec2CtcConfig, Wav2VecCtc
+
+try:
+    import soundfile as sf
+except ImportError:
+    sf = None
+
+
+def build_model(tgt_dict, *extra_args):
+    w2v_args = options.parse_args_and_arch(
+        options.get_training_parser(),
+        [
+            "unused",
+            "--task",
+            "audio_pretraining",
+            "--arch",
+            "wav2vec2",
+            "--conv-feature-layers",
+            "[(32, 10, 5)] + [(32, 3, 2)] * 4 + [(32, 2, 2)] * 2",
+            "--encoder-layers",
+            "1",
+            "--encoder-embed-dim",
+            "32",
+            "--encoder-ffn-embed-dim",
+            "64",
+            "--encoder-attention-heads",
+            "2",
+            "--conv-pos",
+            "16",
+            *extra_args,
+        ],
+    )
+    cfg = Wav2Vec2CtcConfig(
+        w2v_path="unused",
+        w2v_args=convert_namespace_to_omegaconf(w2v_args),
+        normalize=False,
+        data="unused",
+    )
+    return Wav2VecCtc.build_model(cfg, Namespace(target_dictionary=tgt_dict))
+
+
+class TestAsrServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        torch.manual_seed(0)
+        cls.tgt_dict = Dictionary()
+        for c in "|ETAONIHS":
+            cls.tgt_dict.add_symbol(c)
+        cls.model = build_model(cls.tgt_dict).eval()
+        cls.decoder = W2lGreedyDecoder(Namespace(nbest=1), cls.tgt_dict)
+
+    def _server(self, **kwargs):
+        return AsrServer(self.model, self.decoder, self.tgt_dict, **kwargs)
+
+    def _transcribe_alone(self, waveform):
+        sample = {
+            "net_input": {
+                "source": waveform.unsqueeze(0),
+                "padding_mask": torch.zeros(1, len(waveform), dtype=torch.bool),
+            }
+        }
+        with torch.no_grad():
+            hypos = self.decoder.generate([self.model], sample)
+        return post_process(self.tgt_dict.string(hypos[0][0]["tokens"]), "letter")
+
+    def _submit_concurrently(self, server, waveforms):
+        futures = [None] * len(waveforms)
+
+        def submit(i):
+            futures[i] = server.submit(waveforms[i])
+
+        threads = [
+            threading.Thread(target=submit, args=(i,)) for i in range(len(waveforms))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [f.result(timeout=60)["text"] for f in futures]
+
+    def test_matches_unbatched(self):
+        waveforms = [torch.randn(n) for n in [8000, 3000, 12000, 5000]]
+        server = self._server(max_batch_frames=1, max_batch_delay=0.01)
+        try:
+            texts = [server.transcribe(w, timeout=60)["text"] for w in waveforms]
+        finally:
+            server.close()
+        self.assertEqual(texts, [self._transcribe_alone(w) for w in waveforms])
+        self.assertEqual(server.metrics()["batches"], 4)
+
+    def test_dynamic_batching(self):
+        # same lengths, so that batching does not add padding
+        waveforms = [torch.randn(4000) for _ in range(4)]
+        expected = [self._transcribe_alone(w) for w in waveforms]
+
+        # all requests fit into one batch and arrive before its deadline
+        server = self._server(max_batch_frames=16000, max_batch_delay=5)
+        try:
+            self.assertEqual(self._submit_concurrently(server, waveforms), expected)
+        finally:
+            server.close()
+        self.assertEqual(server.metrics()["batches"], 1)
+
+        # the frame budget splits them
+        server = self._server(max_batch_frames=8000, max_batch_delay=5)
+        try:
+            self.assertEqual(self._submit_concurrently(server, waveforms), expected)
+        finally:
+            server.close()
+        self.assertEqual(server.metrics()["batches"], 2)
+
+    def test_deadline_and_metrics(self):
+        server = self._server(max_batch_frames=10**9, max_batch_delay=0.1)
+        try:
+            result = server.transcribe(torch.randn(16000), timeout=60)
+            server.transcribe(torch.randn(8000), timeout=60)
+        finally:
+            server.close()
+        self.assertGreaterEqual(result["latency"], 0.1)
+        metrics = server.metrics()
+        self.assertEqual(metrics["requests"], 2)
+        self.assertAlmostEqual(metrics["audio_seconds"], 1.5)
+        self.assertLessEqual(metrics["latency_p50_ms"], metrics["latency_p99_ms"])
+        self.assertGreater(metrics["rtf"], 0)
+        self.assertAlmostEqual(
+            metrics["rtf"], metrics["encoder_rtf"] + metrics["decoder_rtf"]
+        )
+
+    @unittest.skipIf(sf is None, "soundfile is not installed")
+    def test_http(self):
+        waveform = torch.randn(8000) * 0.1
+        wav = io.BytesIO()
+        sf.write(wav, waveform.numpy(), 16000, format="WAV", subtype="FLOAT")
+
+        server = self._server(max_batch_delay=0.01)
+        http_server = make_http_server(server, port=0)
+        thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+        thread.start()
+        url = f"http://localhost:{http_server.server_address[1]}"
+        try:
+            with urllib.request.urlopen(f"{url}/transcribe", wav.getvalue()) as r:
+                result = json.load(r)
+            with urllib.request.urlopen(f"{url}/metrics") as r:
+                metrics = json.load(r)
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+            server.close()
+        self.assertEqual(result["text"], self._transcribe_alone(waveform))
+        self.assertEqual(metrics["requests"], 1)
+
+    @unittest.skipIf(sf is None, "soundfile is not installed")
+    def test_http_errors(self):
+        def post(server, waveform):
+            wav = io.BytesIO()
+            sf.write(wav, waveform.numpy(), 16000, format="WAV", subtype="FLOAT")
+            http_server = make_http_server(server, port=0)
+            thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+            thread.start()
+            url = f"http://localhost:{http_server.server_address[1]}/transcribe"
+            try:
+                with self.assertRaises(urllib.error.HTTPError) as e:
+                    urllib.request.urlopen(url, wav.getvalue())
+                return e.exception.code, json.load(e.exception)["error"]
+            finally:
+                http_server.shutdown()
+                http_server.server_close()
+                server.close()
+
+        code, _ = post(self._server(), torch.zeros(0))
+        self.assertEqual(code, 400)
+
+        def decode_async(emissions):
+            raise RuntimeError("decoder failed")
+
+        server = AsrServer(
+            self.model, Namespace(decode_async=decode_async), self.tgt_dict
+        )
+        code, error = post(server, torch.randn(8000) * 0.1)
+        self.assertEqual(code, 500)
+        self.assertEqual(error, "decoder failed")
+
+
+if __name__ == "__main__":
+    unittest.main()
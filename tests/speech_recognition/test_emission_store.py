@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+from examples.speech_recognition.utils.emission_store import (
+    PRUNED_LOG_PROB,
+    EmissionStore,
+    EmissionStoreWriter,
+)
+
+
+class EmissionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "emissions")
+        torch.manual_seed(0)
+        self.emissions = torch.randn(3, 7, 5).log_softmax(-1)
+        self.lengths = torch.LongTensor([7, 2, 5])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_write_and_read(self):
+        writer = EmissionStoreWriter(self.path, 5)
+        writer.add(torch.LongTensor([4, 0, 9]), self.emissions, self.lengths)
+        writer.close()
+
+        store = EmissionStore(self.path)
+        self.assertEqual(sorted(store.ids()), [0, 4, 9])
+        for i, id in enumerate([4, 0, 9]):
+            expected = self.emissions[i, : self.lengths[i]].half().float().numpy()
+            np.testing.assert_array_equal(store[id], expected)
+
+        batch = store.batch([0, 9], blank_idx=0)
+        self.assertEqual(tuple(batch.shape), (2, 5, 5))
+        np.testing.assert_array_equal(batch[1].numpy(), store[9])
+        # padding frames are certain blanks
+        self.assertTrue(batch[0, 2:, 0].eq(0).all())
+        self.assertTrue(batch[0, 2:, 1:].eq(PRUNED_LOG_PROB).all())
+
+    def test_topk(self):
+        writer = EmissionStoreWriter(self.path, 5, topk=2)
+        writer.add([1, 2, 3], self.emissions, self.lengths)
+        writer.close()
+
+        store = EmissionStore(self.path)
+        row = store[1]
+        best = self.emissions[0].topk(2, dim=-1)
+        np.testing.assert_array_equal(
+            np.take_along_axis(row, best.indices.numpy(), 1),
+            best.values.half().float().numpy(),
+        )
+        self.assertEqual((row == PRUNED_LOG_PROB).sum(), 7 * 3)
+        with self.assertRaises(AssertionError):
+            EmissionStoreWriter(self.path, 5)
+
+    def test_resume_after_interrupted_write(self):
+        writer = EmissionStoreWriter(self.path, 5)
+        writer.add([0, 1, 2], self.emissions, self.lengths)
+        writer.close()
+        # a crash left a partial index record behind
+        with open(os.path.join(self.path, "shard0.0.index"), "ab") as f:
+            f.write(b"\0" * 5)
+
+        self.assertEqual(len(EmissionStore(self.path)), 3)
+        writer = EmissionStoreWriter(self.path, 5)
+        writer.add([2, 3], self.emissions[1:], self.lengths[1:])
+        writer.close()
+
+        store = EmissionStore(self.path)
+        self.assertEqual(sorted(store.ids()), [0, 1, 2, 3])
+        # the later copy of utterance 2 wins
+        self.assertEqual(store.num_frames(2), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from examples.speech_recognition.utils.lexicon_trie import (
+    LexiconTrieCache,
+    lexicon_fingerprint,
+)
+from fairseq.data import Dictionary
+
+
+class LexiconTrieCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.lexicon = os.path.join(self.tmpdir.name, "lexicon.txt")
+        with open(self.lexicon, "w") as f:
+            f.write("A\tA |\nAB\tA B |\n")
+        self.lm = os.path.join(self.tmpdir.name, "lm.bin")
+        with open(self.lm, "wb") as f:
+            f.write(b"lm")
+        self.tgt_dict = Dictionary()
+        for c in "|AB":
+            self.tgt_dict.add_symbol(c)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_save_and_load(self):
+        fingerprint = lexicon_fingerprint(self.lexicon, self.lm, self.tgt_dict, 4)
+        cache = LexiconTrieCache(os.path.join(self.tmpdir.name, "cache"), fingerprint)
+        self.assertFalse(cache.exists())
+        spellings = [[5, 4], [5, 6, 4], [6]]
+        cache.save(["<unk>", "A", "AB"], 0, spellings, [1, 2, 2], [-1.5, -2.0, -3.25])
+
+        self.assertTrue(cache.exists())
+        words, unk_word, arrays = cache.load()
+        self.assertEqual(words, ["<unk>", "A", "AB"])
+        self.assertEqual(unk_word, 0)
+        offsets = arrays["offsets"]
+        for i, spelling in enumerate(spellings):
+            self.assertEqual(
+                arrays["spellings"][offsets[i] : offsets[i + 1]].tolist(), spelling
+            )
+        np.testing.assert_array_equal(arrays["word_idxs"], [1, 2, 2])
+        np.testing.assert_array_equal(arrays["scores"], [-1.5, -2.0, -3.25])
+
+    def test_fingerprint(self):
+        fingerprint = lexicon_fingerprint(self.lexicon, self.lm, self.tgt_dict, 4)
+        self.assertEqual(
+            fingerprint, lexicon_fingerprint(self.lexicon, self.lm, self.tgt_dict, 4)
+        )
+        self.assertNotEqual(
+            fingerprint, lexicon_fingerprint(self.lexicon, self.lm, self.tgt_dict, 5)
+        )
+        with open(self.lexicon, "a") as f:
+            f.write("B\tB |\n")
+        self.assertNotEqual(
+            fingerprint, lexicon_fingerprint(self.lexicon, self.lm, self.tgt_dict, 4)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+import argparse
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import torch
+from examples.speech_recognition.utils.lm_scoring import BatchedLMScorer
+from fairseq.data import Dictionary
+from fairseq.models.transformer_lm import (
+    TransformerLanguageModel,
+    base_lm_architecture,
+)
+
+
+class BatchedLMScorerTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.dictionary = Dictionary()
+        for i in range(20):
+            self.dictionary.add_symbol(f"w{i}")
+        args = argparse.Namespace(
+            decoder_layers=2,
+            decoder_embed_dim=16,
+            decoder_ffn_embed_dim=32,
+            decoder_attention_heads=2,
+            tokens_per_sample=64,
+        )
+        base_lm_architecture(args)
+        task = SimpleNamespace(
+            source_dictionary=self.dictionary, target_dictionary=self.dictionary
+        )
+        self.model = TransformerLanguageModel.build_model(args, task).eval()
+        eos = self.dictionary.eos()
+        self.prefixes = [(eos,), (eos, 5), (eos, 5, 7, 9), (eos, 12, 4)]
+
+    def _reference(self, prefix):
+        with torch.no_grad():
+            res = self.model(torch.LongTensor([prefix]))
+            lprobs = self.model.get_normalized_probs(res, log_probs=True, sample=None)
+        return lprobs[0, -1]
+
+    def test_batched_scores_match_single_prefix_forward(self):
+        scorer = BatchedLMScorer(self.model, self.dictionary, capacity=8, max_batch=4)
+        for prefix in self.prefixes[1:]:
+            scorer.prefetch(prefix)
+        for prefix in self.prefixes:
+            reference = self._reference(prefix)
+            for token in [4, 10, self.dictionary.eos()]:
+                self.assertAlmostEqual(
+                    scorer.score(prefix, token), reference[token].item(), places=5
+                )
+        # the first miss scored all the prefetched prefixes with it
+        self.assertEqual(scorer.forwards, 1)
+        self.assertEqual(scorer.misses, 1)
+        self.assertEqual(scorer.hits, 11)
+        self.assertEqual(scorer.scored_tokens, 10)
+
+    def test_lru_eviction(self):
+        scorer = BatchedLMScorer(self.model, self.dictionary, capacity=2, max_batch=1)
+        for prefix in [self.prefixes[0], self.prefixes[1], self.prefixes[0]]:
+            scorer.score(prefix, 4)
+        self.assertEqual((scorer.misses, scorer.hits), (2, 1))
+        # evicts prefixes[1], the least recently used
+        scorer.score(self.prefixes[2], 4)
+        self.assertEqual(set(scorer.slots), {self.prefixes[0], self.prefixes[2]})
+        self.assertAlmostEqual(
+            scorer.score(self.prefixes[1], 4),
+            self._reference(self.prefixes[1])[4].item(),
+            places=5,
+        )
+        self.assertEqual(scorer.misses, 4)
+
+    def test_rows_are_allocated_lazily(self):
+        with patch.object(BatchedLMScorer, "BLOCK_BYTES", 1):
+            scorer = BatchedLMScorer(
+                self.model, self.dictionary, capacity=3, max_batch=1
+            )
+        self.assertEqual(len(scorer.blocks), 0)
+        for prefix in self.prefixes:
+            self.assertAlmostEqual(
+                scorer.score(prefix, 4), self._reference(prefix)[4].item(), places=5
+            )
+        # one row per block, the fourth prefix reuses an evicted row
+        self.assertEqual(len(scorer.blocks), 3)
+        self.assertAlmostEqual(
+            scorer.score(self.prefixes[3], 10),
+            self._reference(self.prefixes[3])[10].item(),
+            places=5,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+import unittest
+from argparse import Namespace
+
+import torch
+from examples.speech_recognition.utils.long_form import (
+    LongFormDecoder,
+    feature_stride,
+    stitch_emissions,
+    window_spans,
+)
+from examples.speech_recognition.w2l_decoder import W2lGreedyDecoder
+from fairseq.data import Dictionary
+from tests.speech_recognition.test_asr_server import build_model
+
+
+def make_sample(waveforms):
+    lengths = torch.LongTensor([len(w) for w in waveforms])
+    source = torch.zeros(len(waveforms), int(lengths.max()))
+    for i, w in enumerate(waveforms):
+        source[i, : len(w)] = w
+    padding_mask = torch.arange(source.size(1)) >= lengths.unsqueeze(1)
+    return {"net_input": {"source": source, "padding_mask": padding_mask}}
+
+
+class TestLongForm(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        torch.manual_seed(0)
+        cls.tgt_dict = Dictionary()
+        for c in "|ETAONIHS":
+            cls.tgt_dict.add_symbol(c)
+        # the group norm of the default feature extractor sees the padding of
+        # a batch, the layer norms do not
+        cls.model = build_model(cls.tgt_dict, "--extractor-mode", "layer_norm")
+        cls.model.eval()
+        cls.w2v_model = cls.model.w2v_encoder.w2v_model
+        cls.decoder = W2lGreedyDecoder(Namespace(nbest=1), cls.tgt_dict)
+
+    def test_window_spans(self):
+        for num_samples in [100, 1000, 1001, 1320, 5000]:
+            spans = window_spans(num_samples, window=1000, hop=640, stride=320)
+            self.assertEqual(spans[0][0], 0)
+            self.assertEqual(spans[-1][1], num_samples)
+            for (start, end), (next_start, _) in zip(spans, spans[1:]):
+                self.assertEqual(start % 320, 0)
+                self.assertEqual(end - start, 1000)
+                self.assertLess(start, next_start)
+                self.assertLess(next_start, end)
+            self.assertGreaterEqual(spans[-1][1] - spans[-1][0], min(num_samples, 681))
+
+    def test_stitch_emissions(self):
+        # windows of the same emissions are stitched back into them
+        emissions = torch.randn(50, 5)
+        offsets = [0, 12, 24, 30]
+        chunks = [emissions[o : o + 20] for o in offsets]
+        stitched = stitch_emissions(chunks, offsets, 50)
+        self.assertTrue(torch.allclose(stitched, emissions))
+
+        # overlaps are cross-faded from one window to the next
+        chunks = [torch.zeros(6, 1), torch.ones(6, 1)]
+        stitched = stitch_emissions(chunks, [0, 4], 10).squeeze(-1)
+        self.assertEqual(stitched.tolist(), [0, 0, 0, 0, 0.25, 0.75, 1, 1, 1, 1])
+
+    def _generate(self, generator, waveforms):
+        with torch.no_grad():
+            hypos = generator.generate([self.model], make_sample(waveforms))
+        return [h[0]["tokens"].tolist() for h in hypos]
+
+    def test_single_window_matches_whole_utterances(self):
+        waveforms = [torch.randn(n) for n in [8000, 8000]]
+        generator = LongFormDecoder(self.decoder, window=8000, overlap=1600)
+        self.assertEqual(
+            self._generate(generator, waveforms),
+            self._generate(self.decoder, waveforms),
+        )
+
+    def test_windows_batched_across_utterances(self):
+        waveforms = [torch.randn(n) for n in [20000, 7000, 13000]]
+        generator = LongFormDecoder(
+            self.decoder, window=4000, overlap=960, max_windows=4
+        )
+        with torch.no_grad():
+            emissions, lengths = generator.get_emissions(
+                [self.model], make_sample(waveforms)
+            )
+        expected = self.w2v_model._get_feat_extract_output_lengths(
+            torch.LongTensor([len(w) for w in waveforms])
+        )
+        self.assertEqual(lengths.tolist(), expected.tolist())
+        self.assertEqual(emissions.shape[:2], (3, expected.max()))
+        self.assertFalse(torch.isnan(emissions).any())
+        # padding frames are certain blanks
+        self.assertEqual(emissions[1, lengths[1] :].argmax(-1).unique().tolist(), [0])
+        self.assertEqual(feature_stride(self.w2v_model), 320)
+
+        # the windows of an utterance do not depend on the other utterances
+        for i, w in enumerate(waveforms):
+            with torch.no_grad():
+                alone, _ = generator.get_emissions([self.model], make_sample([w]))
+            self.assertTrue(
+                torch.allclose(alone[0], emissions[i, : lengths[i]], atol=1e-4)
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from fairseq.data import AddTargetDataset, Dictionary, FairseqDataset, data_utils
+from fairseq.data.audio.binarized_labels import BinarizedLabels, binarize_labels
+from fairseq.tasks.audio_finetuning import LabelEncoder, label_len_fn
+
+
+class IdDataset(FairseqDataset):
+    def __init__(self, n):
+        self.n = n
+
+    def __getitem__(self, index):
+        return {"id": index}
+
+    def __len__(self):
+        return self.n
+
+    def size(self, index):
+        return 100 * index
+
+    def num_tokens_vec(self, indices):
+        return 100 * indices
+
+    def collater(self, samples):
+        return {"id": torch.LongTensor([s["id"] for s in samples]), "net_input": {}}
+
+
+class TestBinarizedLabels(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dictionary = Dictionary()
+        for c in "ABC|":
+            self.dictionary.add_symbol(c)
+        self.lines = ["A B | C |", "C |", "B B A |", "A D |"]
+        self.label_path = os.path.join(self.tmpdir.name, "train.ltr")
+        with open(self.label_path, "w") as f:
+            for line in self.lines:
+                print(line, file=f)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _dataset(self, labels, process_label):
+        return AddTargetDataset(
+            IdDataset(len(labels)),
+            labels,
+            pad=self.dictionary.pad(),
+            eos=self.dictionary.eos(),
+            batch_targets=True,
+            process_label=process_label,
+            label_len_fn=label_len_fn,
+        )
+
+    def test_matches_text_labels(self):
+        self.assertEqual(binarize_labels(self.label_path, self.dictionary), 4)
+        self.assertTrue(BinarizedLabels.exists(self.label_path))
+        text = self._dataset(
+            [line.encode() for line in self.lines], LabelEncoder(self.dictionary)
+        )
+        binarized = self._dataset(BinarizedLabels(self.label_path), None)
+
+        for i in range(len(self.lines)):
+            self.assertTrue(torch.equal(binarized[i]["label"], text[i]["label"]))
+            self.assertEqual(binarized.size(i), text.size(i))
+        # unknown symbols are encoded as <unk>, as with LabelEncoder
+        self.assertEqual(binarized[3]["label"][1].item(), self.dictionary.unk())
+
+        samples = [binarized[i] for i in range(4)]
+        expected = text.collater([text[i] for i in range(4)])
+        collated = binarized.collater(samples)
+        self.assertTrue(torch.equal(collated["target"], expected["target"]))
+        self.assertEqual(collated["ntokens"], expected["ntokens"])
+
+    def test_skipped_indices(self):
+        binarize_labels(self.label_path, self.dictionary)
+        labels = BinarizedLabels(self.label_path, skipped_indices={0, 2})
+        self.assertEqual(len(labels), 2)
+        self.assertEqual(labels.sizes.tolist(), [2, 3])
+        self.assertEqual(self.dictionary.string(labels[1]), "A <unk> |")
+
+    def test_matches(self):
+        binarize_labels(self.label_path, self.dictionary)
+        self.assertTrue(BinarizedLabels.matches(self.label_path, self.dictionary))
+
+        dictionary = Dictionary()
+        for c in "ABCD|":
+            dictionary.add_symbol(c)
+        self.assertFalse(BinarizedLabels.matches(self.label_path, dictionary))
+
+        with open(self.label_path, "a") as f:
+            print("D |", file=f)
+        self.assertFalse(BinarizedLabels.matches(self.label_path, self.dictionary))
+
+        binarize_labels(self.label_path, self.dictionary)
+        self.assertTrue(BinarizedLabels.matches(self.label_path, self.dictionary))
+        # binarized before the hashes were written
+        os.remove(self.label_path + ".json")
+        self.assertFalse(BinarizedLabels.matches(self.label_path, self.dictionary))
+
+    def test_filter_indices_by_size(self):
+        text = self._dataset(
+            [line.encode() for line in self.lines], LabelEncoder(self.dictionary)
+        )
+        binarize_labels(self.label_path, self.dictionary)
+        binarized = self._dataset(BinarizedLabels(self.label_path), None)
+        indices = np.array([3, 1, 0, 2])
+        for max_sizes in [(1000, 1000), (150, None), (None, 3), (250, 4), (0, 0)]:
+            expected = data_utils._filter_by_size_dynamic(
+                indices, text.size, max_sizes
+            )
+            for dataset in [text, binarized]:
+                filtered, ignored = dataset.filter_indices_by_size(indices, max_sizes)
+                self.assertEqual(filtered.tolist(), expected[0].tolist())
+                self.assertEqual(ignored, expected[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+from argparse import Namespace
+
+import torch
+import torch.nn.functional as F
+
+from fairseq.criterions.ctc import CtcCriterion, CtcCriterionConfig
+from fairseq.data import Dictionary
+from fairseq.modules import chunked_ctc_loss
+from tests.speech_recognition.test_asr_server import build_model
+
+
+class TestChunkedCtcLoss(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.logits = torch.randn(50, 5, 6, dtype=torch.float64) * 3
+        self.input_lengths = torch.LongTensor([50, 40, 33, 20, 2])
+        self.target_lengths = torch.LongTensor([10, 0, 7, 5, 3])
+        self.targets = torch.randint(1, 6, (5, 10))
+        # repeated labels need a blank in between
+        self.targets[2, :7] = torch.LongTensor([1, 1, 2, 2, 2, 3, 1])
+
+    def _grads(self, loss_fn, logits, **kwargs):
+        logits = logits.detach().requires_grad_()
+        loss = loss_fn(
+            logits,
+            self.targets,
+            self.input_lengths,
+            self.target_lengths,
+            **kwargs,
+        )
+        (grad,) = torch.autograd.grad(loss.sum(), logits)
+        return loss, grad
+
+    def test_matches_native_loss(self):
+        def native(logits, *args, **kwargs):
+            return F.ctc_loss(logits.log_softmax(-1), *args, **kwargs)
+
+        for reduction in ["none", "sum", "mean"]:
+            # the last utterance is too short for its targets
+            expected, expected_grad = self._grads(
+                native, self.logits, reduction=reduction, zero_infinity=True
+            )
+            for chunk_size in [None, 1, 7, 50, 64]:
+                loss, grad = self._grads(
+                    chunked_ctc_loss,
+                    self.logits,
+                    reduction=reduction,
+                    zero_infinity=True,
+                    chunk_size=chunk_size,
+                )
+                self.assertTrue(torch.allclose(loss, expected, rtol=0, atol=1e-10))
+                self.assertTrue(torch.allclose(grad, expected_grad, rtol=0, atol=1e-10))
+
+        loss = chunked_ctc_loss(
+            self.logits, self.targets, self.input_lengths, self.target_lengths
+        )
+        self.assertTrue(torch.isinf(loss))
+
+    def test_concatenated_targets(self):
+        targets = torch.cat([t[:n] for t, n in zip(self.targets, self.target_lengths)])
+        args = (self.input_lengths, self.target_lengths)
+        self.assertTrue(
+            torch.equal(
+                chunked_ctc_loss(self.logits, targets, *args, reduction="none"),
+                chunked_ctc_loss(self.logits, self.targets, *args, reduction="none"),
+            )
+        )
+
+    def test_half_precision(self):
+        logits = self.logits.half()
+        expected, expected_grad = self._grads(
+            lambda x, *args, **kwargs: F.ctc_loss(
+                x.float().log_softmax(-1), *args, **kwargs
+            ),
+            logits,
+            reduction="sum",
+            zero_infinity=True,
+        )
+        loss, grad = self._grads(
+            chunked_ctc_loss, logits, reduction="sum", zero_infinity=True
+        )
+        # accumulated in float32
+        self.assertEqual(loss.dtype, torch.float32)
+        self.assertEqual(grad.dtype, torch.float16)
+        self.assertTrue(torch.allclose(loss, expected, rtol=1e-5))
+        self.assertTrue(torch.allclose(grad.float(), expected_grad.float(), atol=1e-3))
+
+
+class TestCtcCriterionChunkSize(unittest.TestCase):
+    def test_matches_native_loss(self):
+        torch.manual_seed(0)
+        tgt_dict = Dictionary()
+        for c in "|ETAONIHS":
+            tgt_dict.add_symbol(c)
+        model = build_model(tgt_dict).eval()
+        task = Namespace(target_dictionary=tgt_dict)
+
+        lengths = torch.LongTensor([16000, 12000])
+        source = torch.randn(2, 16000)
+        target = torch.randint(tgt_dict.nspecial, len(tgt_dict), (2, 12))
+        target[1, 8:] = tgt_dict.pad()
+        sample = {
+            "id": torch.arange(2),
+            "net_input": {
+                "source": source,
+                "padding_mask": torch.arange(16000) >= lengths.unsqueeze(1),
+            },
+            "target": target,
+            "target_lengths": torch.LongTensor([12, 8]),
+            "ntokens": 20,
+        }
+
+        results = []
+        for ctc_chunk_size in [0, 8]:
+            criterion = CtcCriterion(
+                CtcCriterionConfig(sentence_avg=False, ctc_chunk_size=ctc_chunk_size),
+                task,
+            )
+            model.zero_grad()
+            loss, _, logging_output = criterion(model, sample)
+            loss.backward()
+            grads = [p.grad.clone() for p in model.parameters() if p.grad is not None]
+            results.append((loss, grads, logging_output["c_errors"]))
+
+        (expected, expected_grads, c_errors), (loss, grads, chunked_c_errors) = results
+        self.assertTrue(torch.allclose(loss, expected, rtol=1e-5))
+        self.assertEqual(len(grads), len(expected_grads))
+        for grad, expected_grad in zip(grads, expected_grads):
+            self.assertTrue(torch.allclose(grad, expected_grad, atol=1e-3))
+        self.assertEqual(chunked_c_errors, c_errors)
+
+
+if __name__ == "__main__":
+    unittest.main()
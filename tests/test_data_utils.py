@@ -3,10 +3,28 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import itertools
 import unittest
 
+import editdistance
 import numpy as np
+import torch
 
+from fairseq.data import Dictionary
+from fairseq.data.data_utils import (
+    batch_by_size,
+    batch_by_size_min_padding,
+    batch_edit_distance,
+    batch_word_ids,
+    collate_tokens,
+    compute_mask_indices,
+    compute_mask_indices_batched,
+    ctc_greedy_decode,
+    letter_word_separator,
+    pack_tokens,
+    padding_efficiency,
+    post_process,
+)
 from fairseq.data.data_utils_fast import batch_by_size_fn, batch_by_size_vec
 
 
@@ -132,5 +150,216 @@ class TestBatchBySizeFn(TestBatchBySize):
         self._run_compare_with_baseline_sweep(batch_by_size_fn_wrapper)
 
 
+class TestBatchBySizeMinPadding(unittest.TestCase):
+    @staticmethod
+    def _cost(sizes, batches):
+        return len(batches), sum(sizes[b].max() * len(b) for b in batches)
+
+    def _best_split(self, sizes, max_tokens, max_sentences, bsz_mult):
+        """(number of batches, padded tokens) of the best of all splits"""
+        best = None
+        for ends in itertools.product([False, True], repeat=len(sizes) - 1):
+            batches = np.split(np.arange(len(sizes)), np.flatnonzero(ends) + 1)
+            if all(
+                len(b) == 1
+                or (
+                    sizes[b].max() * len(b) <= max_tokens
+                    and len(b) <= max_sentences
+                    and (len(b) < bsz_mult or len(b) % bsz_mult == 0)
+                )
+                for b in batches
+            ):
+                cost = self._cost(sizes, batches)
+                best = cost if best is None else min(best, cost)
+        return best
+
+    def test_matches_exhaustive_search(self):
+        rng = np.random.RandomState(0)
+        for _ in range(200):
+            n = rng.randint(1, 9)
+            sizes = rng.randint(1, 10, size=n)
+            max_tokens = rng.randint(sizes.max(), 25)
+            max_sentences = rng.randint(1, 6)
+            bsz_mult = rng.randint(1, 4)
+            indices = rng.permutation(n)
+            batches = batch_by_size_min_padding(
+                indices, sizes, max_tokens, max_sentences, bsz_mult
+            )
+            # positions in indices, which num_tokens_vec is aligned with
+            batches = [np.argsort(indices)[b] for b in batches]
+            self.assertEqual(np.concatenate(batches).tolist(), list(range(n)))
+            self.assertEqual(
+                self._cost(sizes, batches),
+                self._best_split(sizes, max_tokens, max_sentences, bsz_mult),
+            )
+
+    def test_keeps_last_batch(self):
+        # the last batch is smaller than required_batch_size_multiple
+        batches = batch_by_size_min_padding(
+            np.arange(13), np.full(13, 100), 800, None, 8
+        )
+        self.assertEqual([len(b) for b in batches], [8, 5])
+
+    def test_not_more_batches_than_greedy(self):
+        rng = np.random.RandomState(0)
+        sizes = rng.randint(100, 1000, size=2000)
+        for indices in [np.arange(len(sizes)), np.argsort(sizes)[::-1]]:
+            for bsz_mult in [1, 8]:
+                greedy = batch_by_size(
+                    indices,
+                    None,
+                    num_tokens_vec=sizes[indices],
+                    max_tokens=10000,
+                    required_batch_size_multiple=bsz_mult,
+                )
+                batches = batch_by_size_min_padding(
+                    indices, sizes[indices], 10000, None, bsz_mult
+                )
+                self.assertEqual(
+                    sorted(np.concatenate(batches).tolist()), list(range(len(sizes)))
+                )
+                self.assertLessEqual(len(batches), len(greedy))
+                if bsz_mult == 1:
+                    self.assertEqual(len(batches), len(greedy))
+                    self.assertGreaterEqual(
+                        padding_efficiency(batches, sizes),
+                        padding_efficiency(greedy, sizes),
+                    )
+
+
+class TestBatchEditDistance(unittest.TestCase):
+    def test_matches_editdistance(self):
+        rng = np.random.RandomState(0)
+        for vocab_size in [2, 5, 30]:
+            hyps, refs = [], []
+            for _ in range(64):
+                hyps.append(
+                    torch.from_numpy(rng.randint(4, 4 + vocab_size, rng.randint(0, 40)))
+                )
+                refs.append(
+                    torch.from_numpy(rng.randint(4, 4 + vocab_size, rng.randint(0, 40)))
+                )
+            hyps.append(torch.LongTensor([])), refs.append(torch.LongTensor([]))
+            hyp_lens = torch.LongTensor([len(h) for h in hyps])
+            ref_lens = torch.LongTensor([len(r) for r in refs])
+            # pad with a symbol that occurs in the sequences to catch leaks
+            hyps_padded = collate_tokens(
+                [h.long() for h in hyps] + [torch.zeros(1).long()], 4
+            )[:-1]
+            refs_padded = collate_tokens(
+                [r.long() for r in refs] + [torch.zeros(1).long()], 4
+            )[:-1]
+
+            dist = batch_edit_distance(hyps_padded, hyp_lens, refs_padded, ref_lens)
+            expected = [
+                editdistance.eval(h.tolist(), r.tolist()) for h, r in zip(hyps, refs)
+            ]
+            self.assertEqual(dist.tolist(), expected)
+
+
+class TestCtcGreedyDecode(unittest.TestCase):
+    def test_matches_groupby(self):
+        torch.manual_seed(0)
+        # few classes so that repeats and blanks are frequent
+        emissions = torch.randn(16, 50, 4).log_softmax(-1)
+        input_lengths = torch.randint(0, 51, (16,))
+        tokens, lengths, timesteps, scores = ctc_greedy_decode(
+            emissions, input_lengths, blank_idx=0, pad_idx=1
+        )
+        for b, length in enumerate(input_lengths.tolist()):
+            best = emissions[b, :length].argmax(-1).tolist()
+            expected, expected_timesteps, frame = [], [], 0
+            for tok, group in itertools.groupby(best):
+                if tok != 0:
+                    expected.append(tok)
+                    expected_timesteps.append(frame)
+                frame += len(list(group))
+            self.assertEqual(tokens[b, : lengths[b]].tolist(), expected)
+            self.assertEqual(timesteps[b, : lengths[b]].tolist(), expected_timesteps)
+            self.assertTrue(tokens[b, lengths[b] :].eq(1).all())
+            self.assertAlmostEqual(
+                scores[b].item(),
+                emissions[b, :length].max(-1).values.sum().item(),
+                places=4,
+            )
+
+
+class TestBatchWordIds(unittest.TestCase):
+    def setUp(self):
+        self.dictionary = Dictionary()
+        for c in "|ABC":
+            self.dictionary.add_symbol(c)
+        self.separator = letter_word_separator(self.dictionary, "letter")
+
+    def test_letter_word_separator(self):
+        self.assertEqual(self.separator, self.dictionary.index("|"))
+        self.assertIsNone(letter_word_separator(self.dictionary, "wordpiece"))
+        # "A" + "AB" and "AA" + "B" spell the same word
+        self.dictionary.add_symbol("AA")
+        self.assertIsNone(letter_word_separator(self.dictionary, "letter"))
+
+    def test_pack_tokens(self):
+        tokens = torch.LongTensor([[5, 2, 6, 1], [2, 2, 7, 8]])
+        packed, lengths = pack_tokens(tokens, tokens.gt(2), pad_idx=1)
+        self.assertEqual(packed.tolist(), [[5, 6, 1, 1], [7, 8, 1, 1]])
+        self.assertEqual(lengths.tolist(), [2, 2])
+
+    def test_matches_string_split(self):
+        d = self.dictionary
+        rng = np.random.RandomState(0)
+        # separators, eos and bos are frequent
+        tokens = torch.from_numpy(rng.randint(0, len(d), (64, 20)))
+        lengths = torch.from_numpy(rng.randint(0, 21, 64))
+        words, word_lengths = batch_word_ids(
+            tokens, lengths, self.separator, ignore=(d.eos(), d.bos())
+        )
+        spellings = {}
+        for i in range(len(tokens)):
+            expected = post_process(d.string(tokens[i, : lengths[i]]), "letter")
+            expected = expected.split()
+            self.assertEqual(word_lengths[i].item(), len(expected))
+            for word_id, word in zip(words[i].tolist(), expected):
+                self.assertEqual(spellings.setdefault(word_id, word), word)
+        # different words got different ids
+        self.assertEqual(len(set(spellings.values())), len(spellings))
+
+
+class TestComputeMaskIndicesBatched(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        lengths = torch.LongTensor([300, 250, 120, 300])
+        self.padding_mask = torch.arange(300) >= lengths.unsqueeze(1)
+
+    def _masks(self, fn, n=100, **kwargs):
+        return np.stack(
+            [
+                np.asarray(fn((4, 300), self.padding_mask, 0.65, 10, **kwargs))
+                for _ in range(n)
+            ]
+        )
+
+    def test_masks_valid_frames_only(self):
+        for mask_type in ["static", "uniform", "normal", "poisson"]:
+            masks = self._masks(
+                compute_mask_indices_batched, mask_type=mask_type, mask_other=2
+            )
+            self.assertFalse(masks[:, self.padding_mask.numpy()].any())
+            # require_same_masks
+            self.assertTrue((masks.sum(-1) == masks.sum(-1)[:, :1]).all())
+
+    def test_matches_compute_mask_indices(self):
+        for mask_type in ["static", "normal", "poisson"]:
+            for kwargs in [
+                {"require_same_masks": False},
+                {"require_same_masks": True, "mask_dropout": 0.2},
+            ]:
+                kwargs.update(mask_type=mask_type, mask_other=2, min_masks=2)
+                expected = self._masks(compute_mask_indices, **kwargs)
+                masks = self._masks(compute_mask_indices_batched, **kwargs)
+                np.testing.assert_allclose(
+                    masks.mean((0, 2)), expected.mean((0, 2)), atol=0.05
+                )
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -114,6 +114,50 @@ class TestDictionary(unittest.TestCase):
         self.assertEqual(d.index("a"), 5)
         self.assertEqual(d.index("b"), 6)
 
+    def test_batch_string(self):
+        d = Dictionary()
+        for c in "ABC|":
+            d.add_symbol(c)
+        tokens = torch.LongTensor(
+            [[4, 5, 7, 6, d.unk(), 2], [6, 7, 4, 2, 1, 1], [2, 1, 1, 1, 1, 1]]
+        )
+        self.assertEqual(
+            d.batch_string(tokens, extra_symbols_to_ignore=[d.pad()]),
+            ["A B | C <unk>", "C | A", ""],
+        )
+        self.assertEqual(
+            d.batch_string(tokens, "letter", escape_unk=True, lengths=[4, 3, 0]),
+            ["AB C", "C A", ""],
+        )
+        self.assertEqual(
+            d.string(tokens, include_eos=True).split("\n"),
+            [d.string(t, include_eos=True) for t in tokens.tolist()],
+        )
+        self.assertEqual(
+            d.string(torch.LongTensor([4, d.unk(), 9]), unk_string="?"), "A ? <unk>"
+        )
+
+    def test_encode_letters(self):
+        d = Dictionary()
+        for c in "ABC|":
+            d.add_symbol(c)
+        lines = ["A B | C", "", "C\tD  A", " B |"]
+        expected = [[4, 5, 7, 6, 2], [2], [6, d.unk(), 4, 2], [5, 7, 2]]
+        ids = d.encode_lines(lines, add_if_not_exist=False)
+        self.assertEqual([t.tolist() for t in ids], expected)
+        self.assertEqual(ids[0].dtype, torch.int32)
+        # words of several letters take the general path
+        ids = d.encode_lines(lines + ["AB C"], add_if_not_exist=False)
+        self.assertEqual([t.tolist() for t in ids], expected + [[d.unk(), 6, 2]])
+        self.assertEqual(
+            d.encode_line("A B C", add_if_not_exist=False, reverse_order=True).tolist(),
+            [6, 5, 4, 2],
+        )
+        # new symbols update the lookup tables
+        self.assertEqual(d.encode_line("D").tolist(), [8, 2])
+        self.assertEqual(d.encode_line("D", add_if_not_exist=False).tolist(), [8, 2])
+        self.assertEqual(d.string(torch.LongTensor([8, 4])), "D A")
+
     def test_add_file_to_dict(self):
         counts = {}
         num_lines = 100
@@ -0,0 +1,95 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import multiprocessing as mp
+import os
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from fairseq.data.mmap_cache import MMapFeatureCache
+
+
+class TestMMapFeatureCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "cache", "train")
+        self.sizes = np.array([3, 0, 5, 1])
+        rng = np.random.RandomState(0)
+        self.entries = [rng.randn(n, 4).astype(np.float32) for n in self.sizes]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _cache(self, **kwargs):
+        kwargs.setdefault("fingerprint", "a")
+        return MMapFeatureCache(
+            self.path, self.sizes, feature_shape=(4,), dtype=np.float32, **kwargs
+        )
+
+    def test_lazy_fill_and_reopen(self):
+        cache = self._cache()
+        self.assertEqual(cache.num_filled, 0)
+        for i in [2, 0]:
+            cache[i] = self.entries[i]
+        self.assertNotIn(1, cache)
+        self.assertIn(2, cache)
+        np.testing.assert_array_equal(cache[2], self.entries[2])
+        cache.flush()
+
+        reopened = self._cache(readonly=True)
+        self.assertEqual(reopened.num_filled, 2)
+        for i in [0, 2]:
+            np.testing.assert_array_equal(reopened[i], self.entries[i])
+        self.assertEqual(reopened.entry_nbytes(2), 5 * 4 * 4)
+
+    def test_stale_fingerprint_is_rebuilt(self):
+        cache = self._cache()
+        cache[0] = self.entries[0]
+        cache.flush()
+        self.assertEqual(self._cache().num_filled, 1)
+        self.assertEqual(self._cache(fingerprint="b").num_filled, 0)
+        with self.assertRaises(FileNotFoundError):
+            self._cache(fingerprint="c", readonly=True)
+
+    def test_concurrent_creation(self):
+        # e.g. distributed ranks opening the same cache: every process keeps
+        # the entries it writes, none of them maps a replaced file
+        ctx = mp.get_context("fork")
+        start = ctx.Event()
+
+        def fill(i):
+            start.wait()
+            cache = self._cache()
+            cache[i] = self.entries[i]
+            cache.flush()
+
+        procs = [ctx.Process(target=fill, args=(i,)) for i in range(len(self.sizes))]
+        for p in procs:
+            p.start()
+        start.set()
+        for p in procs:
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+        cache = self._cache(readonly=True)
+        self.assertEqual(cache.num_filled, len(self.sizes))
+        for i, entry in enumerate(self.entries):
+            np.testing.assert_array_equal(cache[i], entry)
+        self.assertFalse(os.path.exists(cache.lock_path))
+
+    def test_stale_lock_is_removed(self):
+        os.makedirs(os.path.dirname(self.path))
+        lock_path = self.path + ".lock"
+        open(lock_path, "w").close()
+        old = time.time() - 2 * MMapFeatureCache._LOCK_TIMEOUT
+        os.utime(lock_path, (old, old))
+        self.assertEqual(self._cache().num_filled, 0)
+        self.assertFalse(os.path.exists(lock_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from fairseq.data import FileAudioDataset
+
+try:
+    import soundfile as sf
+except ImportError:
+    sf = None
+
+
+@unittest.skipIf(sf is None, "soundfile is not installed")
+class TestFileAudioDatasetCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.manifest = os.path.join(self.tmpdir.name, "train.tsv")
+        self.cache_dir = os.path.join(self.tmpdir.name, "cache")
+        rng = np.random.RandomState(0)
+        with open(self.manifest, "w") as f:
+            print(self.tmpdir.name, file=f)
+            for i, n in enumerate([1600, 800, 2400]):
+                wav = rng.randint(-(1 << 15), 1 << 15, n).astype(np.int16)
+                sf.write(os.path.join(self.tmpdir.name, f"{i}.flac"), wav, 16000)
+                print(f"{i}.flac\t{n}", file=f)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _dataset(self, **kwargs):
+        return FileAudioDataset(self.manifest, sample_rate=16000, **kwargs)
+
+    def test_cache_matches_decoding(self):
+        reference = self._dataset()
+        cached = self._dataset(audio_cache_dir=self.cache_dir)
+        self.assertEqual(cached.get_audio_cache().num_filled, 0)
+        for _ in range(2):
+            for i in range(len(reference)):
+                self.assertTrue(
+                    torch.equal(cached[i]["source"], reference[i]["source"])
+                )
+        self.assertEqual(cached.get_audio_cache().num_filled, len(reference))
+
+        # a new dataset over the same manifest reuses the decoded audio
+        reopened = self._dataset(audio_cache_dir=self.cache_dir)
+        self.assertEqual(reopened.get_audio_cache().num_filled, len(reference))
+        self.assertTrue(torch.equal(reopened[2]["source"], reference[2]["source"]))
+
+    def test_manifest_change_invalidates_cache(self):
+        cached = self._dataset(audio_cache_dir=self.cache_dir)
+        cached[0]
+        cached.get_audio_cache().flush()
+        with open(self.manifest) as f:
+            lines = f.readlines()
+        with open(self.manifest, "w") as f:
+            f.writelines(lines[:1] + lines[2:] + lines[1:2])
+        reopened = self._dataset(audio_cache_dir=self.cache_dir)
+        self.assertEqual(reopened.get_audio_cache().num_filled, 0)
+
+    def test_collater(self):
+        dataset = self._dataset(pad=True)
+        samples = [dataset[i] for i in range(3)]
+        net_input = dataset.collater(samples)["net_input"]
+        self.assertEqual(tuple(net_input["source"].shape), (3, 2400))
+        for i, n in enumerate([1600, 800, 2400]):
+            self.assertTrue(
+                torch.equal(net_input["source"][i, :n], samples[i]["source"])
+            )
+            self.assertTrue(net_input["source"][i, n:].eq(0).all())
+            self.assertEqual(net_input["padding_mask"][i].sum().item(), 2400 - n)
+
+        # bucketed batches are padded to the bucket size
+        dataset.set_bucket_info(1)
+        net_input = dataset.collater(samples[:2])["net_input"]
+        self.assertEqual(tuple(net_input["source"].shape), (2, 2400))
+        self.assertEqual(net_input["padding_mask"].sum(-1).tolist(), [800, 1600])
+
+        # without padding, sources are cropped to the shortest one
+        dataset = self._dataset(pad=False)
+        net_input = dataset.collater([dataset[i] for i in range(3)])["net_input"]
+        self.assertEqual(tuple(net_input["source"].shape), (3, 800))
+        self.assertNotIn("padding_mask", net_input)
+
+    def test_feature_cache_ids(self):
+        dataset = self._dataset(pad=True, max_sample_size=2000)
+        net_input = dataset.collater([dataset[i] for i in range(3)])["net_input"]
+        self.assertNotIn("feature_cache_ids", net_input)
+
+        dataset = self._dataset(
+            pad=True, max_sample_size=2000, feature_cache_key="train"
+        )
+        net_input = dataset.collater([dataset[i] for i in [2, 0, 1]])["net_input"]
+        self.assertEqual(net_input["feature_cache_key"], "train")
+        # the cropped source is not cached
+        self.assertEqual(net_input["feature_cache_ids"].tolist(), [-1, 0, 1])
+
+    def test_num_tokens_vec(self):
+        indices = np.array([2, 0, 1])
+        for pad in [False, True]:
+            dataset = self._dataset(max_sample_size=1000, pad=pad)
+            self.assertEqual(
+                dataset.num_tokens_vec(indices).tolist(),
+                [dataset.num_tokens(i) for i in indices],
+            )
+
+    def test_min_padding_batches(self):
+        for min_padding_batches, expected in [
+            (False, [[2, 0], [1]]),
+            (True, [[2], [0, 1]]),
+        ]:
+            dataset = self._dataset(pad=True, min_padding_batches=min_padding_batches)
+            # greedy batching pads 1000 to 2400, instead of 800 to 1000
+            dataset.sizes = np.array([1000, 800, 2400])
+            batches = dataset.batch_by_size(np.array([2, 0, 1]), max_tokens=4800)
+            self.assertEqual([b.tolist() for b in batches], expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import string
+import unittest
+from collections import Counter
+
+import torch
+
+from fairseq.data import Dictionary, data_utils
+from fairseq.data.text_augment import BatchedTextAugment
+
+
+class TestBatchedTextAugment(unittest.TestCase):
+    def setUp(self):
+        self.vocab = Dictionary()
+        for c in "|" + string.ascii_uppercase:
+            self.vocab.add_symbol(c)
+        lines = [
+            "THE QUICK BROWN FOX JUMPS OVER",
+            "A LAZY DOG",
+            "HELLO WORLD AGAIN AND AGAIN",
+            "X",
+        ]
+        rows = [
+            self.vocab.encode_line(
+                " ".join(line.replace(" ", "|")) + " |", append_eos=False
+            ).long()
+            for line in lines
+        ]
+        self.lengths = torch.LongTensor([len(r) for r in rows])
+        self.tokens = data_utils.collate_tokens(rows, self.vocab.pad())
+        self.augment = BatchedTextAugment(self.vocab, seed=3)
+
+    def _words(self, row):
+        return self.vocab.string(row[row.ne(self.vocab.pad())]).replace(" ", "")
+
+    def test_shapes_and_reference(self):
+        out = self.augment(self.tokens, self.lengths, num_aug=2)
+        self.assertEqual(len(out), 7)
+        self.assertIs(out[0], self.tokens)
+        for swap, delete, insert in zip(out[1::3], out[2::3], out[3::3]):
+            self.assertEqual(swap.shape, self.tokens.shape)
+            self.assertEqual(delete.shape, self.tokens.shape)
+            self.assertEqual(insert.size(1), self.tokens.size(1) + 4)
+
+    def test_swap_permutes_words(self):
+        for step in range(20):
+            swap = self.augment(self.tokens, self.lengths, step=step)[1]
+            for i in range(self.tokens.size(0)):
+                ref, hyp = self._words(self.tokens[i]), self._words(swap[i])
+                self.assertEqual(len(ref), len(hyp))
+                self.assertTrue(hyp.endswith("|"))
+                self.assertEqual(Counter(ref.split("|")), Counter(hyp.split("|")))
+                if ref.count("|") < 3:
+                    self.assertEqual(ref, hyp)
+
+    def test_delete_removes_one_span(self):
+        for step in range(20):
+            delete = self.augment(self.tokens, self.lengths, step=step)[2]
+            for i, length in enumerate(self.lengths.tolist()):
+                ref = self.tokens[i, :length].tolist()
+                hyp = delete[i][delete[i].ne(self.vocab.pad())].tolist()
+                num_del = len(ref) - len(hyp)
+                if length < 2:
+                    self.assertEqual(num_del, 0)
+                    continue
+                self.assertTrue(1 <= num_del <= length // 2)
+                self.assertTrue(
+                    any(
+                        ref[:s] + ref[s + num_del :] == hyp
+                        for s in range(length - num_del + 1)
+                    )
+                )
+
+    def test_insert_repeats_one_token(self):
+        for step in range(20):
+            insert = self.augment(self.tokens, self.lengths, step=step)[3]
+            for i, length in enumerate(self.lengths.tolist()):
+                ref = self.tokens[i, :length].tolist()
+                hyp = insert[i][insert[i].ne(self.vocab.pad())].tolist()
+                num_ins = len(hyp) - len(ref)
+                self.assertTrue(0 <= num_ins <= min(4, length - 1))
+                if num_ins == 0:
+                    self.assertEqual(ref, hyp)
+                    continue
+                self.assertTrue(
+                    any(
+                        ref[:s] + [ref[s]] * num_ins + ref[s:] == hyp
+                        for s in range(length - num_ins)
+                    )
+                )
+
+    def test_reproducible(self):
+        out1 = self.augment(self.tokens, self.lengths, step=7)
+        out2 = self.augment(self.tokens, self.lengths, step=7)
+        for a, b in zip(out1, out2):
+            self.assertTrue(torch.equal(a, b))
+
+
+if __name__ == "__main__":
+    unittest.main()
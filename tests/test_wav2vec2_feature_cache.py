@@ -0,0 +1,132 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from fairseq.models.wav2vec.feature_cache import ConvFeatureCache
+from fairseq.models.wav2vec.wav2vec2 import Wav2Vec2Config, Wav2Vec2Model
+
+
+class TestConvFeatureCache(unittest.TestCase):
+    def setUp(self):
+        self.model = self._model("layer_norm")
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.sizes = np.array([1000, 700, 1000, 400])
+        self.sources = [torch.randn(n) for n in self.sizes]
+
+        self.conv_calls = 0
+
+        def count(module, input, output):
+            self.conv_calls += 1
+
+        self.model.feature_extractor.register_forward_hook(count)
+
+    @staticmethod
+    def _model(extractor_mode):
+        torch.manual_seed(0)
+        cfg = Wav2Vec2Config(
+            encoder_layers=1,
+            encoder_embed_dim=32,
+            encoder_ffn_embed_dim=64,
+            encoder_attention_heads=2,
+            conv_feature_layers="[(32, 10, 5)] + [(32, 3, 2)]",
+            conv_pos=16,
+            extractor_mode=extractor_mode,
+            feature_grad_mult=0.0,
+        )
+        return Wav2Vec2Model(cfg).eval()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _cache(self):
+        cache = ConvFeatureCache(self.tmpdir.name)
+        cache.update(self.model, {"train": self.sizes})
+        return cache
+
+    def _extract(self, ids, cache=True):
+        lengths = torch.LongTensor(self.sizes[ids])
+        source = torch.zeros(len(ids), int(lengths.max()))
+        for i, id in enumerate(ids):
+            source[i, : lengths[i]] = self.sources[id]
+        padding_mask = torch.arange(source.size(1)) >= lengths.unsqueeze(1)
+        kwargs = {}
+        if cache:
+            kwargs["feature_cache_key"] = "train"
+            kwargs["feature_cache_ids"] = torch.LongTensor(ids)
+        with torch.no_grad():
+            return self.model.extract_features(source, padding_mask, **kwargs)
+
+    def test_hits_skip_the_conv_stack(self):
+        self.model.feature_cache = self._cache()
+        expected = self._extract([0, 1], cache=False)["x"]
+
+        self.conv_calls = 0
+        x = self._extract([0, 1])["x"]
+        self.assertEqual(self.conv_calls, 1)
+        self.assertTrue(torch.equal(x, expected))
+        self.assertEqual(self.model.feature_cache.caches["train"].num_filled, 2)
+
+        # the cached features are float16
+        x = self._extract([0, 1])["x"]
+        self.assertEqual(self.conv_calls, 1)
+        self.assertTrue(torch.allclose(x, expected, atol=1e-2))
+
+        # a batch with a miss is computed as a whole
+        self._extract([2, 0])
+        self.assertEqual(self.conv_calls, 2)
+        self.assertEqual(self.model.feature_cache.caches["train"].num_filled, 3)
+
+        # cropped sources are not cached
+        self.model.feature_cache.put(
+            "train", torch.LongTensor([-1]), torch.zeros(1, 32, 100)
+        )
+        self.assertEqual(self.model.feature_cache.caches["train"].num_filled, 3)
+
+    def test_conv_weights_invalidate_cache(self):
+        self.model.feature_cache = self._cache()
+        self._extract([0, 1, 3])
+        self.assertEqual(self._cache().caches["train"].num_filled, 3)
+
+        with torch.no_grad():
+            self.model.feature_extractor.conv_layers[0][0].weight.mul_(2)
+        self.model.feature_cache.update(self.model, {"train": self.sizes})
+        self.assertEqual(self.model.feature_cache.caches["train"].num_filled, 0)
+
+    def test_trained_feature_extractor_is_not_cached(self):
+        self.model.feature_cache = self._cache()
+        self.model.feature_grad_mult = 0.1
+        self._extract([0])
+        self._extract([0])
+        self.assertEqual(self.conv_calls, 2)
+        self.assertEqual(self.model.feature_cache.caches["train"].num_filled, 0)
+
+    def test_group_norm_caches_unpadded_batches(self):
+        self.model = self._model("default")
+        self.model.feature_extractor.register_forward_hook(
+            lambda *args: setattr(self, "conv_calls", self.conv_calls + 1)
+        )
+        self.model.feature_cache = self._cache()
+
+        # the group norm sees the padding of 1 in this batch
+        self._extract([0, 1])
+        self._extract([0, 1])
+        self.assertEqual(self.conv_calls, 2)
+        self.assertEqual(self.model.feature_cache.caches["train"].num_filled, 0)
+
+        expected = self._extract([0], cache=False)["x"]
+        self._extract([0, 2])
+        self.assertEqual(self.model.feature_cache.caches["train"].num_filled, 2)
+        x = self._extract([0])["x"]
+        self.assertEqual(self.conv_calls, 4)
+        self.assertTrue(torch.allclose(x, expected, atol=1e-2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+import torch
+
+from fairseq.models.wav2vec.wav2vec2 import Wav2Vec2Config, Wav2Vec2Model
+
+
+class TestWav2Vec2ResultLayers(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        cfg = Wav2Vec2Config(
+            encoder_layers=3,
+            encoder_embed_dim=32,
+            encoder_ffn_embed_dim=64,
+            encoder_attention_heads=2,
+            conv_feature_layers="[(32, 10, 5)] + [(32, 3, 2)]",
+            conv_pos=16,
+            required_seq_len_multiple=4,
+        )
+        self.model = Wav2Vec2Model(cfg).eval()
+        self.source = torch.randn(2, 1000)
+        self.padding_mask = torch.zeros(2, 1000, dtype=torch.bool)
+        self.padding_mask[1, 700:] = True
+
+    def _extract(self, result_layers):
+        with torch.no_grad():
+            return self.model.extract_features(
+                self.source, self.padding_mask, result_layers=result_layers
+            )
+
+    def test_result_layers(self):
+        full = self._extract(None)
+        self.assertEqual(len(full["layer_results"]), 3)
+        for result_layers, expected in [((), []), ((0, -1), [0, 2]), ([1], [1])]:
+            res = self._extract(result_layers)
+            self.assertTrue(torch.equal(res["x"], full["x"]))
+            self.assertEqual(len(res["layer_results"]), len(expected))
+            for (x, _, lr), i in zip(res["layer_results"], expected):
+                self.assertTrue(torch.equal(x, full["layer_results"][i][0]))
+                self.assertTrue(torch.equal(lr, full["layer_results"][i][2]))
+
+    def test_out_of_range(self):
+        with self.assertRaises(AssertionError):
+            self._extract([3])
+
+
+if __name__ == "__main__":
+    unittest.main()